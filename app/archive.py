@@ -0,0 +1,215 @@
+import asyncio, json, os, tarfile, time, zipfile
+from collections import deque
+from typing import Awaitable, Callable, Iterable, List, Optional
+from azure.storage.blob import BlobClient, ContentSettings
+from .azure_dest import BlockSink, make_write_sas
+from .buffers import MiB, UploadBuffers, block_size_for, upload_buffers
+from .config import settings
+from .http_clients import get_client, azure_transport
+from .metrics import MOODLE_TTFB, MOODLE_ERRORS, TRANSFER_BYTES
+from .ratelimit import limiter_for, send_with_retry
+
+class TarWriter:
+    ext = "tar"
+    content_type = "application/x-tar"
+
+    def __init__(self, sink: BlockSink):
+        self.sink = sink
+
+    def begin(self, name: str, size: int, mtime: Optional[int]) -> int:
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = mtime or 0
+        self.sink.write(info.tobuf(format=tarfile.PAX_FORMAT))
+        self.size = size
+        return self.sink.tell()
+
+    def write(self, data: bytes):
+        self.sink.write(data)
+
+    def end(self):
+        self.sink.write(b"\0" * (-self.size % tarfile.BLOCKSIZE))
+
+    def close(self):
+        self.sink.write(b"\0" * (2 * tarfile.BLOCKSIZE))
+
+class ZipWriter:
+    # Members are stored, not deflated: course files are mostly PDFs, images and video
+    ext = "zip"
+    content_type = "application/zip"
+
+    def __init__(self, sink: BlockSink):
+        self.sink = sink
+        self.zf = zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_STORED, allowZip64=True)
+
+    def begin(self, name: str, size: int, mtime: Optional[int]) -> int:
+        info = zipfile.ZipInfo(name, date_time=time.gmtime(max(mtime or 0, 315532800))[:6])
+        info.file_size = size
+        self.member = self.zf.open(info, "w", force_zip64=size >= zipfile.ZIP64_LIMIT)
+        return self.sink.tell()
+
+    def write(self, data: bytes):
+        self.member.write(data)
+
+    def end(self):
+        self.member.close()
+
+    def close(self):
+        self.zf.close()
+
+WRITERS = {"tar": TarWriter, "zip": ZipWriter}
+
+def unique_name(name: str, seen: set) -> str:
+    # Moodle filenames are only unique per module; the archive needs unique paths
+    stem, ext = os.path.splitext(name)
+    n, candidate = 1, name
+    while candidate in seen:
+        n += 1
+        candidate = f"{stem} ({n}){ext}"
+    seen.add(candidate)
+    return candidate
+
+class ArchiveJob:
+    """Writes a job's files, in order, as one ZIP or tar blob plus an `<archive>.index.json` manifest.
+
+    Files up to ARCHIVE_INLINE_MB are downloaded ahead of the writer, TRANSFER_FILE_CONCURRENCY at a time;
+    bigger ones are streamed straight into the archive when their turn comes. Nothing touches local disk.
+    """
+
+    def __init__(self, blob_name: str, fmt: str, source_url: Callable[[dict], Awaitable[str]],
+                 auth_header: Callable[[], Awaitable[Optional[str]]],
+                 on_file: Callable[[dict, Optional[dict], Optional[str]], None],
+                 on_progress: Optional[Callable[[int], None]] = None, size_hint: Optional[int] = None):
+        self.blob_name = blob_name
+        self.size_hint = size_hint  # roughly the archive's size (the files' total), to pick the block size
+        self.fmt = fmt
+        self.source_url = source_url
+        self.auth_header = auth_header
+        self.on_file = on_file  # (file, index entry or None, error or None)
+        self.on_progress = on_progress
+        self.index: List[dict] = []
+
+    async def _headers(self) -> dict:
+        auth = await self.auth_header()
+        return {"Authorization": auth} if auth else {}
+
+    async def _fetch(self, f: dict) -> Optional[bytes]:
+        if f["filesize"] > settings.ARCHIVE_INLINE_MB * 1024 * 1024:
+            return None  # streamed in order by _stream_member
+        url = await self.source_url(f)
+        r = await send_with_retry(get_client(url, download=True), "GET", url, measure_latency=False,
+                                  headers=await self._headers())
+        r.raise_for_status()
+        TRANSFER_BYTES.labels("download").inc(len(r.content))
+        return r.content
+
+    async def _stream_member(self, writer, sink: BlockSink, f: dict, name: str) -> dict:
+        url = await self.source_url(f)
+        lim = limiter_for(url)
+        async with lim.slot(measure_latency=False) as slot:
+            started = time.monotonic()
+            async with get_client(url, download=True).stream("GET", url, headers=await self._headers()) as r:
+                MOODLE_TTFB.labels(lim.host, "GET").observe(time.monotonic() - started)
+                slot.done(r)
+                if r.status_code >= 400:
+                    MOODLE_ERRORS.labels(lim.host, str(r.status_code)).inc()
+                r.raise_for_status()
+                # The member header carries the size, so it must be known before the first byte
+                size = int(r.headers.get("content-length") or -1)
+                if size < 0:
+                    raise IOError(f"{f['filename']}: no Content-Length, can't be streamed into the archive")
+                offset = writer.begin(name, size, f.get("timemodified"))
+                written = 0
+                async for chunk in r.aiter_bytes():
+                    TRANSFER_BYTES.labels("download").inc(len(chunk))
+                    writer.write(chunk)
+                    written += len(chunk)
+                    if self.on_progress:
+                        self.on_progress(len(chunk))
+                    await sink.drain()
+                if written != size:
+                    raise IOError(f"{f['filename']}: expected {size} bytes, got {written}")
+                writer.end()
+        return {"name": name, "fileurl": f["fileurl"], "offset": offset, "size": size, "timemodified": f.get("timemodified")}
+
+    async def run(self, files: Iterable[dict]) -> str:
+        bc = BlobClient.from_blob_url(make_write_sas(self.blob_name), transport=azure_transport())
+        block = block_size_for(self.size_hint)
+        inline = settings.ARCHIVE_INLINE_MB * MiB
+        staging = block * max(1, settings.AZURE_BLOB_UPLOAD_CONCURRENCY)
+        window = max(1, settings.TRANSFER_FILE_CONCURRENCY)
+        # The archive's memory comes out of the upload budget in one piece, up front: blocks being staged, the
+        # sink's buffer (up to a block plus a member, as write() can't wait) and the members downloaded ahead
+        # plus the one being written. Reserving those one at a time could deadlock, with downloaded members
+        # holding the budget while their writers wait for blocks
+        shared = upload_buffers()
+        held = await shared.reserve(staging + block + inline + (window + 1) * inline)
+        # Less than asked for when the budget is small: stage fewer blocks at once and download fewer ahead
+        blocks = min(staging, held)
+        window = max(1, min(window, (held - blocks - block - inline) // max(1, inline) - 1))
+        sink = BlockSink(bc, block, UploadBuffers(blocks))
+        writer = WRITERS[self.fmt](sink)
+        seen, failed = set(), []
+        ahead = deque()
+        files = iter(files)
+
+        def refill():
+            while len(ahead) < window:
+                f = next(files, None)
+                if f is None:
+                    return
+                ahead.append((f, asyncio.ensure_future(self._fetch(f))))
+
+        try:
+            refill()
+            while ahead:
+                f, task = ahead.popleft()
+                try:
+                    data = await task
+                except Exception as e:
+                    failed.append({"fileurl": f["fileurl"], "filename": f["filename"], "error": str(e)})
+                    self.on_file(f, None, str(e))
+                    refill()
+                    continue
+                refill()
+                name = unique_name(f["filename"], seen)
+                if data is None:
+                    before = sink.tell()
+                    try:
+                        entry = await self._stream_member(writer, sink, f, name)
+                    except Exception as e:
+                        if sink.tell() != before:
+                            raise  # part of the member is already in the archive: it can't be skipped any more
+                        seen.discard(name)
+                        failed.append({"fileurl": f["fileurl"], "filename": f["filename"], "error": str(e)})
+                        self.on_file(f, None, str(e))
+                        continue
+                else:
+                    offset = writer.begin(name, len(data), f.get("timemodified"))
+                    writer.write(data)
+                    writer.end()
+                    if self.on_progress:
+                        self.on_progress(len(data))
+                    entry = {"name": name, "fileurl": f["fileurl"], "offset": offset, "size": len(data),
+                             "timemodified": f.get("timemodified")}
+                    await sink.drain()
+                self.index.append(entry)
+                self.on_file(f, entry, None)
+            writer.close()
+            await sink.commit()
+        except BaseException:
+            for _, task in ahead:
+                task.cancel()
+            await asyncio.gather(*(t for _, t in ahead), return_exceptions=True)
+            await sink.abort()
+            raise
+        finally:
+            shared.unreserve(held)
+
+        # offset is where the member's bytes start, so one file can be read back with a Range request
+        manifest = {"archive": self.blob_name, "format": self.fmt, "size": sink.tell(),
+                    "files": self.index, "failed": failed}
+        index_bc = BlobClient.from_blob_url(make_write_sas(f"{self.blob_name}.index.json"), transport=azure_transport())
+        await asyncio.to_thread(index_bc.upload_blob, json.dumps(manifest).encode(), overwrite=True,
+                                content_settings=ContentSettings(content_type="application/json"))
+        return self.blob_name
@@ -0,0 +1,133 @@
+import asyncio, os, signal, socket, traceback
+from datetime import datetime, timezone
+from typing import List, Optional, Set
+from rq import Queue
+from rq.exceptions import DequeueTimeout
+from rq.job import Job, JobStatus
+from rq.registry import StartedJobRegistry, FinishedJobRegistry, FailedJobRegistry
+from .config import settings
+from .db import close_async_engine
+from .http_clients import close_clients
+from .jobs import run_transfer, observe_queue_wait
+from .redis_conn import get_redis
+from .scheduler import dispatch
+
+# RQ functions that have a coroutine twin; these run on the loop instead of in a thread
+ASYNC_HANDLERS = {
+    "app.jobs.perform_transfer": run_transfer,
+}
+
+class AsyncWorker:
+    """Consumes RQ queues from one long-lived process, running many jobs on one event loop.
+
+    Unlike rq's Worker there is no fork per job, so the DB pool, Redis connection, per-host
+    HTTP pools and Azure session stay warm between jobs. SIGTERM/SIGINT stop dequeuing and
+    wait up to WORKER_DRAIN_TIMEOUT for running jobs; the rest are re-queued.
+    """
+
+    def __init__(self, queue_names: List[str], concurrency: int):
+        self.redis = get_redis()
+        self.queues = [Queue(name, connection=self.redis) for name in queue_names]
+        self.concurrency = max(1, concurrency)
+        self.name = f"async-{socket.gethostname()}-{os.getpid()}"
+        self.stopping = False
+        self.tasks: Set[asyncio.Task] = set()
+
+    def stop(self):
+        if not self.stopping:
+            print(f"[INFO] {self.name}: draining {len(self.tasks)} running jobs")
+        self.stopping = True
+
+    def _dequeue(self) -> Optional[Job]:
+        try:
+            res = Queue.dequeue_any(self.queues, timeout=settings.WORKER_DEQUEUE_TIMEOUT, connection=self.redis)
+        except DequeueTimeout:
+            return None
+        return res[0] if res else None
+
+    def _started(self, job: Job):
+        pipe = self.redis.pipeline()
+        job.prepare_for_execution(self.name, pipe)
+        StartedJobRegistry(job.origin, connection=self.redis).add(job, (job.timeout or settings.TRANSFER_JOB_TIMEOUT) + 60,
+                                                                  pipeline=pipe)
+        pipe.execute()
+
+    def _finished(self, job: Job, exc_string: Optional[str]):
+        pipe = self.redis.pipeline()
+        StartedJobRegistry(job.origin, connection=self.redis).remove(job, pipeline=pipe)
+        job.ended_at = datetime.now(timezone.utc).replace(tzinfo=None)
+        if exc_string is None:
+            job.set_status(JobStatus.FINISHED, pipeline=pipe)
+            FinishedJobRegistry(job.origin, connection=self.redis).add(job, job.result_ttl or 500, pipeline=pipe)
+        else:
+            job.set_status(JobStatus.FAILED, pipeline=pipe)
+            FailedJobRegistry(job.origin, connection=self.redis).add(job, job.failure_ttl, exc_string=exc_string,
+                                                                     pipeline=pipe)
+        pipe.execute()
+
+    async def _execute(self, job: Job):
+        exc_string = None
+        try:
+            observe_queue_wait(job)
+            await asyncio.to_thread(self._started, job)
+            handler = ASYNC_HANDLERS.get(job.func_name)
+            if handler is not None:
+                await handler(*job.args, **job.kwargs)
+            else:
+                await asyncio.to_thread(job.perform)
+        except asyncio.CancelledError:
+            # Drain timed out: hand the job back so another worker resumes it from its checkpoints
+            pipe = self.redis.pipeline()
+            StartedJobRegistry(job.origin, connection=self.redis).remove(job, pipeline=pipe)
+            pipe.execute()
+            Queue(job.origin, connection=self.redis).enqueue_job(job)
+            print(f"[INFO] {self.name}: re-queued unfinished job {job.id}")
+            raise
+        except Exception:
+            exc_string = traceback.format_exc()
+            print(f"[WARN] {self.name}: job {job.id} failed\n{exc_string}")
+        try:
+            await asyncio.to_thread(self._finished, job, exc_string)
+        except Exception as e:
+            print(f"[WARN] {self.name}: could not record result of job {job.id}: {e}")
+
+    async def _dispatch(self):
+        # Idle: make sure nothing waits in the DB because the job that should have dispatched it died
+        try:
+            await asyncio.to_thread(dispatch)
+        except Exception as e:
+            print(f"[WARN] {self.name}: dispatch failed: {e}")
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self.stop)
+        slots = asyncio.Semaphore(self.concurrency)
+        print(f"[INFO] {self.name}: listening on {[q.name for q in self.queues]} with {self.concurrency} job slots")
+        try:
+            while not self.stopping:
+                await slots.acquire()
+                job = None
+                try:
+                    if not self.stopping:
+                        job = await asyncio.to_thread(self._dequeue)
+                finally:
+                    if job is None:
+                        slots.release()
+                if job is None:
+                    if not self.stopping:
+                        await self._dispatch()
+                    continue
+                task = asyncio.create_task(self._execute(job))
+                self.tasks.add(task)
+                task.add_done_callback(lambda t: (self.tasks.discard(t), slots.release()))
+            # Graceful drain: let running transfers finish, take nothing new
+            if self.tasks:
+                _, pending = await asyncio.wait(set(self.tasks), timeout=settings.WORKER_DRAIN_TIMEOUT)
+                for t in pending:
+                    t.cancel()
+                if pending:
+                    await asyncio.gather(*pending, return_exceptions=True)
+        finally:
+            await close_clients()
+            await close_async_engine()
@@ -1,7 +1,19 @@
-from azure.storage.blob import BlobServiceClient, BlobClient, generate_blob_sas, BlobSasPermissions
+from azure.storage.blob import BlobServiceClient, BlobClient, BlobBlock, generate_blob_sas, BlobSasPermissions
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
 from datetime import datetime, timedelta
+from typing import Callable, Dict, Optional
 from .config import settings
-import httpx, asyncio
+from .buffers import UploadBuffers, block_size_for, single_put, upload_buffers
+from .http_clients import get_client, azure_transport
+from .metrics import MOODLE_TTFB, MOODLE_ERRORS, TRANSFER_BYTES, AZURE_STAGE, AZURE_COMMIT, AZURE_PUT
+from .ratelimit import host_key, limiter_for, send_with_retry
+import httpx, asyncio, base64, time
+
+class RangesNotSupported(Exception):
+    """Source ignored a Range request; the caller should fall back to a single stream."""
+
+class SourceUnreachable(Exception):
+    """Azure could not fetch the source itself; the caller should stream it through the worker instead."""
 
 def make_write_sas(blob_name: str, hours: int = 2) -> str:
     sas = generate_blob_sas(
@@ -9,26 +21,372 @@ def make_write_sas(blob_name: str, hours: int = 2) -> str:
         container_name=settings.AZURE_BLOB_CONTAINER,
         blob_name=blob_name,
         account_key=settings.AZURE_STORAGE_KEY,
-        permission=BlobSasPermissions(write=True, create=True, add=True),
+        # read lets a resumed transfer list the blocks it already staged
+        permission=BlobSasPermissions(read=True, write=True, create=True, add=True),
         expiry=datetime.utcnow() + timedelta(hours=hours)
     )
-    return f"https://{settings.AZURE_STORAGE_ACCOUNT}.blob.core.windows.net/{settings.AZURE_BLOB_CONTAINER}/{blob_name}?{sas}"
+    endpoint = settings.AZURE_BLOB_ENDPOINT or f"https://{settings.AZURE_STORAGE_ACCOUNT}.blob.core.windows.net"
+    return f"{endpoint.rstrip('/')}/{settings.AZURE_BLOB_CONTAINER}/{blob_name}?{sas}"
+
+def block_id(index: int) -> str:
+    # Azure requires every block id of a blob to have the same length
+    return base64.b64encode(f"{index:08d}".encode()).decode()
+
+def _stage(bc: BlobClient, bid: str, data: bytes):
+    with AZURE_STAGE.time():
+        bc.stage_block(bid, data, length=len(data))
+    TRANSFER_BYTES.labels("upload").inc(len(data))
+
+def _commit(bc: BlobClient, ids):
+    with AZURE_COMMIT.time():
+        bc.commit_block_list([BlobBlock(block_id=b) for b in ids])
+
+def _put(bc: BlobClient, data: bytes):
+    with AZURE_PUT.time():
+        bc.upload_blob(data, length=len(data), overwrite=True, max_concurrency=1)
+    TRANSFER_BYTES.labels("upload").inc(len(data))
+
+async def staged_stream_copy(client: httpx.AsyncClient, source_url: str, bc: BlobClient, headers: dict,
+                             block_size: Optional[int] = None, on_progress: Optional[Callable[[int], None]] = None):
+    """Stream the source once, staging each full block while the next one downloads.
+
+    Without a block_size it is picked from Content-Length; sources up to AZURE_SINGLE_PUT_MB go up in one
+    Put Blob. Block buffers come from the process-wide pool, so they count against AZURE_UPLOAD_MEMORY_MB.
+    """
+    buffers = upload_buffers()
+    sem = asyncio.Semaphore(max(1, settings.AZURE_BLOB_UPLOAD_CONCURRENCY))
+    ids, tasks = [], []
+
+    async def stage(bid: str, buf: bytearray, n: int):
+        try:
+            await asyncio.to_thread(_stage, bc, bid, memoryview(buf)[:n])
+            if on_progress:
+                on_progress(n)
+        finally:
+            buffers.give(buf)
+            sem.release()
+
+    async def flush(buf: bytearray, n: int):
+        await sem.acquire()  # at most AZURE_BLOB_UPLOAD_CONCURRENCY blocks buffered in flight
+        bid = block_id(len(ids))
+        ids.append(bid)
+        tasks.append(asyncio.ensure_future(stage(bid, buf, n)))
+
+    buf = None
+    try:
+        lim = limiter_for(source_url)
+        async with lim.slot(measure_latency=False) as slot:
+            started = time.monotonic()
+            async with client.stream("GET", source_url, headers=headers) as r:
+                MOODLE_TTFB.labels(lim.host, "GET").observe(time.monotonic() - started)
+                slot.done(r)
+                if r.status_code >= 400:
+                    MOODLE_ERRORS.labels(lim.host, str(r.status_code)).inc()
+                r.raise_for_status()
+                size = int(r.headers.get("content-length") or 0) or None
+                if single_put(size):
+                    taken = await buffers.reserve(size)
+                    try:
+                        data = await r.aread()
+                        TRANSFER_BYTES.labels("download").inc(len(data))
+                        await asyncio.to_thread(_put, bc, data)
+                    finally:
+                        buffers.unreserve(taken)
+                    if on_progress:
+                        on_progress(len(data))
+                    return
+                block_size = block_size or block_size_for(size)
+                pos = 0
+                async for chunk in r.aiter_bytes():
+                    TRANSFER_BYTES.labels("download").inc(len(chunk))
+                    view = memoryview(chunk)
+                    while view:
+                        if buf is None:
+                            buf, pos = await buffers.take(block_size), 0
+                        n = min(len(view), block_size - pos)
+                        buf[pos:pos + n] = view[:n]
+                        pos += n
+                        view = view[n:]
+                        if pos == block_size:
+                            full, buf = buf, None
+                            await flush(full, pos)
+                if buf is not None:
+                    last, buf = buf, None
+                    await flush(last, pos)
+        await asyncio.gather(*tasks)
+    except BaseException:
+        if buf is not None:
+            buffers.give(buf)
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    await asyncio.to_thread(_commit, bc, ids)
+
+class BlockSink:
+    """Write-only file object that stages what is written to it as Azure blocks.
+
+    write() only buffers (so sync writers like zipfile can use it); await drain() to stage full blocks,
+    which waits when AZURE_BLOB_UPLOAD_CONCURRENCY blocks are already in flight or `buffers` (by default
+    the process-wide upload budget) is spent.
+    """
+
+    def __init__(self, bc: BlobClient, block_size: int, buffers: Optional[UploadBuffers] = None):
+        self.bc = bc
+        self.block_size = block_size
+        self.buffers = buffers or upload_buffers()
+        self.buf = bytearray()
+        self.pos = 0
+        self.ids = []
+        self.tasks = set()
+        self.sem = asyncio.Semaphore(max(1, settings.AZURE_BLOB_UPLOAD_CONCURRENCY))
+
+    def write(self, data) -> int:
+        self.buf += data
+        self.pos += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.pos
+
+    def flush(self):
+        pass
+
+    async def _stage(self, bid: str, block: bytearray, n: int):
+        try:
+            await asyncio.to_thread(_stage, self.bc, bid, memoryview(block)[:n])
+        finally:
+            self.buffers.give(block)
+            self.sem.release()
+
+    async def drain(self, final: bool = False):
+        for t in [t for t in self.tasks if t.done()]:
+            self.tasks.discard(t)
+            t.result()  # surface a failed block now rather than at commit
+        while len(self.buf) >= self.block_size or (final and self.buf):
+            await self.sem.acquire()
+            block = await self.buffers.take(self.block_size)
+            n = min(len(self.buf), self.block_size)
+            with memoryview(self.buf) as view:
+                block[:n] = view[:n]
+            del self.buf[:n]
+            bid = block_id(len(self.ids))
+            self.ids.append(bid)
+            self.tasks.add(asyncio.ensure_future(self._stage(bid, block, n)))
+
+    async def commit(self):
+        await self.drain(final=True)
+        await asyncio.gather(*self.tasks)
+        self.tasks.clear()
+        await asyncio.to_thread(_commit, self.bc, self.ids)
+
+    async def abort(self):
+        for t in self.tasks:
+            t.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks.clear()
 
-async def stream_copy_to_azure(source_url: str, blob_name: str, auth_header: str = None, chunk_size_mb: int = None):
+async def probe_range_support(client: httpx.AsyncClient, source_url: str, headers: dict) -> Optional[int]:
+    """HEAD the source; return its size if it can be fetched in byte ranges, else None."""
+    try:
+        r = await send_with_retry(client, "HEAD", source_url, headers=headers)
+    except httpx.HTTPError:
+        return None
+    if r.status_code >= 400 or r.headers.get("accept-ranges", "").lower() != "bytes":
+        return None
+    size = int(r.headers.get("content-length") or 0)
+    return size or None
+
+async def _gather_or_cancel(coros):
+    # Like gather(), but a failed block cancels its siblings instead of leaving them running
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+def _uncommitted_blocks(bc: BlobClient) -> dict:
+    try:
+        _, uncommitted = bc.get_block_list("uncommitted")
+    except ResourceNotFoundError:
+        return {}
+    return {b.id: b.size for b in uncommitted}
+
+async def ranged_copy_to_azure(client: httpx.AsyncClient, source_url: str, bc: BlobClient, headers: dict,
+                               size: int, block_size: int, checkpoint=None,
+                               on_progress: Optional[Callable[[int], None]] = None):
+    """Fetch byte ranges in parallel, stage each one as a block, then commit the block list.
+
+    With a checkpoint, blocks staged by an earlier attempt and still present on the blob are skipped.
+    """
+    count = (size + block_size - 1) // block_size
+    done = set()
+    if checkpoint:
+        done = checkpoint.begin(size, block_size)
+        if done:
+            on_blob = await asyncio.to_thread(_uncommitted_blocks, bc)
+            done = {i for i in done
+                    if on_blob.get(block_id(i)) == min(size, (i + 1) * block_size) - i * block_size}
+            checkpoint.keep_only(done)
+            if on_progress:
+                on_progress(sum(min(size, (i + 1) * block_size) - i * block_size for i in done))
+    sem = asyncio.Semaphore(max(1, settings.AZURE_BLOB_UPLOAD_CONCURRENCY))
+    buffers = upload_buffers()
+
+    async def copy_block(index: int):
+        start = index * block_size
+        end = min(size, start + block_size) - 1
+        async with sem:
+            buf = await buffers.take(block_size)
+            n = 0
+
+            async def read_into(r: httpx.Response):
+                # Only a 206 body is read, straight into the pooled block, so nothing outside the budget is
+                # buffered. Other responses are closed unread: a 200 means the server ignored Range (the
+                # whole file), and raise_for_status needs only the status
+                nonlocal n
+                if r.status_code != 206:
+                    return
+                n = 0
+                async for chunk in r.aiter_bytes():
+                    if n + len(chunk) > len(buf):
+                        raise IOError(f"Range at {start} longer than requested")
+                    buf[n:n + len(chunk)] = chunk
+                    n += len(chunk)
+
+            try:
+                r = await send_with_retry(client, "GET", source_url, measure_latency=False, read=read_into,
+                                          headers={**headers, "Range": f"bytes={start}-{end}"})
+                if r.status_code == 200:
+                    raise RangesNotSupported(source_url)
+                r.raise_for_status()
+                TRANSFER_BYTES.labels("download").inc(n)
+                if n != end - start + 1:
+                    raise IOError(f"Short range read at {start}: got {n} bytes")
+                await asyncio.to_thread(_stage, bc, block_id(index), memoryview(buf)[:n])
+            finally:
+                buffers.give(buf)
+            if checkpoint:
+                checkpoint.mark(index)
+            if on_progress:
+                on_progress(n)
+
+    await _gather_or_cancel(copy_block(i) for i in range(count) if i not in done)
+    await asyncio.to_thread(_commit, bc, [block_id(i) for i in range(count)])
+
+# Source hosts Azure recently failed to fetch from -> monotonic time until which they are streamed instead
+_unreachable: Dict[str, float] = {}
+
+def server_copy_allowed(source_url: str) -> bool:
+    return settings.AZURE_SERVER_COPY and _unreachable.get(host_key(source_url), 0) <= time.monotonic()
+
+def _stage_from_url(bc: BlobClient, bid: str, source_url: str, offset: int, length: int):
+    with AZURE_STAGE.time():
+        bc.stage_block_from_url(bid, source_url, source_offset=offset, source_length=length)
+    TRANSFER_BYTES.labels("server_copy").inc(length)
+
+async def _copy_blob_and_wait(bc: BlobClient, source_url: str, on_progress: Optional[Callable[[int], None]]):
+    copy = await asyncio.to_thread(bc.start_copy_from_url, source_url)
+    reported = 0
+    try:
+        while True:
+            props = (await asyncio.to_thread(bc.get_blob_properties)).copy
+            status = props.status if props.id == copy["copy_id"] else copy["copy_status"]
+            if props.progress:
+                copied = int(props.progress.split("/")[0])
+                if on_progress and copied > reported:
+                    on_progress(copied - reported)
+                reported = max(reported, copied)
+            if status == "success":
+                TRANSFER_BYTES.labels("server_copy").inc(reported)
+                return
+            if status != "pending":
+                raise SourceUnreachable(props.status_description or f"copy {status}")
+            await asyncio.sleep(settings.AZURE_SERVER_COPY_POLL_SECONDS)
+    except BaseException:
+        try:
+            await asyncio.to_thread(bc.abort_copy, copy["copy_id"])
+        except HttpResponseError:
+            pass  # already finished or failed
+        raise
+
+async def server_copy_to_azure(source_url: str, bc: BlobClient, size: Optional[int],
+                               on_progress: Optional[Callable[[int], None]] = None):
+    """Have Azure pull the source itself; the worker only coordinates.
+
+    With a known size (the source accepts ranges) blocks are staged in parallel with Put Block From URL and
+    then committed; otherwise one Copy Blob is started and polled. Raises SourceUnreachable when Azure can't
+    fetch the source, and remembers the host for AZURE_SERVER_COPY_RETRY_SECONDS.
+    """
+    block_size = max(settings.AZURE_SERVER_COPY_BLOCK_MB * 1024 * 1024, block_size_for(size))
+    try:
+        if size:
+            sem = asyncio.Semaphore(max(1, settings.AZURE_SERVER_COPY_CONCURRENCY))
+            count = (size + block_size - 1) // block_size
+
+            async def copy_block(index: int):
+                start = index * block_size
+                length = min(size, start + block_size) - start
+                async with sem:
+                    await asyncio.to_thread(_stage_from_url, bc, block_id(index), source_url, start, length)
+                if on_progress:
+                    on_progress(length)
+
+            await _gather_or_cancel(copy_block(i) for i in range(count))
+            await asyncio.to_thread(_commit, bc, [block_id(i) for i in range(count)])
+        else:
+            await _copy_blob_and_wait(bc, source_url, on_progress)
+    except (HttpResponseError, SourceUnreachable) as e:
+        _unreachable[host_key(source_url)] = time.monotonic() + settings.AZURE_SERVER_COPY_RETRY_SECONDS
+        raise SourceUnreachable(str(e)) from e
+
+async def stream_copy_to_azure(source_url: str, blob_name: str, auth_header: str = None, chunk_size_mb: int = None,
+                               checkpoint=None, on_progress: Optional[Callable[[int], None]] = None,
+                               server_copy_url: Optional[str] = None):
+    """Copy source_url into blob_name. With server_copy_url (the source in a form Azure can fetch without our
+    headers, e.g. a token-in-URL link) and AZURE_SERVER_COPY set, Azure is asked to pull it first."""
     sas_url = make_write_sas(blob_name)
-    bc = BlobClient.from_blob_url(sas_url)
-    chunk_size = (chunk_size_mb or settings.AZURE_BLOB_BLOCK_SIZE_MB) * 1024 * 1024
+    bc = BlobClient.from_blob_url(sas_url, transport=azure_transport())
+    chunk_size = chunk_size_mb * 1024 * 1024 if chunk_size_mb else None  # else sized from the file
     headers = {}
     if auth_header:
         headers["Authorization"] = auth_header
-    with httpx.stream("GET", source_url, headers=headers, timeout=None) as r:
-        r.raise_for_status()
-        await asyncio.to_thread(
-            bc.upload_blob,
-            r.iter_bytes(),
-            overwrite=True,
-            max_concurrency=settings.AZURE_BLOB_UPLOAD_CONCURRENCY,
-            length=None,
-            chunk_size=chunk_size
-        )
+
+    counted = 0
+    def count(n: int):
+        nonlocal counted
+        counted += n
+        if on_progress:
+            on_progress(n)
+
+    def uncount():
+        nonlocal counted
+        if on_progress and counted:
+            on_progress(-counted)
+        counted = 0
+
+    client = get_client(source_url, download=True)
+    server_copy = bool(server_copy_url) and server_copy_allowed(server_copy_url)
+    size = None
+    if settings.AZURE_RANGED_COPY or server_copy:
+        size = await probe_range_support(client, source_url, headers)
+    if server_copy:
+        try:
+            await server_copy_to_azure(server_copy_url, bc, size, on_progress=count)
+            return sas_url
+        except SourceUnreachable:
+            uncount()  # Azure can't reach the source; stream through the worker instead
+    if settings.AZURE_RANGED_COPY and size and size >= settings.AZURE_RANGED_COPY_MIN_MB * 1024 * 1024:
+        try:
+            await ranged_copy_to_azure(client, source_url, bc, headers, size, chunk_size or block_size_for(size),
+                                       checkpoint=checkpoint, on_progress=count)
+            return sas_url
+        except RangesNotSupported:
+            # HEAD advertised ranges but GET ignored them; stream instead
+            uncount()
+
+    await staged_stream_copy(client, source_url, bc, headers, chunk_size, on_progress=on_progress)
     return sas_url
@@ -0,0 +1,112 @@
+import asyncio
+from collections import deque
+from typing import Dict, List, Optional
+from .config import settings
+
+MiB = 1024 * 1024
+MAX_BLOCKS = 50_000  # Azure's limit on blocks in one blob
+MAX_BLOCK = 4000 * MiB  # and on the size of one block
+TARGET_BLOCKS = 1000  # big files get bigger blocks, so fewer round trips per file
+
+def _pow2_mib(n: int) -> int:
+    # Sizes are powers of two MiB so pooled buffers are shared between files
+    size = MiB
+    while size < n:
+        size *= 2
+    return size
+
+def block_size_for(size: Optional[int]) -> int:
+    """Block size for a blob of `size` bytes (None if unknown): AZURE_BLOB_BLOCK_SIZE_MB, larger for multi-GB
+    files (up to AZURE_BLOB_MAX_BLOCK_MB), and always large enough to stay within 50,000 blocks."""
+    base = settings.AZURE_BLOB_BLOCK_SIZE_MB * MiB
+    if not size:
+        return base
+    block = min(max(base, _pow2_mib(-(-size // TARGET_BLOCKS))), max(base, settings.AZURE_BLOB_MAX_BLOCK_MB * MiB))
+    return min(MAX_BLOCK, max(block, _pow2_mib(-(-size // MAX_BLOCKS))))
+
+def single_put(size: Optional[int]) -> bool:
+    # Small files are uploaded with one Put Blob instead of stage + commit
+    return size is not None and 0 < size <= settings.AZURE_SINGLE_PUT_MB * MiB
+
+class UploadBuffers:
+    """Process-wide budget for upload buffers (AZURE_UPLOAD_MEMORY_MB), shared by every transfer on the loop,
+    plus a pool of the bytearrays themselves so blocks aren't allocated per chunk.
+
+    Reservations are granted in arrival order, so a big block isn't starved by a stream of small ones.
+    Idle pooled buffers count towards the budget and are dropped when live ones need the room.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.idle = 0
+        self.pool: Dict[int, List[bytearray]] = {}
+        self.waiters = deque()
+
+    async def reserve(self, n: int) -> int:
+        """Wait until n bytes (at most the whole budget) are free and take them; returns the amount taken."""
+        n = min(n, self.limit)
+        if not self.waiters and self.used + n <= self.limit:
+            self.used += n
+            return n
+        fut = asyncio.get_running_loop().create_future()
+        waiter = (n, fut)
+        self.waiters.append(waiter)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.unreserve(n)  # granted just as we were cancelled
+            else:
+                try:
+                    self.waiters.remove(waiter)
+                except ValueError:
+                    pass
+                self._wake()
+            raise
+        return n
+
+    def unreserve(self, n: int):
+        self.used -= n
+        self._wake()
+
+    def _wake(self):
+        while self.waiters and self.used + self.waiters[0][0] <= self.limit:
+            n, fut = self.waiters.popleft()
+            self.used += n
+            fut.set_result(None)
+
+    async def take(self, size: int) -> bytearray:
+        """A size-byte buffer counted against the budget; hand it back with give()."""
+        await self.reserve(size)
+        free = self.pool.get(size)
+        if free:
+            self.idle -= size
+            return free.pop()
+        while self.idle and self.used + self.idle > self.limit:
+            self._drop_one()
+        return bytearray(size)
+
+    def give(self, buf: bytearray):
+        size = len(buf)
+        self.unreserve(min(size, self.limit))
+        if self.used + self.idle + size <= self.limit:
+            self.pool.setdefault(size, []).append(buf)
+            self.idle += size
+
+    def _drop_one(self):
+        size, bufs = max(((s, b) for s, b in self.pool.items() if b), key=lambda sb: sb[0])
+        bufs.pop()
+        self.idle -= size
+
+_buffers: Optional[UploadBuffers] = None
+_buffers_loop: Optional[asyncio.AbstractEventLoop] = None
+
+def upload_buffers() -> UploadBuffers:
+    global _buffers, _buffers_loop
+    loop = asyncio.get_running_loop()
+    if loop is not _buffers_loop or _buffers is None:
+        # Waiters are futures of one loop; a new loop (RQ runs one per job) starts a fresh budget
+        _buffers = UploadBuffers(settings.AZURE_UPLOAD_MEMORY_MB * MiB)
+        _buffers_loop = loop
+    return _buffers
@@ -0,0 +1,32 @@
+import asyncio
+from typing import Dict, List, Tuple
+from fastapi import HTTPException
+from .config import settings
+from .models import Platform
+from .listing import get_course_files
+
+_issuer_limits: Dict[str, asyncio.Semaphore] = {}
+
+def issuer_limit(issuer: str) -> asyncio.Semaphore:
+    # Bounds how many course listings we fetch from one Moodle at once
+    return _issuer_limits.setdefault(issuer, asyncio.Semaphore(max(1, settings.MOODLE_MAX_CONCURRENCY_PER_ISSUER)))
+
+async def collect_course_files(platform: Platform, user_sub: str,
+                               course_ids: List[int]) -> Tuple[Dict[int, List[dict]], Dict[int, str]]:
+    """Fetch many course listings concurrently; return files per course and errors per course."""
+    sem = issuer_limit(platform.issuer)
+    listings, errors = {}, {}
+
+    async def fetch(course_id: int):
+        async with sem:
+            try:
+                _, files = await get_course_files(platform, user_sub, course_id)
+            except HTTPException as e:
+                errors[course_id] = str(e.detail)
+            except Exception as e:
+                errors[course_id] = str(e)
+            else:
+                listings[course_id] = files
+
+    await asyncio.gather(*(fetch(c) for c in dict.fromkeys(course_ids)))
+    return listings, errors
@@ -0,0 +1,61 @@
+from datetime import datetime
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import flag_modified
+from .models import TransferCheckpoint
+from .events import EventSink
+
+class BlockCheckpoint:
+    """Block-level progress of one file in one job, saved so a retried job can resume.
+
+    Changes are committed with the job's next EventSink batch rather than per block, so staging doesn't wait
+    on the DB; a resume re-checks the blob's uncommitted blocks anyway, so a lagging checkpoint costs at most
+    a few re-fetched blocks.
+    """
+
+    def __init__(self, db: Session, events: EventSink, job_id: int, fileurl: str, blob_name: str):
+        self.db = db
+        self.events = events
+        self.row = db.query(TransferCheckpoint).filter_by(job_id=job_id, fileurl=fileurl).first()
+        if not self.row:
+            # Only saved once a ranged copy begins; streamed files never write one
+            self.row = TransferCheckpoint(job_id=job_id, fileurl=fileurl, blob_name=blob_name,
+                                          size=0, block_size=0, offset=0, staged_blocks=[])
+        self.staged = set(self.row.staged_blocks or [])
+
+    def begin(self, size: int, block_size: int) -> set:
+        """Return block indexes staged by an earlier attempt with the same layout."""
+        r = self.row
+        if r.size != size or r.block_size != block_size:
+            # Source changed or block size changed: earlier blocks no longer line up
+            self.staged = set()
+            r.size = size; r.block_size = block_size
+        if r.id is None:
+            self.db.add(r)
+        self._save()
+        return set(self.staged)
+
+    def keep_only(self, indexes: set):
+        # Drop indexes Azure no longer holds (uncommitted blocks expire after a week)
+        self.staged &= indexes
+        self._save()
+
+    def mark(self, index: int):
+        self.staged.add(index)
+        self._save()
+
+    def clear(self):
+        if self.row in self.db.new:
+            self.db.expunge(self.row)
+        elif self.row.id is not None:
+            self.db.delete(self.row)
+            self.events.mark_dirty()
+
+    def _save(self):
+        r = self.row
+        r.staged_blocks = sorted(self.staged); flag_modified(r, "staged_blocks")
+        offset = 0
+        while offset in self.staged:
+            offset += 1
+        r.offset = min(offset * r.block_size, r.size)
+        r.updated_at = datetime.utcnow()
+        self.events.mark_dirty()
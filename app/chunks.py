@@ -0,0 +1,92 @@
+from datetime import datetime
+from typing import Iterable, Iterator, List, Tuple
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from .config import settings
+from .models import TransferJob, TransferFile
+from .transfer_files import DONE, iter_pending, counts
+
+FINAL = ("completed", "partial", "failed")
+
+def should_split(job: TransferJob, pending_files: int, pending_bytes: int) -> bool:
+    # An archive is one blob written in order, so it can't be shared out between workers
+    if job.parent_id is not None or job.mode == "archive" or settings.TRANSFER_CHUNK_FILES <= 0:
+        return False
+    return pending_files > settings.TRANSFER_CHUNK_FILES or pending_bytes > settings.TRANSFER_CHUNK_MB * 1024 * 1024
+
+def plan_chunks(pending: Iterable[dict]) -> Iterator[Tuple[int, int, int, int]]:
+    """Group pending files (in id order) into (first_id, last_id, files, bytes) runs within the chunk limits."""
+    max_bytes = settings.TRANSFER_CHUNK_MB * 1024 * 1024
+    first = last = n = size = 0
+    for f in pending:
+        if n and (n >= settings.TRANSFER_CHUNK_FILES or size + f["filesize"] > max_bytes):
+            yield first, last, n, size
+            n = size = 0
+        if not n:
+            first = f["id"]
+        last = f["id"]; n += 1; size += f["filesize"]
+    if n:
+        yield first, last, n, size
+
+def split_job(db: Session, job: TransferJob) -> List[TransferJob]:
+    """Create chunk jobs for the parent's pending files; the parent only aggregates. They are dispatched
+    when the parent's run hands back its slot (jobs.run_transfer)."""
+    children = []
+    for first, last, n, size in plan_chunks(iter_pending(db, job)):
+        child = TransferJob(
+            issuer=job.issuer, requester_sub=job.requester_sub, course_id=job.course_id,
+            source=job.source, destination=job.destination, mode=job.mode, parent_id=job.id,
+            files_total=n, bytes_total=size, status="queued", priority=job.priority,
+        )
+        db.add(child); db.flush()
+        # Pending files are contiguous runs of ids, so one range update hands a run to its chunk
+        db.execute(update(TransferFile)
+                   .where(TransferFile.job_id == job.id, TransferFile.id.between(first, last),
+                          TransferFile.status.not_in(DONE))
+                   .values(chunk_id=child.id, status="pending", error=None))
+        children.append(child)
+    job.updated_at = datetime.utcnow()
+    db.commit()
+    return children
+
+def requeue_failed_chunks(db: Session, job: TransferJob) -> int:
+    children = db.query(TransferJob).filter(TransferJob.parent_id == job.id,
+                                            TransferJob.status.in_(("failed", "partial"))).all()
+    for child in children:
+        child.status = "queued"
+    job.status = "running"; job.updated_at = datetime.utcnow()
+    db.commit()
+    return len(children)
+
+def _unchunked_completed():
+    # Files the parent itself copied before it was split
+    return select(func.coalesce(func.sum(TransferFile.filesize), 0)).where(
+        TransferFile.chunk_id.is_(None), TransferFile.status == "completed")
+
+async def chunk_summary(db: AsyncSession, job: TransferJob):
+    """Live chunk counts by status and bytes sent for a parent job, or None if it was never split."""
+    rows = (await db.execute(select(TransferJob.status, func.count(), func.sum(TransferJob.bytes_sent))
+                             .filter(TransferJob.parent_id == job.id).group_by(TransferJob.status))).all()
+    if not rows:
+        return None
+    base = await db.scalar(_unchunked_completed().where(TransferFile.job_id == job.id))
+    return {"chunks": {status: count for status, count, _ in rows},
+            "bytes_sent": int(base) + sum(int(sent or 0) for _, _, sent in rows)}
+
+def aggregate_parent(db: Session, parent_id: int) -> TransferJob:
+    """Roll chunk bytes and statuses up into the parent; finish it once every chunk has."""
+    # Row lock so two chunks finishing together don't both miss each other's result
+    parent = db.query(TransferJob).filter_by(id=parent_id).with_for_update().one()
+    children = db.query(TransferJob).filter_by(parent_id=parent_id).all()
+    base = db.scalar(_unchunked_completed().where(TransferFile.job_id == parent_id))
+    parent.bytes_sent = int(base) + sum(c.bytes_sent or 0 for c in children)
+    parent.updated_at = datetime.utcnow()
+    if children and all(c.status in FINAL for c in children):
+        # Chunks write their outcomes straight onto the parent's file rows
+        by_status = counts(db, parent)
+        failed = by_status.get("failed", (0, 0))[0]
+        total = sum(n for n, _ in by_status.values())
+        parent.status = "completed" if not failed else ("failed" if failed == total else "partial")
+    db.commit()
+    return parent
@@ -5,6 +5,12 @@ class Settings(BaseSettings):
     # LTI (tool key only used if you later expose your JWKS; PoC validates platform tokens)
     LTI_TOOL_PRIVATE_KEY_JWK: str
     LTI_TOOL_KID: str = "tool-key-1"
+    # Platform JWKS cache: Cache-Control max-age is honoured within these bounds (seconds)
+    LTI_JWKS_DEFAULT_TTL: int = 3600
+    LTI_JWKS_MIN_TTL: int = 60
+    LTI_JWKS_MAX_TTL: int = 86400
+    LTI_JWKS_MIN_REFRESH_SECONDS: int = 10  # floor between kid-miss refetches
+    LTI_JWKS_CACHE_SIZE: int = 256  # issuers whose keys are kept per process
 
     # Session
     SESSION_SECRET: str = "change-me"
@@ -13,8 +19,92 @@ class Settings(BaseSettings):
     AZURE_STORAGE_ACCOUNT: str
     AZURE_STORAGE_KEY: str
     AZURE_BLOB_CONTAINER: str
+    AZURE_BLOB_ENDPOINT: Optional[str] = None  # e.g. an emulator; defaults to https://<account>.blob.core.windows.net
     AZURE_BLOB_UPLOAD_CONCURRENCY: int = 4
-    AZURE_BLOB_BLOCK_SIZE_MB: int = 8
+    AZURE_BLOB_BLOCK_SIZE_MB: int = 8  # smallest block; multi-GB files get bigger ones
+    AZURE_BLOB_MAX_BLOCK_MB: int = 64
+    AZURE_SINGLE_PUT_MB: int = 4  # files up to this size are uploaded with one Put Blob
+    AZURE_UPLOAD_MEMORY_MB: int = 128  # upload buffers held at once by all transfers in one process
+    AZURE_RANGED_COPY: bool = True  # fetch large files as parallel byte ranges staged as blocks
+    AZURE_RANGED_COPY_MIN_MB: int = 16
+    # Server-side copy: Azure pulls token-in-URL Moodle downloads itself (Put Block From URL / Copy Blob).
+    # Off by default since the Moodle token then travels in a URL to Azure.
+    AZURE_SERVER_COPY: bool = False
+    AZURE_SERVER_COPY_BLOCK_MB: int = 100  # Put Block From URL range size
+    AZURE_SERVER_COPY_CONCURRENCY: int = 8  # ranges per file copied at once
+    AZURE_SERVER_COPY_POLL_SECONDS: float = 2  # Copy Blob status polling
+    AZURE_SERVER_COPY_RETRY_SECONDS: int = 600  # after Azure fails to reach a host, stream from it for this long
+
+    # Moodle OAuth tokens (seconds)
+    TOKEN_CACHE_TTL: int = 60  # how long a process trusts its cached copy of a token
+    TOKEN_REFRESH_AHEAD: int = 300  # refresh this long before expiry so long jobs don't run out
+    TOKEN_REFRESH_LOCK_SECONDS: int = 30
+
+    MOODLE_MAX_CONCURRENCY_PER_ISSUER: int = 4  # parallel Web Service calls for bulk listing
+
+    # Per-Moodle traffic controller (Web Service calls and file downloads), shared via Redis
+    MOODLE_RATE_PER_SEC: float = 20
+    MOODLE_RATE_BURST: int = 40
+    MOODLE_CONCURRENCY_START: int = 4
+    MOODLE_CONCURRENCY_MIN: int = 1
+    MOODLE_CONCURRENCY_MAX: int = 32
+    MOODLE_LATENCY_TOLERANCE: float = 2.0  # back off when latency exceeds this multiple of the best seen
+    MOODLE_LATENCY_FLOOR: float = 0.5  # ...and is above this many seconds
+    MOODLE_DECREASE_COOLDOWN: float = 2.0
+    MOODLE_LIMIT_SYNC_SECONDS: float = 2.0
+    MOODLE_MAX_RETRIES: int = 4
+    MOODLE_BACKOFF_BASE: float = 0.5
+    MOODLE_BACKOFF_MAX: float = 30
+
+    # Course file listings are cached per (issuer, course) in Redis, or in-process without it
+    COURSE_FILES_CACHE_TTL: int = 300
+    PLATFORM_CACHE_TTL: int = 300  # per-process platform config cache; writes invalidate it via Redis
+
+    # Outbound HTTP (pooled per host; timeouts in seconds)
+    HTTP_CONNECT_TIMEOUT: float = 10
+    HTTP_READ_TIMEOUT: float = 60
+    HTTP_WRITE_TIMEOUT: float = 60
+    HTTP_POOL_TIMEOUT: float = 30
+    HTTP_MAX_CONNECTIONS_PER_HOST: int = 20
+    HTTP_KEEPALIVE_EXPIRY: float = 30
+
+    # Transfers
+    TRANSFER_FILE_CONCURRENCY: int = 4  # files copied in parallel within one job
+    TRANSFER_JOB_TIMEOUT: int = 6 * 3600  # RQ job timeout (RQ's own default is 180s)
+    # Jobs bigger than this are split into chunk jobs that any worker can pick up (0 disables)
+    TRANSFER_CHUNK_FILES: int = 200
+    TRANSFER_CHUNK_MB: int = 5 * 1024
+    # Archive mode: files up to this size are downloaded ahead of the archive writer, bigger ones streamed in turn
+    ARCHIVE_INLINE_MB: int = 8
+    # A running job touches updated_at this often; one silent for TRANSFER_STALE_SECONDS lost its worker
+    # and is queued again to resume from its checkpoints, at most TRANSFER_MAX_RESUMES times
+    TRANSFER_HEARTBEAT_SECONDS: int = 60
+    TRANSFER_STALE_SECONDS: int = 300
+    TRANSFER_MAX_RESUMES: int = 3
+
+    # Scheduling: jobs wait in the DB and are handed to RQ fairly (priority class, then issuer, then requester)
+    SCHED_MAX_ACTIVE_JOBS: int = 16  # jobs on the RQ queue or running at once, all issuers; 0 = no limit
+    SCHED_ISSUER_MAX_ACTIVE_MB: int = 20 * 1024  # remaining bytes of one issuer's active jobs; 0 = no limit
+    SCHED_INTERACTIVE_MB: int = 1024  # bigger jobs (and whole-course syncs) are scheduled as bulk
+    SCHED_INTERACTIVE_WEIGHT: int = 4  # interactive jobs get this many bytes per bulk byte while both wait
+    SCHED_RATE_WINDOW: int = 900  # seconds of completed files used for estimated start times
+
+    # Transfer events and per-file job updates are written in batches
+    EVENT_FLUSH_ROWS: int = 100
+    EVENT_FLUSH_SECONDS: float = 5
+
+    # Worker: "rq" forks per job; "async" runs up to WORKER_JOB_CONCURRENCY jobs in one process
+    WORKER_MODE: str = "rq"
+    WORKER_JOB_CONCURRENCY: int = 8
+    WORKER_DEQUEUE_TIMEOUT: int = 5
+    WORKER_DRAIN_TIMEOUT: float = 25  # seconds to let jobs finish after SIGTERM
+    WORKER_METRICS_PORT: int = 9100  # Prometheus /metrics on the worker; 0 disables
+
+    # Live progress (seconds)
+    PROGRESS_REDIS_INTERVAL: float = 0.5
+    PROGRESS_DB_INTERVAL: float = 10
+    PROGRESS_PUSH_INTERVAL: float = 1
+    PROGRESS_TTL: int = 86400
 
     # Infra
     DATABASE_URL: Optional[str] = None
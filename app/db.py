@@ -5,7 +5,11 @@ from .models import Base
 
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session
 from .config import settings
+from .metrics import instrument_sessions
 import sys
 
 def get_engine():
@@ -35,6 +39,49 @@ def get_engine():
 
 engine = get_engine()
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+instrument_sessions(SessionLocal)
 
 def init_db():
-    Base.metadata.create_all(bind=engine)
+    # Creates missing tables and upgrades ones made by earlier versions (see schema.upgrade)
+    from .schema import upgrade
+    with engine.begin() as conn:
+        upgrade(conn)
+
+# Async engine for request handlers (and the token provider), so queries don't block the event loop.
+# The worker keeps the sync SessionLocal for job state.
+_ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "postgres": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
+
+def async_database_url(url):
+    # Takes the URL object, not str(url), which masks the password
+    u = make_url(url)
+    backend = u.get_backend_name()
+    if backend not in _ASYNC_DRIVERS:
+        print(f"[WARN] No async driver configured for {backend}; using '{u.drivername}' as given", file=sys.stderr)
+        return u
+    u = u.set(drivername=_ASYNC_DRIVERS[backend])
+    if "sslmode" in u.query and u.drivername.startswith("postgresql"):
+        # asyncpg spells libpq's sslmode as ssl (same values)
+        u = u.update_query_dict({"ssl": u.query["sslmode"]}).difference_update_query(["sslmode"])
+    return u
+
+class AsyncSyncSession(Session):
+    """Session class behind AsyncSessionLocal, separate so its commits can be instrumented."""
+
+instrument_sessions(AsyncSyncSession)
+
+
+def get_async_engine():
+    try:
+        return create_async_engine(async_database_url(engine.url), pool_pre_ping=True)
+    except Exception as e:
+        print(f"[WARN] No async engine for DATABASE_URL: {e}", file=sys.stderr)
+        print("[WARN] Falling back to sqlite+aiosqlite:///./app.db", file=sys.stderr)
+        return create_async_engine("sqlite+aiosqlite:///./app.db", pool_pre_ping=True)
+
+async_engine = get_async_engine()
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, class_=AsyncSession, sync_session_class=AsyncSyncSession,
+                                       autoflush=False, expire_on_commit=False)
+
+async def close_async_engine():
+    # asyncpg connections belong to the loop that opened them; call before that loop ends
+    await async_engine.dispose()
@@ -0,0 +1,74 @@
+import asyncio, time
+from datetime import datetime
+from typing import List, Optional
+from sqlalchemy import insert, update
+from sqlalchemy.orm import Session
+from .config import settings
+from .models import TransferEvent, TransferJob
+from .transfer_files import UPDATE_FILE
+
+class EventSink:
+    """Buffers TransferEvent rows, per-file outcomes and pending job changes; writes them in one transaction.
+
+    Flushes when EVENT_FLUSH_ROWS events are waiting, when EVENT_FLUSH_SECONDS have passed,
+    on ERROR events, and when the caller flushes at the end of the job.
+    """
+
+    def __init__(self, db: Session, job_id: int):
+        self.db = db
+        self.job_id = job_id
+        self.rows: List[dict] = []
+        self.files: List[dict] = []
+        self.dirty = False
+        self.flushed_at = time.monotonic()
+
+    def log(self, level: str, message: str, data=None):
+        self.rows.append({"job_id": self.job_id, "ts": datetime.utcnow(), "level": level,
+                          "message": message, "data": data or {}})
+        if level == "ERROR":
+            self.flush()
+        else:
+            self.maybe_flush()
+
+    def file_done(self, file_id: int, status: str, bytes_done: int, blob_name: str, error: Optional[str] = None):
+        self.files.append({"b_id": file_id, "b_status": status, "b_bytes": bytes_done, "b_blob": blob_name,
+                           "b_error": error, "b_at": datetime.utcnow()})
+        self.dirty = True
+        self.maybe_flush()
+
+    def mark_dirty(self):
+        # The caller changed ORM objects on self.db; they are committed with the next flush
+        self.dirty = True
+        self.maybe_flush()
+
+    def maybe_flush(self):
+        if (len(self.rows) >= settings.EVENT_FLUSH_ROWS
+                or time.monotonic() - self.flushed_at >= settings.EVENT_FLUSH_SECONDS):
+            self.flush()
+
+    def flush(self):
+        self.flushed_at = time.monotonic()
+        if not self.rows and not self.dirty:
+            return
+        rows, self.rows = self.rows, []
+        files, self.files = self.files, []
+        if rows:
+            self.db.execute(insert(TransferEvent), rows)
+        if files:
+            self.db.execute(UPDATE_FILE, files)
+        self.dirty = False
+        self.db.commit()
+
+    async def run(self):
+        # Time-based flushes while nothing else is happening (e.g. one long upload), and the job's heartbeat:
+        # a running job whose updated_at goes stale is taken to have lost its worker (scheduler.recover_lost)
+        beat = time.monotonic()
+        while True:
+            await asyncio.sleep(settings.EVENT_FLUSH_SECONDS)
+            if time.monotonic() - beat >= settings.TRANSFER_HEARTBEAT_SECONDS:
+                beat = time.monotonic()
+                self.db.execute(update(TransferJob).where(TransferJob.id == self.job_id)
+                                .values(updated_at=datetime.utcnow()))
+                self.dirty = True
+            if self.rows or self.dirty:
+                self.flush()
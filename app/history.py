@@ -0,0 +1,67 @@
+import base64, json
+from datetime import datetime
+from typing import List, Optional, Tuple
+from fastapi import HTTPException
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from .models import TransferJob, TransferFile
+from .transfer_files import of_job
+
+# Keyset pagination: the cursor is the sort key of the last row returned, so deep pages cost the same as
+# the first and rows inserted meanwhile don't shift the pages.
+
+def encode_key(*key) -> str:
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+def decode_key(cursor: str) -> list:
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def job_summary(job: TransferJob) -> dict:
+    return {"id": job.id, "course_id": job.course_id, "mode": job.mode, "status": job.status,
+            "priority": job.priority, "files_total": job.files_total, "bytes_total": job.bytes_total,
+            "bytes_sent": job.bytes_sent, "created_at": job.created_at.isoformat(),
+            "updated_at": job.updated_at.isoformat()}
+
+def file_detail(f: TransferFile) -> dict:
+    return {"id": f.id, "filename": f.filename, "fileurl": f.fileurl, "filesize": f.filesize, "status": f.status,
+            "bytes_done": f.bytes_done, "attempts": f.attempts, "blob_name": f.blob_name or None, "error": f.error,
+            "chunk_id": f.chunk_id, "updated_at": f.updated_at.isoformat() if f.updated_at else None}
+
+async def file_counts(db: AsyncSession, job: TransferJob) -> dict:
+    rows = (await db.execute(select(TransferFile.status, func.count()).where(of_job(job))
+                             .group_by(TransferFile.status))).all()
+    return {status: n for status, n in rows}
+
+async def job_page(db: AsyncSession, issuer: str, cursor: Optional[str], limit: int,
+                   status: Optional[str] = None, requester_sub: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+    """Newest-first top-level jobs of an issuer (chunk jobs are reported through their parent)."""
+    q = select(TransferJob).where(TransferJob.issuer == issuer, TransferJob.parent_id.is_(None))
+    if status:
+        q = q.where(TransferJob.status == status)
+    if requester_sub:
+        q = q.where(TransferJob.requester_sub == requester_sub)
+    if cursor:
+        ts, last_id = decode_key(cursor)
+        ts = datetime.fromisoformat(ts)
+        q = q.where(or_(TransferJob.created_at < ts, and_(TransferJob.created_at == ts, TransferJob.id < last_id)))
+    jobs = list(await db.scalars(q.order_by(TransferJob.created_at.desc(), TransferJob.id.desc()).limit(limit + 1)))
+    more = len(jobs) > limit
+    jobs = jobs[:limit]
+    next_cursor = encode_key(jobs[-1].created_at.isoformat(), jobs[-1].id) if more else None
+    return [job_summary(j) for j in jobs], next_cursor
+
+async def file_page(db: AsyncSession, job: TransferJob, cursor: Optional[str], limit: int,
+                    status: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+    q = select(TransferFile).where(of_job(job))
+    if status:
+        q = q.where(TransferFile.status == status)
+    if cursor:
+        (last_id,) = decode_key(cursor)
+        q = q.where(TransferFile.id > last_id)
+    files = list(await db.scalars(q.order_by(TransferFile.id).limit(limit + 1)))
+    more = len(files) > limit
+    files = files[:limit]
+    return [file_detail(f) for f in files], (encode_key(files[-1].id) if more else None)
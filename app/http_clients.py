@@ -0,0 +1,73 @@
+import asyncio
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+import httpx, requests
+from azure.core.pipeline.transport import RequestsTransport
+from .config import settings
+
+try:
+    import h2  # noqa: F401  (httpx only negotiates HTTP/2 when h2 is installed)
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+# One pooled client per scheme://host for Moodle WS, OAuth and JWKS calls (HTTP/2 when offered), and a
+# separate HTTP/1.1 one per host for file downloads: over h2 every parallel range and file would share one
+# TCP connection, which is what parallel ranges are there to get past
+_clients: Dict[str, httpx.AsyncClient] = {}
+_clients_loop: Optional[asyncio.AbstractEventLoop] = None
+_azure_session: Optional[requests.Session] = None
+
+def default_timeout() -> httpx.Timeout:
+    return httpx.Timeout(
+        connect=settings.HTTP_CONNECT_TIMEOUT,
+        read=settings.HTTP_READ_TIMEOUT,
+        write=settings.HTTP_WRITE_TIMEOUT,
+        pool=settings.HTTP_POOL_TIMEOUT,
+    )
+
+def get_client(url: str, download: bool = False) -> httpx.AsyncClient:
+    """Return the keep-alive client for url's host, creating it on first use. download=True gives the
+    HTTP/1.1 pool used for file bodies."""
+    global _clients_loop
+    loop = asyncio.get_running_loop()
+    if loop is not _clients_loop:
+        # Async clients are bound to the loop that created them
+        _clients.clear()
+        _clients_loop = loop
+    parts = urlsplit(url)
+    key = f"{'download:' if download else ''}{parts.scheme}://{parts.netloc}"
+    client = _clients.get(key)
+    if client is None or client.is_closed:
+        client = _clients[key] = httpx.AsyncClient(
+            http2=HTTP2 and not download,
+            timeout=default_timeout(),
+            limits=httpx.Limits(
+                max_connections=settings.HTTP_MAX_CONNECTIONS_PER_HOST,
+                max_keepalive_connections=settings.HTTP_MAX_CONNECTIONS_PER_HOST,
+                keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY,
+            ),
+        )
+    return client
+
+def azure_transport() -> RequestsTransport:
+    """Shared keep-alive transport for the (synchronous) Azure Blob SDK clients."""
+    global _azure_session
+    if _azure_session is None:
+        _azure_session = requests.Session()
+        size = settings.HTTP_MAX_CONNECTIONS_PER_HOST
+        adapter = requests.adapters.HTTPAdapter(pool_connections=size, pool_maxsize=size)
+        _azure_session.mount("https://", adapter)
+        _azure_session.mount("http://", adapter)
+    return RequestsTransport(session=_azure_session, session_owner=False)
+
+async def close_clients():
+    global _clients_loop, _azure_session
+    clients = list(_clients.values())
+    _clients.clear()
+    _clients_loop = None
+    for c in clients:
+        await c.aclose()
+    if _azure_session is not None:
+        _azure_session.close()
+        _azure_session = None
@@ -1,50 +1,263 @@
-import asyncio, os
+import asyncio, time
 from datetime import datetime
-from redis import Redis
-from rq import Queue
+from rq import get_current_job
 from sqlalchemy.orm import Session
-from .db import SessionLocal
-from .models import TransferJob, TransferEvent, Platform
+from fastapi import HTTPException
+from sqlalchemy import insert
+from .config import settings
+from .models import TransferJob, TransferEvent, TransferFile, Platform
 from .azure_dest import stream_copy_to_azure
-from .moodle import get_signed_download_url
+from .archive import ArchiveJob, WRITERS
+from .checkpoints import BlockCheckpoint
+from .events import EventSink
+from .chunks import FINAL, should_split, split_job, requeue_failed_chunks, aggregate_parent
+from .progress import ProgressTracker, publish_status, publish_split
+from .http_clients import close_clients
+from .db import SessionLocal, close_async_engine
+from .scheduler import finished
+from .metrics import QUEUE_WAIT, JOBS_ACTIVE, JOB_SECONDS, FILES, FILE_SECONDS, FILE_THROUGHPUT, span
+from .tokens import get_access_token
+from .moodle import get_signed_download_url, get_tokenized_download_url, list_course_files
+from .sync import load_manifest, is_unchanged, record_synced, pop_deleted
+from .transfer_files import DONE, file_rows, iter_pending, counts, mark_skipped, failed_names
+
+def file_entry(f: dict) -> dict:
+    return {"filename": f["filename"], "fileurl": f["fileurl"], "filesize": f.get("filesize") or 0,
+            "timemodified": f.get("timemodified")}
+
+def blob_name_for(job: TransferJob, f: dict) -> str:
+    return f"{job.requester_sub}/{job.course_id}/{f['filename']}"
+
+def archive_name_for(job: TransferJob) -> str:
+    ext = WRITERS[job.archive_format or "zip"].ext
+    return f"{job.requester_sub}/{job.course_id}/course-{job.course_id}-{job.id}.{ext}"
 
 def log_event(db: Session, job_id: int, level: str, message: str, data=None):
     evt = TransferEvent(job_id=job_id, level=level, message=message, data=data or {})
     db.add(evt); db.commit()
 
+def observe_queue_wait(rq_job):
+    if rq_job is not None and rq_job.enqueued_at:
+        QUEUE_WAIT.observe(max(0.0, (datetime.utcnow() - rq_job.enqueued_at.replace(tzinfo=None)).total_seconds()))
+
 def perform_transfer(job_id: int):
+    # RQ entrypoint: the whole job runs inside a single event loop
+    observe_queue_wait(get_current_job())
+    async def _run():
+        try:
+            await run_transfer(job_id)
+        finally:
+            await close_clients()
+            await close_async_engine()
+    asyncio.run(_run())
+
+async def run_transfer(job_id: int):
+    drained = False
+    try:
+        with span("transfer.job", job_id=job_id), JOBS_ACTIVE.track_inprogress():
+            await _run_transfer(job_id)
+    except asyncio.CancelledError:
+        drained = True  # the worker puts it back on the queue, still holding its slot
+        raise
+    finally:
+        # Also after a crash or RQ timeout. This dispatches chunk jobs a split or retry just queued too,
+        # off the loop (dispatch blocks)
+        if not drained:
+            try:
+                await asyncio.to_thread(finished, job_id)
+            except Exception as e:
+                print(f"[WARN] job {job_id}: could not hand its slot to the scheduler: {e}")
+
+async def _run_transfer(job_id: int):
+    started = time.monotonic()
     db = SessionLocal()
     job = db.get(TransferJob, job_id)
     if not job:
+        db.close()
         return
+    events = EventSink(db, job.id)
+    flusher = asyncio.ensure_future(events.run())
     try:
         job.status = "running"; job.updated_at = datetime.utcnow(); db.commit()
-        total = sum((f.get("filesize") or 0) for f in job.files)
-        job.bytes_total = total; db.commit()
-
+        if db.query(TransferJob.id).filter_by(parent_id=job.id).first():
+            # Retry of a split job: re-run only its failed chunks
+            n = requeue_failed_chunks(db, job)
+            events.log("INFO", f"Re-queued {n} failed chunks")
+            publish_status(job)
+            return
         platform = db.query(Platform).filter_by(issuer=job.issuer).first()
-        auth_header = None
-        # In OAuth bearer mode, downloads require the Authorization header.
-        from .platforms import get_user_token
-        ut = get_user_token(db, job.issuer, job.requester_sub)
-        if ut:
-            auth_header = f"Bearer {ut.access_token}"
-
-        sent = 0
-        for f in job.files:
-            fname = f["filename"]
-            url = f["fileurl"]
-            signed = asyncio.run(get_signed_download_url(db, platform, job.requester_sub, url))
-            blob_name = f"{job.requester_sub}/{job.course_id}/{fname}"
-            log_event(db, job.id, "INFO", f"Uploading {fname}")
-            asyncio.run(stream_copy_to_azure(signed, blob_name, auth_header=auth_header))
-            sent += f.get("filesize") or 0
-            job.bytes_sent = sent; job.updated_at = datetime.utcnow(); db.commit()
-
-        job.status = "completed"; job.updated_at = datetime.utcnow(); db.commit()
-        log_event(db, job.id, "INFO", "Transfer complete")
+
+        manifest = None
+        if job.mode == "sync":
+            manifest = load_manifest(db, job.issuer, job.course_id)
+            if not job.files_total:
+                # Whole-course sync: list at run time so deletions can be detected too
+                listing = [file_entry(f) for f in
+                           await list_course_files(platform, job.requester_sub, int(job.course_id))]
+                rows = file_rows(job.id, listing)
+                if rows:
+                    db.execute(insert(TransferFile), rows)
+                job.files_total = len(rows)
+                deleted = pop_deleted(db, manifest, listing)
+                if deleted:
+                    events.log("WARN", f"{len(deleted)} previously synced files are no longer in the course",
+                               {"deleted": deleted})
+            unchanged = [f["id"] for f in iter_pending(db, job)
+                         if is_unchanged(manifest.get(f["fileurl"]), f, blob_name_for(job, f))]
+            mark_skipped(db, unchanged)
+
+        by_status = counts(db, job)
+        if manifest is not None:
+            skipped = by_status.get("skipped", (0, 0))[0]
+            events.log("INFO", f"Sync: {job.files_total - skipped} new or changed, {skipped} unchanged")
+        job.bytes_total = sum(size for status, (_, size) in by_status.items() if status != "skipped")
+        events.flush()
+
+        async def auth_header():
+            # In OAuth bearer mode, downloads require the Authorization header.
+            # Fetched per file so a long job picks up refreshed tokens.
+            try:
+                return f"Bearer {await get_access_token(platform, job.requester_sub)}"
+            except HTTPException:
+                return None
+
+        # Files already copied by an earlier run of this job are not sent again; an archive is rewritten whole
+        sent = by_status.get("completed", (0, 0))[1] if job.mode != "archive" else 0
+        pending = [v for status, v in by_status.items() if status not in DONE]
+        if should_split(job, sum(n for n, _ in pending), sum(size for _, size in pending)):
+            children = split_job(db, job)
+            events.log("INFO", f"Split into {len(children)} chunk jobs", {"chunks": [c.id for c in children]})
+            publish_split(job, sent)
+            return
+        progress = ProgressTracker(events, job, initial=sent)
+        await progress.finish()
+        issuer = job.issuer  # job is re-read after every commit otherwise
+
+        if job.mode == "archive":
+            archive_name = archive_name_for(job)
+
+            async def source_url(f: dict) -> str:
+                return await get_signed_download_url(platform, job.requester_sub, f["fileurl"])
+
+            outcomes = []
+
+            def on_file(f: dict, entry, error):
+                if error:
+                    events.log("ERROR", f"Download failed for {f['filename']}, left out of the archive: {error}")
+                outcomes.append((f["id"], entry["size"] if entry else 0, error))
+                job.bytes_sent = progress.bytes; job.updated_at = datetime.utcnow()
+
+            events.log("INFO", f"Writing {job.files_total} files to {archive_name}")
+            with span("transfer.archive", job_id=job_id, format=job.archive_format):
+                writer = ArchiveJob(archive_name, job.archive_format or "zip", source_url, auth_header, on_file,
+                                    on_progress=progress.add, size_hint=job.bytes_total)
+                await writer.run(iter_pending(db, job, done=True))
+            # Only now is the archive committed, so only now are its files really transferred
+            for file_id, size, error in outcomes:
+                FILES.labels(issuer, "failed" if error else "completed").inc()
+                events.file_done(file_id, "failed" if error else "completed", size, archive_name, error)
+        else:
+            async def copy_file(f: dict):
+                fname = f["filename"]
+                blob_name = blob_name_for(job, f)
+                copied = 0
+                def on_progress(n: int):
+                    nonlocal copied
+                    copied += n
+                    progress.add(n)
+                file_started = time.monotonic()
+                with span("transfer.file", job_id=job_id, filename=fname, size=f["filesize"]):
+                    try:
+                        signed = await get_signed_download_url(platform, job.requester_sub, f["fileurl"])
+                        checkpoint = BlockCheckpoint(db, events, job_id, f["fileurl"], blob_name)
+                        if checkpoint.staged:
+                            events.log("INFO", f"Resuming {fname} at byte {checkpoint.row.offset}",
+                                       {"staged_blocks": len(checkpoint.staged)})
+                        else:
+                            events.log("INFO", f"Uploading {fname}")
+                        server_url = None
+                        if settings.AZURE_SERVER_COPY:
+                            server_url = await get_tokenized_download_url(platform, job.requester_sub, f["fileurl"])
+                        await stream_copy_to_azure(signed, blob_name, auth_header=await auth_header(),
+                                                  checkpoint=checkpoint, on_progress=on_progress,
+                                                  server_copy_url=server_url)
+                        checkpoint.clear()
+                        if manifest is not None:
+                            record_synced(db, manifest, job.issuer, job.course_id, f, blob_name, commit=False)
+                    except Exception as e:
+                        progress.add(-copied)  # a failed file's bytes will be sent again on retry
+                        events.log("ERROR", f"Upload failed for {fname}: {e}")
+                        FILES.labels(issuer, "failed").inc()
+                        outcome = ("failed", 0, str(e))
+                    else:
+                        elapsed = time.monotonic() - file_started
+                        FILES.labels(issuer, "completed").inc()
+                        FILE_SECONDS.observe(elapsed)
+                        if elapsed > 0:
+                            FILE_THROUGHPUT.observe(copied / elapsed)
+                        outcome = ("completed", f["filesize"], None)
+                # Per-file outcome and summed progress; committed with the next batch of events
+                job.bytes_sent = progress.bytes; job.updated_at = datetime.utcnow()
+                events.file_done(f["id"], outcome[0], outcome[1], blob_name, outcome[2])
+
+            # A bounded queue between the DB cursor and the copiers keeps memory flat however many files there are
+            todo: asyncio.Queue = asyncio.Queue(maxsize=2 * max(1, settings.TRANSFER_FILE_CONCURRENCY))
+
+            async def copier():
+                while (f := await todo.get()) is not None:
+                    await copy_file(f)
+
+            workers = max(1, settings.TRANSFER_FILE_CONCURRENCY)
+
+            async def feed():
+                for f in iter_pending(db, job):
+                    await todo.put(f)
+                for _ in range(workers):
+                    await todo.put(None)
+
+            tasks = [asyncio.ensure_future(feed())] + [asyncio.ensure_future(copier()) for _ in range(workers)]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for t in tasks:
+                    t.cancel()
+        events.flush()
+
+        by_status = counts(db, job)
+        failed = by_status.get("failed", (0, 0))[0]
+        total = sum(n for n, _ in by_status.values())
+        if not failed:
+            job.status = "completed"
+        elif failed == total:
+            job.status = "failed"
+        else:
+            job.status = "partial"
+        if failed:
+            events.log("WARN", f"Transfer finished with {failed} of {total} files failed",
+                       {"failed": failed_names(db, job)})
+        else:
+            events.log("INFO", "Transfer complete")
+        await progress.finish()
+        events.flush()
     except Exception as e:
-        job.status = "failed"; job.updated_at = datetime.utcnow(); db.commit()
-        log_event(db, job.id, "ERROR", f"Transfer failed: {e}")
+        try:
+            events.flush()  # keep the per-file outcomes gathered so far
+        except Exception:
+            db.rollback(); events.rows = []; events.files = []
+        job.status = "failed"; job.updated_at = datetime.utcnow()
+        events.log("ERROR", f"Transfer failed: {e}")
+        publish_status(job)
     finally:
+        JOB_SECONDS.labels(job.status).observe(time.monotonic() - started)
+        flusher.cancel()
+        try:
+            events.flush()
+        except Exception:
+            db.rollback()
+        if job.parent_id and job.status in FINAL:
+            try:
+                publish_status(aggregate_parent(db, job.parent_id))
+            except Exception as e:
+                db.rollback()
+                log_event(db, job.parent_id, "ERROR", f"Chunk {job.id} could not update its parent: {e}")
         db.close()
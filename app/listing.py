@@ -0,0 +1,128 @@
+import asyncio, base64, json, re, time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+from fastapi import HTTPException
+from .config import settings
+from .models import Platform
+from .moodle import list_course_files
+from .redis_conn import get_redis
+
+# In-process fallback when Redis is not configured: key -> (expires_at, version, files), oldest first
+_local: Dict[str, Tuple[float, float, List[dict]]] = {}
+# Fetches in progress: key -> [lock, callers holding or waiting for it]; dropped when the last one leaves
+_locks: Dict[str, list] = {}
+
+def _prefix(issuer: str, course_id: int) -> str:
+    return f"course-files:{issuer}:{course_id}:"
+
+def _key(issuer: str, course_id: int, user_sub: str) -> str:
+    # Per user: a hit skips Moodle, so it must only return what that user's own token could list
+    return _prefix(issuer, course_id) + user_sub
+
+def _load(key: str) -> Optional[Tuple[float, List[dict]]]:
+    redis = get_redis()
+    if redis is not None:
+        raw = redis.get(key)
+        if raw:
+            data = json.loads(raw)
+            return data["version"], data["files"]
+        return None
+    hit = _local.get(key)
+    if hit and hit[0] > time.time():
+        return hit[1], hit[2]
+    return None
+
+def _store(key: str, version: float, files: List[dict]):
+    redis = get_redis()
+    if redis is not None:
+        redis.set(key, json.dumps({"version": version, "files": files}), ex=settings.COURSE_FILES_CACHE_TTL)
+    else:
+        now = time.time()
+        # Re-inserted at the end: with one TTL for every entry, insertion order is expiry order
+        _local.pop(key, None)
+        _local[key] = (now + settings.COURSE_FILES_CACHE_TTL, version, files)
+        while _local:
+            oldest = next(iter(_local))
+            if _local[oldest][0] > now:
+                break
+            del _local[oldest]
+
+@asynccontextmanager
+async def _fetching(key: str):
+    entry = _locks.setdefault(key, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del _locks[key]
+
+def invalidate_course_files(issuer: str, course_id: int):
+    # Every user's copy of the course
+    prefix = _prefix(issuer, course_id)
+    for key in [k for k in _local if k.startswith(prefix)]:
+        _local.pop(key, None)
+    redis = get_redis()
+    if redis is not None:
+        pattern = re.sub(r"([*?\[\]\\])", r"\\\1", prefix) + "*"
+        keys = list(redis.scan_iter(match=pattern, count=500))
+        if keys:
+            redis.delete(*keys)
+
+async def get_course_files(platform: Platform, user_sub: str, course_id: int,
+                           refresh: bool = False) -> Tuple[float, List[dict]]:
+    """Flattened file listing for a course and the version (fetch time) it was built at."""
+    key = _key(platform.issuer, course_id, user_sub)
+    if not refresh:
+        hit = await asyncio.to_thread(_load, key)
+        if hit:
+            return hit
+    # One core_course_get_contents call per course at a time; waiters reuse its result
+    async with _fetching(key):
+        if not refresh:
+            hit = await asyncio.to_thread(_load, key)
+            if hit:
+                return hit
+        files = await list_course_files(platform, user_sub, course_id)
+        version = time.time()
+        await asyncio.to_thread(_store, key, version, files)
+        return version, files
+
+def filter_files(files: List[dict], modname: Optional[str] = None, min_size: Optional[int] = None,
+                 max_size: Optional[int] = None, changed_since: Optional[int] = None) -> List[dict]:
+    out = []
+    for f in files:
+        size = f.get("filesize") or 0
+        if modname and (f.get("module") or {}).get("modname") != modname:
+            continue
+        if min_size is not None and size < min_size:
+            continue
+        if max_size is not None and size > max_size:
+            continue
+        if changed_since is not None and (f.get("timemodified") or 0) <= changed_since:
+            continue
+        out.append(f)
+    return out
+
+def encode_cursor(version: float, offset: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps({"v": version, "o": offset}).encode()).decode()
+
+def decode_cursor(cursor: Optional[str], version: float) -> int:
+    if not cursor:
+        return 0
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        v, offset = data["v"], int(data["o"])
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if v != version:
+        raise HTTPException(status_code=409, detail="Course listing changed; reload from the first page")
+    return offset
+
+def paginate(files: List[dict], version: float, cursor: Optional[str], limit: int):
+    start = decode_cursor(cursor, version)
+    page = files[start:start + limit]
+    end = start + len(page)
+    return page, (encode_cursor(version, end) if end < len(files) else None)
@@ -1,7 +1,16 @@
-from jose import jwt
+from jose import jwt, jwk
+from jose.exceptions import JWTError
+import asyncio, re, time
+from collections import OrderedDict
 import httpx
 from fastapi import HTTPException, status
-from typing import Dict, Any
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Dict, Any, Optional, Tuple
+from .config import settings
+from .platforms import derive_endpoints_from_issuer, get_platform
+from .http_clients import get_client
+from .metrics import JWKS_FETCH, LTI_VALIDATE
+from .ratelimit import host_key
 
 ADMIN_ROLE_URIS = {
     "http://purl.imsglobal.org/vocab/lis/v2/membership#Administrator",
@@ -9,26 +18,143 @@ ADMIN_ROLE_URIS = {
     "http://purl.imsglobal.org/vocab/lis/v2/membership#Instructor",
 }
 
-async def fetch_jwks(issuer: str) -> Dict[str, Any]:
+# Signature algorithms each key type may verify. alg comes from the token header, so it is checked against
+# the key: otherwise an HS256 token could be "verified" with an RSA public key as the HMAC secret
+KEY_ALGS = {"RSA": ("RS256", "RS384", "RS512"), "EC": ("ES256", "ES384", "ES512")}
+
+def _algs_for(key: dict) -> Tuple[str, ...]:
+    algs = KEY_ALGS.get(key.get("kty"), ())
+    pinned = key.get("alg")
+    if pinned:
+        return (pinned,) if pinned in algs else ()
+    return algs
+
+class JwksEntry:
+    def __init__(self, url: str, pooled: bool):
+        self.url = url
+        self.pooled = pooled
+        self.keys: Dict[str, dict] = {}
+        self.parsed: Dict[Tuple[str, str], Any] = {}  # (kid, alg) -> jose Key, so JWKs are parsed once
+        self.fetched_at = 0.0
+        self.expires_at = 0.0
+        self.lock = asyncio.Lock()
+
+# Per-process JWKS cache, keyed by issuer, least recently used first. Any caller can name an issuer in an
+# unsigned token, so only successful fetches are cached, and at most LTI_JWKS_CACHE_SIZE of them
+_jwks_cache: "OrderedDict[str, JwksEntry]" = OrderedDict()
+# First fetches in flight, so concurrent launches from a new issuer share one
+_jwks_pending: Dict[str, "asyncio.Future[JwksEntry]"] = {}
+
+def _ttl_from_headers(headers) -> int:
+    cc = headers.get("cache-control", "").lower()
+    if "no-store" in cc or "no-cache" in cc:
+        return settings.LTI_JWKS_MIN_TTL
+    m = re.search(r"max-age=(\d+)", cc)
+    ttl = int(m.group(1)) if m else settings.LTI_JWKS_DEFAULT_TTL
+    return max(settings.LTI_JWKS_MIN_TTL, min(ttl, settings.LTI_JWKS_MAX_TTL))
+
+async def fetch_jwks(url: str, pooled: bool = True) -> Tuple[Dict[str, Any], int]:
     # Moodle typically exposes JWKS at /mod/lti/certs.php
-    url = issuer.rstrip("/") + "/mod/lti/certs.php"
-    async with httpx.AsyncClient(timeout=10) as client:
-        r = await client.get(url)
-        r.raise_for_status()
-        return r.json()
+    with JWKS_FETCH.labels(host_key(url)).time():
+        if pooled:
+            r = await get_client(url).get(url, timeout=10)
+        else:
+            # Issuer not set up yet: don't keep a pooled client for a host the caller picked
+            async with httpx.AsyncClient(timeout=10) as client:
+                r = await client.get(url)
+    r.raise_for_status()
+    return r.json(), _ttl_from_headers(r.headers)
+
+async def _jwks_url(db: Optional[AsyncSession], issuer: str) -> Tuple[str, bool]:
+    p = await get_platform(db, issuer) if db is not None else None
+    if p and p.jwks_endpoint:
+        return p.jwks_endpoint, True
+    return derive_endpoints_from_issuer(issuer)["jwks_endpoint"], p is not None
+
+def _load(entry: JwksEntry, jwks: Dict[str, Any], ttl: int):
+    entry.keys = {k.get("kid") or "": k for k in jwks.get("keys", [])}
+    entry.parsed = {}
+    entry.fetched_at = time.monotonic()
+    entry.expires_at = entry.fetched_at + ttl
 
-async def validate_lti_id_token(id_token: str) -> Dict[str, Any]:
+async def _first_fetch(issuer: str, url: str, pooled: bool) -> JwksEntry:
+    entry = JwksEntry(url, pooled)
+    _load(entry, *await fetch_jwks(url, pooled))
+    _jwks_cache[issuer] = entry
+    while len(_jwks_cache) > max(1, settings.LTI_JWKS_CACHE_SIZE):
+        _jwks_cache.popitem(last=False)
+    return entry
+
+async def _refresh(entry: JwksEntry, seen_at: float):
+    # Single flight: concurrent launches wait for one fetch instead of each fetching
+    async with entry.lock:
+        if entry.fetched_at > seen_at:
+            return
+        try:
+            jwks, ttl = await fetch_jwks(entry.url, entry.pooled)
+        except httpx.HTTPError:
+            if not entry.keys:
+                raise
+            # Platform unreachable: keep using the keys we have for a little longer
+            entry.expires_at = time.monotonic() + settings.LTI_JWKS_MIN_TTL
+            return
+        _load(entry, jwks, ttl)
+
+async def get_signing_key(db: Optional[AsyncSession], issuer: str, kid: str, alg: str):
+    entry = _jwks_cache.get(issuer)
+    if entry is None:
+        pending = _jwks_pending.get(issuer)
+        if pending is None:
+            url, pooled = await _jwks_url(db, issuer)
+            pending = _jwks_pending.get(issuer)  # another launch may have started while we looked
+            if pending is None:
+                pending = _jwks_pending[issuer] = asyncio.ensure_future(_first_fetch(issuer, url, pooled))
+                pending.add_done_callback(lambda _: _jwks_pending.pop(issuer, None))
+        # Shielded so one launch giving up doesn't cancel the fetch the others wait for
+        entry = await asyncio.shield(pending)
+    else:
+        _jwks_cache.move_to_end(issuer)
+        now = time.monotonic()
+        if now >= entry.expires_at:
+            await _refresh(entry, entry.fetched_at)
+        elif kid not in entry.keys and now - entry.fetched_at >= settings.LTI_JWKS_MIN_REFRESH_SECONDS:
+            # Unknown kid: the platform may have rotated keys. Rate limited so bogus kids can't force fetches.
+            await _refresh(entry, entry.fetched_at)
+    key = entry.keys.get(kid)
+    if key is None:
+        # Without a kid, let jose try every key in the set that takes this alg
+        keys = [k for k in entry.keys.values() if alg in _algs_for(k)]
+        return ({"keys": keys} if not kid and keys else None), alg
+    if alg not in _algs_for(key):
+        return None, alg
+    parsed = entry.parsed.get((kid, alg))
+    if parsed is None:
+        parsed = entry.parsed[(kid, alg)] = jwk.construct(key, alg)
+    return parsed, alg
+
+async def validate_lti_id_token(id_token: str, db: Optional[AsyncSession] = None) -> Dict[str, Any]:
+    with LTI_VALIDATE.time():
+        return await _validate_lti_id_token(id_token, db)
+
+async def _validate_lti_id_token(id_token: str, db: Optional[AsyncSession]) -> Dict[str, Any]:
     # Decode using issuer-derived JWKS. For PoC we do NOT verify 'aud' to avoid per-issuer client_id config.
-    unverified = jwt.get_unverified_claims(id_token)
+    try:
+        unverified = jwt.get_unverified_claims(id_token)
+        header = jwt.get_unverified_header(id_token)
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=f"LTI id_token invalid: {e}")
     issuer = unverified.get("iss")
     if not issuer:
         raise HTTPException(status_code=401, detail="Missing issuer in id_token")
 
-    jwks = await fetch_jwks(issuer)
     try:
+        key, alg = await get_signing_key(db, issuer, header.get("kid") or "", header.get("alg") or "RS256")
+        if key is None:
+            raise JWTError("no signing key for this kid and alg")
         claims = jwt.decode(
             id_token,
-            jwks,
+            key,
+            algorithms=[alg],
             options={"verify_aud": False, "verify_at_hash": False},
             issuer=issuer,
         )
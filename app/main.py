@@ -1,22 +1,32 @@
-import json
-from fastapi import FastAPI, Request, Form, Depends, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+import asyncio, json
+from datetime import datetime, timedelta
+from fastapi import FastAPI, Request, Form, Depends, HTTPException, Query
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
 from starlette.middleware.sessions import SessionMiddleware
 from starlette.templating import Jinja2Templates
-from sqlalchemy.orm import Session
-from redis import Redis
-from rq import Queue
-from typing import Dict, Any
+from sqlalchemy import func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Dict, Any, Optional
 from .config import settings
-from .db import init_db, SessionLocal
+from .db import init_db, AsyncSessionLocal, close_async_engine
 from .lti import validate_lti_id_token
-from .models import Platform, TransferJob
-from .platforms import get_or_create_platform, get_user_token, set_user_token
+from .models import TransferJob, TransferFile
+from .platforms import get_platform, get_or_create_platform, update_platform, get_user_token, set_user_token
 from .moodle_oauth import build_auth_url, exchange_code_for_tokens
-from .moodle import list_course_files
-from .schemas import CreateTransfer
-from .jobs import perform_transfer
+from .moodle import list_category_courses
+from .bulk import collect_course_files
+from .listing import get_course_files, filter_files, paginate, decode_cursor, invalidate_course_files
+from .schemas import CreateTransfer, BulkTransfer
+from .jobs import file_entry, archive_name_for
+from .transfer_files import file_rows
+from .history import job_page, file_page, file_counts
+from .progress import read_progress, publish_status, snapshot as progress_snapshot, FINAL_STATUSES
+from .http_clients import close_clients
+from .metrics import render as render_metrics, CONTENT_TYPE_LATEST
+from .scheduler import dispatch, priority_for, queue_estimate
+from .chunks import chunk_summary
+from .tokens import invalidate_token
 
 app = FastAPI()
 app.add_middleware(SessionMiddleware, secret_key=settings.SESSION_SECRET)
@@ -31,10 +41,27 @@ def _startup():
         print("[INFO] DB init ok")
     except Exception as e:
         print(f"[WARN] DB init failed at startup: {e}")
-def get_db():
-    db = SessionLocal()
-    try: yield db
-    finally: db.close()
+
+async def _recover():
+    # Finished jobs and idle async workers dispatch too, but a lost worker may have been the last one
+    # running: look for jobs it left behind (scheduler.recover_lost) even when nothing else happens
+    while True:
+        await asyncio.sleep(settings.TRANSFER_HEARTBEAT_SECONDS)
+        await _dispatch()
+
+@app.on_event("startup")
+async def _start_recovery():
+    app.state.recovery = asyncio.ensure_future(_recover())
+
+@app.on_event("shutdown")
+async def _shutdown():
+    app.state.recovery.cancel()
+    await close_clients()
+    await close_async_engine()
+
+async def get_db():
+    async with AsyncSessionLocal() as db:
+        yield db
 
 def require_session(request: Request) -> Dict[str, Any]:
     if not request.session.get("lti"):
@@ -49,6 +76,10 @@ async def root(request: Request):
 async def healthz():
     return {"ok": True}
 
+@app.get("/metrics")
+def metrics():
+    return Response(render_metrics(), media_type=CONTENT_TYPE_LATEST)
+
 @app.get("/.well-known/jwks.json", response_class=JSONResponse)
 async def get_jwks():
     key = json.loads(settings.LTI_TOOL_PRIVATE_KEY_JWK)
@@ -63,15 +94,15 @@ async def get_jwks():
     return {"keys": [public_jwk]}
 
 @app.post("/lti/launch")
-async def lti_launch(request: Request, id_token: str = Form(...), state: str = Form(None), db: Session = Depends(get_db)):
-    claims = await validate_lti_id_token(id_token)
+async def lti_launch(request: Request, id_token: str = Form(...), state: str = Form(None), db: AsyncSession = Depends(get_db)):
+    claims = await validate_lti_id_token(id_token, db)
     issuer = claims.get("iss")
     deployment_id = claims.get("https://purl.imsglobal.org/spec/lti/claim/deployment_id", "")
     aud = claims.get("aud")
     client_id_lti = aud if isinstance(aud, str) else (aud[0] if aud else "")
 
     # Ensure platform exists
-    platform = get_or_create_platform(db, issuer, client_id_lti, deployment_id)
+    platform = await get_or_create_platform(db, issuer, client_id_lti, deployment_id)
 
     request.session["lti"] = {
         "issuer": issuer,
@@ -83,89 +114,246 @@ async def lti_launch(request: Request, id_token: str = Form(...), state: str = F
         return RedirectResponse(url="/platform/setup", status_code=303)
 
     # If no user token, start OAuth auth code flow
-    ut = get_user_token(db, issuer, claims.get("sub"))
+    ut = await get_user_token(db, issuer, claims.get("sub"))
     if not ut:
         return RedirectResponse(url="/auth/moodle/start", status_code=303)
 
     return RedirectResponse(url="/ui", status_code=303)
 
 @app.get("/platform/setup", response_class=HTMLResponse)
-async def platform_setup(request: Request, db: Session = Depends(get_db)):
+async def platform_setup(request: Request, db: AsyncSession = Depends(get_db)):
     ctx = request.session.get("lti")
     if not ctx: return HTMLResponse("<p>LTI launch required</p>", status_code=401)
-    platform = db.query(Platform).filter_by(issuer=ctx["issuer"]).first()
+    platform = await get_platform(db, ctx["issuer"])
     return templates.TemplateResponse("platform_setup.html", {"request": request, "platform": platform})
 
 @app.post("/platform/setup")
-async def platform_setup_post(request: Request, db: Session = Depends(get_db),
+async def platform_setup_post(request: Request, db: AsyncSession = Depends(get_db),
                               oauth_client_id: str = Form(...),
                               oauth_client_secret: str = Form(...),
                               oauth_auth_endpoint: str = Form(...),
                               oauth_token_endpoint: str = Form(...)):
     ctx = request.session.get("lti")
     if not ctx: raise HTTPException(status_code=401, detail="LTI launch required")
-    p = db.query(Platform).filter_by(issuer=ctx["issuer"]).first()
-    if not p: raise HTTPException(400, "Platform not found")
-    p.oauth_client_id = oauth_client_id.strip()
-    p.oauth_client_secret = oauth_client_secret.strip()
-    p.oauth_auth_endpoint = oauth_auth_endpoint.strip()
-    p.oauth_token_endpoint = oauth_token_endpoint.strip()
-    db.commit()
+    found = await update_platform(db, ctx["issuer"],
+                                  oauth_client_id=oauth_client_id.strip(),
+                                  oauth_client_secret=oauth_client_secret.strip(),
+                                  oauth_auth_endpoint=oauth_auth_endpoint.strip(),
+                                  oauth_token_endpoint=oauth_token_endpoint.strip())
+    if not found: raise HTTPException(400, "Platform not found")
     return RedirectResponse(url="/auth/moodle/start", status_code=303)
 
 @app.get("/auth/moodle/start")
-async def moodle_auth_start(request: Request, db: Session = Depends(get_db)):
+async def moodle_auth_start(request: Request, db: AsyncSession = Depends(get_db)):
     ctx = request.session.get("lti")
     if not ctx: raise HTTPException(status_code=401, detail="LTI launch required")
-    platform = db.query(Platform).filter_by(issuer=ctx["issuer"]).first()
+    platform = await get_platform(db, ctx["issuer"])
     state = f"{ctx['issuer']}|{ctx['user_sub']}"
     url = build_auth_url(platform, settings.APP_BASE_URL, state=state, scope="webservice")
     return RedirectResponse(url, status_code=303)
 
 @app.get("/auth/moodle/callback")
-async def moodle_auth_callback(request: Request, code: str, state: str, db: Session = Depends(get_db)):
+async def moodle_auth_callback(request: Request, code: str, state: str, db: AsyncSession = Depends(get_db)):
     ctx = request.session.get("lti")
     if not ctx: raise HTTPException(status_code=401, detail="LTI launch required")
-    platform = db.query(Platform).filter_by(issuer=ctx["issuer"]).first()
+    platform = await get_platform(db, ctx["issuer"])
     tokens = await exchange_code_for_tokens(platform, settings.APP_BASE_URL, code)
-    set_user_token(db, platform.issuer, ctx["user_sub"], tokens.get("access_token"), tokens.get("refresh_token"), tokens.get("expires_in", 3600))
+    await set_user_token(db, platform.issuer, ctx["user_sub"], tokens.get("access_token"), tokens.get("refresh_token"), tokens.get("expires_in", 3600))
+    invalidate_token(platform.issuer, ctx["user_sub"])
     return RedirectResponse(url="/ui", status_code=303)
 
 @app.get("/ui", response_class=HTMLResponse)
-async def ui(request: Request, db: Session = Depends(get_db)):
+async def ui(request: Request, db: AsyncSession = Depends(get_db)):
     ctx = request.session.get("lti")
     if not ctx: return HTMLResponse("<h2>Launch Required</h2><p>Please launch this tool from your LMS as an admin.</p>")
-    platform = db.query(Platform).filter_by(issuer=ctx["issuer"]).first()
+    platform = await get_platform(db, ctx["issuer"])
     return templates.TemplateResponse("picker.html", {"request": request, "user": {"name": ctx["name"] or ctx["user_sub"]}, "platform": platform})
 
 @app.get("/moodle/files")
-async def moodle_files(course_id: int, request: Request, db: Session = Depends(get_db)):
+async def moodle_files(course_id: int, request: Request, db: AsyncSession = Depends(get_db),
+                       cursor: Optional[str] = None, limit: int = Query(200, ge=1, le=1000),
+                       modname: Optional[str] = None, min_size: Optional[int] = None, max_size: Optional[int] = None,
+                       changed_since: Optional[int] = None, refresh: bool = False, format: str = "json"):
     ctx = require_session(request)
-    platform = db.query(Platform).filter_by(issuer=ctx["issuer"]).first()
-    files = await list_course_files(db, platform, ctx["user_sub"], course_id)
-    return {"files": files[:200]}
+    platform = await get_platform(db, ctx["issuer"])
+    version, files = await get_course_files(platform, ctx["user_sub"], course_id, refresh=refresh)
+    files = filter_files(files, modname=modname, min_size=min_size, max_size=max_size, changed_since=changed_since)
+    if format == "ndjson":
+        # Whole (filtered) listing, one JSON object per line, without building one big response body
+        start = decode_cursor(cursor, version)
+        return StreamingResponse((json.dumps(f) + "\n" for f in files[start:]), media_type="application/x-ndjson")
+    page, next_cursor = paginate(files, version, cursor, limit)
+    return {"files": page, "next_cursor": next_cursor, "total": len(files)}
 
-@app.post("/transfers")
-async def create_transfer(payload: CreateTransfer, request: Request, db: Session = Depends(get_db)):
+@app.delete("/moodle/files/cache")
+async def moodle_files_invalidate(course_id: int, request: Request):
     ctx = require_session(request)
+    await asyncio.to_thread(invalidate_course_files, ctx["issuer"], course_id)
+    return {"ok": True}
+
+async def _dispatch():
+    # The job is already saved and will be dispatched by the next finished job or idle worker,
+    # so a lock timeout or Redis error here doesn't fail the request
+    try:
+        await asyncio.to_thread(dispatch)
+    except Exception as e:
+        print(f"[WARN] dispatch failed, jobs stay queued: {e}")
+
+async def _publish(*jobs: TransferJob):
+    # Seed the live snapshot so event streams read Redis, not the DB, while the job waits
+    await asyncio.to_thread(lambda: [publish_status(job) for job in jobs])
+
+async def _add_job(db: AsyncSession, ctx: dict, course_id, mode: str, files: list,
+                   archive_format: Optional[str] = None, priority: str = "auto") -> TransferJob:
     job = TransferJob(
         issuer=ctx["issuer"],
         requester_sub=ctx["user_sub"],
-        course_id=str(payload.course_id),
+        course_id=str(course_id),
         source="moodle",
         destination="azure",
-        files=[{"filename": f["filename"], "fileurl": f["fileurl"], "filesize": f.get("filesize", 0)} for f in payload.files],
+        mode=mode,
+        archive_format=archive_format if mode == "archive" else None,
         status="queued",
     )
-    db.add(job); db.commit(); db.refresh(job)
-    q = Queue('transfers', connection=Redis.from_url(os.getenv("REDIS_URL")))
-    q.enqueue(perform_transfer, job.id)
-    return {"job_id": job.id, "status": job.status}
+    db.add(job); await db.flush()
+    rows = file_rows(job.id, [file_entry(f) for f in files])
+    if rows:
+        await db.execute(insert(TransferFile), rows)
+    job.files_total = len(rows)
+    job.bytes_total = sum(r["filesize"] for r in rows)
+    job.priority = priority_for(job.bytes_total, priority, whole_course=not rows)
+    return job
+
+@app.post("/transfers")
+async def create_transfer(payload: CreateTransfer, request: Request, db: AsyncSession = Depends(get_db)):
+    ctx = require_session(request)
+    if payload.mode != "sync" and not payload.files:
+        raise HTTPException(status_code=400, detail="No files selected")
+    job = await _add_job(db, ctx, payload.course_id, payload.mode, payload.files, payload.archive_format,
+                         payload.priority)
+    await db.commit()
+    await _publish(job)
+    await _dispatch()
+    return {"job_id": job.id, "status": job.status, "mode": job.mode}
+
+@app.post("/transfers/bulk")
+async def create_bulk_transfer(payload: BulkTransfer, request: Request, db: AsyncSession = Depends(get_db)):
+    ctx = require_session(request)
+    platform = await get_platform(db, ctx["issuer"])
+    course_ids = list(payload.course_ids)
+    if payload.category_id is not None:
+        courses = await list_category_courses(platform, ctx["user_sub"], payload.category_id)
+        course_ids += [c["id"] for c in courses]
+    if not course_ids:
+        raise HTTPException(status_code=400, detail="No courses selected")
+
+    listings, errors = await collect_course_files(platform, ctx["user_sub"], course_ids)
+    skipped = [{"course_id": cid, "reason": reason} for cid, reason in errors.items()]
+    jobs = []
+    for cid, files in listings.items():
+        if not files:
+            skipped.append({"course_id": cid, "reason": "No files"})
+            continue
+        jobs.append(await _add_job(db, ctx, cid, payload.mode, files, payload.archive_format, payload.priority))
+    await db.commit()
+    await _publish(*jobs)
+    await _dispatch()
+    return {
+        "jobs": [{"job_id": j.id, "course_id": int(j.course_id), "files": j.files_total,
+                  "bytes": j.bytes_total} for j in jobs],
+        "skipped": skipped,
+    }
+
+@app.get("/transfers")
+async def list_transfers(request: Request, db: AsyncSession = Depends(get_db), cursor: Optional[str] = None,
+                         limit: int = Query(50, ge=1, le=500), status: Optional[str] = None, mine: bool = False):
+    ctx = require_session(request)
+    jobs, next_cursor = await job_page(db, ctx["issuer"], cursor, limit, status=status,
+                                       requester_sub=ctx["user_sub"] if mine else None)
+    return {"jobs": jobs, "next_cursor": next_cursor}
 
 @app.get("/transfers/{job_id}")
-async def get_transfer(job_id: int, request: Request, db: Session = Depends(get_db)):
+async def get_transfer(job_id: int, request: Request, db: AsyncSession = Depends(get_db)):
+    ctx = require_session(request)
+    job = await db.get(TransferJob, job_id)
+    if not job or job.issuer != ctx["issuer"]:
+        raise HTTPException(status_code=404, detail="Not found")
+    res = {"id": job.id, "status": job.status, "bytes_total": job.bytes_total, "bytes_sent": job.bytes_sent,
+           "files_total": job.files_total, "files": await file_counts(db, job), "priority": job.priority}
+    estimate = await queue_estimate(db, job)
+    if estimate:
+        res.update(estimate)
+    if job.mode == "archive":
+        name = archive_name_for(job)
+        res["archive"] = {"format": job.archive_format, "blob_name": name, "index_blob_name": f"{name}.index.json"}
+    summary = await chunk_summary(db, job)
+    if summary:
+        res.update(summary)
+    return res
+
+@app.get("/transfers/{job_id}/files")
+async def get_transfer_files(job_id: int, request: Request, db: AsyncSession = Depends(get_db),
+                             cursor: Optional[str] = None, limit: int = Query(200, ge=1, le=1000),
+                             status: Optional[str] = None):
+    ctx = require_session(request)
+    job = await db.get(TransferJob, job_id)
+    if not job or job.issuer != ctx["issuer"]:
+        raise HTTPException(status_code=404, detail="Not found")
+    files, next_cursor = await file_page(db, job, cursor, limit, status=status)
+    return {"files": files, "next_cursor": next_cursor}
+
+async def _job_progress(job_id: int) -> Optional[dict]:
+    # DB fallback when Redis has no live snapshot (no Redis, or it expired)
+    async with AsyncSessionLocal() as db:
+        job = await db.get(TransferJob, job_id)
+        return progress_snapshot(job.status, job.bytes_total, job.bytes_sent, 0) if job else None
+
+@app.get("/transfers/{job_id}/events")
+async def transfer_events(job_id: int, request: Request, db: AsyncSession = Depends(get_db)):
+    ctx = require_session(request)
+    job = await db.get(TransferJob, job_id)
+    if not job or job.issuer != ctx["issuer"]:
+        raise HTTPException(status_code=404, detail="Not found")
+    await db.close()  # the stream below may run for hours; don't hold a pooled connection
+
+    async def stream():
+        # Server-Sent Events: progress, throughput (bytes/s) and ETA until the job finishes
+        while not await request.is_disconnected():
+            snap = await asyncio.to_thread(read_progress, job_id)
+            live = snap is not None
+            if not live:
+                snap = await _job_progress(job_id)
+            if snap is None:
+                break
+            yield f"data: {json.dumps({'id': job_id, **snap})}\n\n"
+            if snap["status"] in FINAL_STATUSES:
+                break
+            # The DB copy changes only every PROGRESS_DB_INTERVAL, so there is no point reading it more often
+            await asyncio.sleep(settings.PROGRESS_PUSH_INTERVAL if live else settings.PROGRESS_DB_INTERVAL)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+async def _lost(db: AsyncSession, job: TransferJob) -> bool:
+    # A running job with no heartbeat for TRANSFER_STALE_SECONDS lost its worker. A split parent has none
+    # of its own while its chunks run
+    stale = datetime.utcnow() - timedelta(seconds=settings.TRANSFER_STALE_SECONDS)
+    if job.status != "running" or (job.updated_at and job.updated_at >= stale):
+        return False
+    active = await db.scalar(select(func.count()).select_from(TransferJob)
+                             .where(TransferJob.parent_id == job.id, TransferJob.status.in_(("queued", "running"))))
+    return not active
+
+@app.post("/transfers/{job_id}/retry")
+async def retry_transfer(job_id: int, request: Request, db: AsyncSession = Depends(get_db)):
     ctx = require_session(request)
-    job = db.get(TransferJob, job_id)
+    job = await db.get(TransferJob, job_id)
     if not job or job.issuer != ctx["issuer"]:
         raise HTTPException(status_code=404, detail="Not found")
-    return {"id": job.id, "status": job.status, "bytes_total": job.bytes_total, "bytes_sent": job.bytes_sent}
+    if job.status not in ("failed", "partial") and not await _lost(db, job):
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    # Completed files are skipped and partly staged files resume from their checkpoints
+    job.status = "queued"; job.dispatched_at = None; job.resumes = 0; await db.commit()
+    await asyncio.to_thread(publish_status, job)
+    await _dispatch()
+    return {"job_id": job.id, "status": job.status}
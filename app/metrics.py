@@ -0,0 +1,80 @@
+import os, time
+from contextlib import contextmanager
+from prometheus_client import (CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST,
+                               generate_latest, start_http_server)
+from prometheus_client import multiprocess
+
+try:
+    from opentelemetry import trace
+    _tracer = trace.get_tracer("verify-learner-work")
+except ImportError:
+    _tracer = None
+
+# Prometheus metrics for each stage of the pipeline. Rates (MB/s, files/s, errors/s) come from the counters;
+# latency percentiles from the histograms. Moodle series are labelled by host (scheme://netloc), which is
+# the issuer for every Moodle we talk to.
+
+_SLOW = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600, 4 * 3600)
+_RATE = tuple(2 ** i * 1024 * 1024 for i in range(-4, 10))  # 64 KB/s .. 512 MB/s
+
+MOODLE_TTFB = Histogram("moodle_ttfb_seconds", "Time to response headers from Moodle", ["host", "method"])
+MOODLE_ERRORS = Counter("moodle_errors_total", "Moodle requests that failed (HTTP status or 'transport')",
+                        ["host", "reason"])
+JWKS_FETCH = Histogram("lti_jwks_fetch_seconds", "Platform JWKS fetch time", ["host"])
+LTI_VALIDATE = Histogram("lti_validate_seconds", "LTI id_token validation time, including JWKS lookups")
+TOKEN_REFRESH = Histogram("moodle_token_refresh_seconds", "OAuth access token refresh time", ["host"])
+
+TRANSFER_BYTES = Counter("transfer_bytes_total", "Bytes moved, by direction (download from Moodle, upload to Azure, "
+                         "server_copy pulled by Azure itself)", ["direction"])
+AZURE_STAGE = Histogram("azure_block_stage_seconds", "Azure stage_block latency")
+AZURE_COMMIT = Histogram("azure_block_commit_seconds", "Azure commit_block_list latency")
+AZURE_PUT = Histogram("azure_put_blob_seconds", "Azure single-shot Put Blob latency (small files)")
+DB_COMMIT = Histogram("db_commit_seconds", "Session flush + commit time")
+
+QUEUE_WAIT = Histogram("rq_queue_wait_seconds", "Time a job spent queued before a worker started it", buckets=_SLOW)
+JOBS_ACTIVE = Gauge("transfer_jobs_active", "Transfer jobs running in this process", multiprocess_mode="livesum")
+JOB_SECONDS = Histogram("transfer_job_seconds", "Transfer job run time", ["status"], buckets=_SLOW)
+FILES = Counter("transfer_files_total", "Files finished, by issuer and outcome", ["issuer", "outcome"])
+FILE_SECONDS = Histogram("transfer_file_seconds", "Per-file copy time", buckets=_SLOW)
+FILE_THROUGHPUT = Histogram("transfer_file_bytes_per_second", "Per-file end-to-end throughput", buckets=_RATE)
+
+def registry() -> CollectorRegistry:
+    # With PROMETHEUS_MULTIPROC_DIR set (gunicorn workers, forking RQ workers) merge every process's samples
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        reg = CollectorRegistry()
+        multiprocess.MultiProcessCollector(reg)
+        return reg
+    return REGISTRY
+
+def render() -> bytes:
+    return generate_latest(registry())
+
+def serve(port: int):
+    """Expose /metrics from a non-web process (the worker) on its own port."""
+    start_http_server(port, registry=registry())
+
+def instrument_sessions(session_factory):
+    from sqlalchemy import event
+
+    @event.listens_for(session_factory, "before_commit")
+    def _before(session):
+        session.info["commit_started"] = time.perf_counter()
+
+    @event.listens_for(session_factory, "after_commit")
+    def _after(session):
+        started = session.info.pop("commit_started", None)
+        if started is not None:
+            DB_COMMIT.observe(time.perf_counter() - started)
+
+    @event.listens_for(session_factory, "after_rollback")
+    def _rollback(session):
+        session.info.pop("commit_started", None)
+
+@contextmanager
+def span(name: str, **attributes):
+    """OpenTelemetry span when opentelemetry is installed (and configured by the deployment), else a no-op."""
+    if _tracer is None:
+        yield None
+        return
+    with _tracer.start_as_current_span(name, attributes={k: v for k, v in attributes.items() if v is not None}) as s:
+        yield s
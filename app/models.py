@@ -1,5 +1,5 @@
 from sqlalchemy.orm import declarative_base, Mapped, mapped_column
-from sqlalchemy import String, Integer, Text, DateTime, JSON, ForeignKey, UniqueConstraint
+from sqlalchemy import String, Integer, BigInteger, Text, DateTime, JSON, ForeignKey, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 
@@ -38,18 +38,76 @@ class TransferJob(Base):
     course_id: Mapped[str] = mapped_column(String(64))
     source: Mapped[str] = mapped_column(String(32))  # "moodle"
     destination: Mapped[str] = mapped_column(String(32))  # "azure"
-    files: Mapped[dict] = mapped_column(JSON)
+    mode: Mapped[str] = mapped_column(String(16), default="copy")  # "copy" | "sync" | "archive"
+    archive_format: Mapped[str] = mapped_column(String(8), nullable=True)  # "zip" | "tar", archive mode only
+    parent_id: Mapped[int] = mapped_column(Integer, ForeignKey("transfer_jobs.id"), nullable=True, index=True)  # set on chunk jobs
     status: Mapped[str] = mapped_column(String(32), default="queued")
-    bytes_total: Mapped[int] = mapped_column(Integer, default=0)
-    bytes_sent: Mapped[int] = mapped_column(Integer, default=0)
+    priority: Mapped[str] = mapped_column(String(16), default="interactive")  # "interactive" | "bulk"
+    dispatched_at: Mapped[datetime] = mapped_column(DateTime, nullable=True, index=True)  # handed to RQ, not finished
+    resumes: Mapped[int] = mapped_column(Integer, default=0)  # times re-queued after its worker was lost
+    files_total: Mapped[int] = mapped_column(Integer, default=0)
+    bytes_total: Mapped[int] = mapped_column(BigInteger, default=0)
+    bytes_sent: Mapped[int] = mapped_column(BigInteger, default=0)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
     updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (Index('ix_transfer_jobs_issuer_status_created', 'issuer', 'status', 'created_at'),
+                      Index('ix_transfer_jobs_issuer_created', 'issuer', 'created_at', 'id'))
+
+class TransferFile(Base):
+    __tablename__ = "transfer_files"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    job_id: Mapped[int] = mapped_column(Integer, ForeignKey("transfer_jobs.id"))
+    chunk_id: Mapped[int] = mapped_column(Integer, ForeignKey("transfer_jobs.id"), nullable=True)  # chunk job copying it
+    filename: Mapped[str] = mapped_column(String(512), default="")
+    fileurl: Mapped[str] = mapped_column(String(1024))
+    filesize: Mapped[int] = mapped_column(BigInteger, default=0)
+    timemodified: Mapped[int] = mapped_column(BigInteger, nullable=True)
+    blob_name: Mapped[str] = mapped_column(String(1024), default="")
+    status: Mapped[str] = mapped_column(String(16), default="pending")  # pending|completed|failed|skipped
+    bytes_done: Mapped[int] = mapped_column(BigInteger, default=0)
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    error: Mapped[str] = mapped_column(Text, nullable=True)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (Index('ix_transfer_files_job_id', 'job_id', 'id'),
+                      Index('ix_transfer_files_job_status', 'job_id', 'status'),
+                      Index('ix_transfer_files_chunk_id', 'chunk_id', 'id'),
+                      Index('ix_transfer_files_status_updated', 'status', 'updated_at'))  # recent throughput
+
 class TransferEvent(Base):
     __tablename__ = "transfer_events"
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    job_id: Mapped[int] = mapped_column(Integer, ForeignKey("transfer_jobs.id"))
+    job_id: Mapped[int] = mapped_column(Integer, ForeignKey("transfer_jobs.id"), index=True)
     ts: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
     level: Mapped[str] = mapped_column(String(16), default="INFO")
     message: Mapped[str] = mapped_column(Text, default="")
     data: Mapped[dict] = mapped_column(JSON, default={})
+
+class TransferCheckpoint(Base):
+    __tablename__ = "transfer_checkpoints"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    job_id: Mapped[int] = mapped_column(Integer, ForeignKey("transfer_jobs.id"))
+    fileurl: Mapped[str] = mapped_column(String(1024))
+    blob_name: Mapped[str] = mapped_column(String(1024))
+    size: Mapped[int] = mapped_column(BigInteger, default=0)
+    block_size: Mapped[int] = mapped_column(Integer, default=0)
+    staged_blocks: Mapped[list] = mapped_column(JSON, default=list)  # block indexes staged on the blob
+    offset: Mapped[int] = mapped_column(BigInteger, default=0)  # bytes staged without gaps from the start
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (UniqueConstraint('job_id', 'fileurl', name='uq_checkpoint_job_file'),)
+
+class SyncManifestEntry(Base):
+    __tablename__ = "sync_manifest"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    issuer: Mapped[str] = mapped_column(String(512))
+    course_id: Mapped[str] = mapped_column(String(64))
+    fileurl: Mapped[str] = mapped_column(String(1024))
+    filename: Mapped[str] = mapped_column(String(512), default="")
+    filesize: Mapped[int] = mapped_column(BigInteger, default=0)
+    timemodified: Mapped[int] = mapped_column(BigInteger, nullable=True)
+    blob_name: Mapped[str] = mapped_column(String(1024), default="")
+    synced_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (UniqueConstraint('issuer', 'course_id', 'fileurl', name='uq_manifest_issuer_course_file'),)
@@ -1,9 +1,10 @@
-import httpx, urllib.parse
+import urllib.parse
 from datetime import datetime
 from sqlalchemy.orm import Session
 from fastapi import HTTPException
 from .models import Platform, UserToken
 from .platforms import get_user_token, set_user_token
+from .http_clients import get_client
 
 def build_auth_url(platform: Platform, app_base_url: str, state: str, scope: str = "webservice"):
     redirect_uri = f"{app_base_url.rstrip('/')}/auth/moodle/callback"
@@ -25,11 +26,10 @@ async def exchange_code_for_tokens(platform: Platform, app_base_url: str, code:
         "client_id": platform.oauth_client_id,
         "client_secret": platform.oauth_client_secret,
     }
-    async with httpx.AsyncClient(timeout=20) as client:
-        r = await client.post(platform.oauth_token_endpoint, data=data)
-        if r.status_code >= 400:
-            raise HTTPException(status_code=400, detail=f"Token exchange failed: {r.text}")
-        return r.json()
+    r = await get_client(platform.oauth_token_endpoint).post(platform.oauth_token_endpoint, data=data, timeout=20)
+    if r.status_code >= 400:
+        raise HTTPException(status_code=400, detail=f"Token exchange failed: {r.text}")
+    return r.json()
 
 async def refresh_access_token(platform: Platform, refresh_token: str):
     data = {
@@ -38,8 +38,7 @@ async def refresh_access_token(platform: Platform, refresh_token: str):
         "client_id": platform.oauth_client_id,
         "client_secret": platform.oauth_client_secret,
     }
-    async with httpx.AsyncClient(timeout=20) as client:
-        r = await client.post(platform.oauth_token_endpoint, data=data)
-        if r.status_code >= 400:
-            raise HTTPException(status_code=400, detail=f"Refresh failed: {r.text}")
-        return r.json()
+    r = await get_client(platform.oauth_token_endpoint).post(platform.oauth_token_endpoint, data=data, timeout=20)
+    if r.status_code >= 400:
+        raise HTTPException(status_code=400, detail=f"Refresh failed: {r.text}")
+    return r.json()
@@ -1,5 +1,12 @@
-from sqlalchemy.orm import Session
+import asyncio, threading, time
+from dataclasses import dataclass, fields, replace
+from typing import Dict, Optional, Tuple
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from .config import settings
 from .models import Platform, UserToken
+from .redis_conn import get_redis
 from datetime import datetime, timedelta
 
 def derive_endpoints_from_issuer(issuer: str):
@@ -11,11 +18,88 @@ def derive_endpoints_from_issuer(issuer: str):
         "oauth_token_endpoint": f"{issuer}/oauth2/token.php",
     }
 
-def get_or_create_platform(db: Session, issuer: str, client_id_lti: str, deployment_id: str):
-    p = db.query(Platform).filter_by(issuer=issuer).first()
+@dataclass(frozen=True)
+class PlatformConfig:
+    """Immutable snapshot of a platforms row, safe to share between requests."""
+    id: int
+    issuer: str
+    client_id_lti: str
+    deployment_id: str
+    oauth_client_id: str
+    oauth_client_secret: str
+    oauth_auth_endpoint: str
+    oauth_token_endpoint: str
+    jwks_endpoint: str
+
+    @classmethod
+    def from_row(cls, p: Platform) -> "PlatformConfig":
+        return cls(**{f.name: getattr(p, f.name) for f in fields(cls)})
+
+# Per-process cache keyed by issuer: (expires_at, snapshot). Writes publish the issuer on PLATFORM_CHANNEL
+# so every web process drops its copy; the TTL bounds staleness if a message is missed.
+PLATFORM_CHANNEL = "platform-config-invalidate"
+_platforms: Dict[str, Tuple[float, PlatformConfig]] = {}
+_generations: Dict[str, int] = {}
+_listener: Optional[threading.Thread] = None
+
+def _forget(issuer: str):
+    _generations[issuer] = _generations.get(issuer, 0) + 1
+    _platforms.pop(issuer, None)
+
+def _listen(redis):
+    while True:
+        try:
+            pubsub = redis.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(PLATFORM_CHANNEL)
+            for issuer in list(_platforms):
+                _forget(issuer)  # invalidations sent while we weren't subscribed are lost
+            for msg in pubsub.listen():
+                _forget(msg["data"].decode())
+        except Exception as e:
+            print(f"[WARN] platform cache listener: {e}")
+            time.sleep(1)
+
+def _ensure_listener():
+    global _listener
+    redis = get_redis()
+    if redis is None or (_listener is not None and _listener.is_alive()):
+        return
+    _listener = threading.Thread(target=_listen, args=(redis,), name="platform-cache", daemon=True)
+    _listener.start()
+
+def invalidate_platform(issuer: str):
+    _forget(issuer)
+    redis = get_redis()
+    if redis is not None:
+        redis.publish(PLATFORM_CHANNEL, issuer)
+
+async def get_platform(db: AsyncSession, issuer: str) -> Optional[PlatformConfig]:
+    _ensure_listener()
+    hit = _platforms.get(issuer)
+    if hit and hit[0] > time.monotonic():
+        return hit[1]
+    generation = _generations.get(issuer, 0)
+    p = await db.scalar(select(Platform).filter_by(issuer=issuer))
+    if p is None:
+        return None
+    snap = PlatformConfig.from_row(p)
+    if _generations.get(issuer, 0) == generation:
+        # Not invalidated while we were reading, so this copy is current
+        _platforms[issuer] = (time.monotonic() + settings.PLATFORM_CACHE_TTL, snap)
+    return snap
+
+async def update_platform(db: AsyncSession, issuer: str, **values) -> bool:
+    """Write-through update of a platform's config; False if the issuer is unknown."""
+    res = await db.execute(update(Platform).filter_by(issuer=issuer).values(**values))
+    await db.commit()
+    await asyncio.to_thread(invalidate_platform, issuer)
+    return res.rowcount > 0
+
+async def get_or_create_platform(db: AsyncSession, issuer: str, client_id_lti: str, deployment_id: str):
+    p = await get_platform(db, issuer)
     if not p:
         eps = derive_endpoints_from_issuer(issuer)
-        p = Platform(
+        row = Platform(
             issuer=issuer,
             client_id_lti=client_id_lti or "",
             deployment_id=deployment_id or "",
@@ -25,23 +109,31 @@ def get_or_create_platform(db: Session, issuer: str, client_id_lti: str, deploym
             oauth_client_id="",
             oauth_client_secret="",
         )
-        db.add(p); db.commit(); db.refresh(p)
-    else:
-        # Update latest seen client_id/deployment
-        changed = False
-        if client_id_lti and p.client_id_lti != client_id_lti:
-            p.client_id_lti = client_id_lti; changed = True
-        if deployment_id and p.deployment_id != deployment_id:
-            p.deployment_id = deployment_id; changed = True
-        if changed:
-            db.commit()
+        db.add(row)
+        try:
+            await db.commit()
+        except IntegrityError:
+            # First launches from a new Moodle racing each other: the other one created it
+            await db.rollback()
+        else:
+            await asyncio.to_thread(invalidate_platform, issuer)
+        return await get_platform(db, issuer)
+    # Update latest seen client_id/deployment; usually unchanged, so no write
+    changes = {}
+    if client_id_lti and p.client_id_lti != client_id_lti:
+        changes["client_id_lti"] = client_id_lti
+    if deployment_id and p.deployment_id != deployment_id:
+        changes["deployment_id"] = deployment_id
+    if changes:
+        await update_platform(db, issuer, **changes)
+        return replace(p, **changes)
     return p
 
-def get_user_token(db: Session, issuer: str, user_sub: str):
-    return db.query(UserToken).filter_by(issuer=issuer, user_sub=user_sub).first()
+async def get_user_token(db: AsyncSession, issuer: str, user_sub: str):
+    return await db.scalar(select(UserToken).filter_by(issuer=issuer, user_sub=user_sub))
 
-def set_user_token(db: Session, issuer: str, user_sub: str, access_token: str, refresh_token: str, expires_in: int):
-    ut = get_user_token(db, issuer, user_sub)
+async def set_user_token(db: AsyncSession, issuer: str, user_sub: str, access_token: str, refresh_token: str, expires_in: int):
+    ut = await get_user_token(db, issuer, user_sub)
     exp = datetime.utcnow() + timedelta(seconds=max(expires_in-30, 30))
     if not ut:
         ut = UserToken(issuer=issuer, user_sub=user_sub, access_token=access_token, refresh_token=refresh_token, expires_at=exp)
@@ -50,5 +142,5 @@ def set_user_token(db: Session, issuer: str, user_sub: str, access_token: str, r
         ut.access_token = access_token
         ut.refresh_token = refresh_token or ut.refresh_token
         ut.expires_at = exp
-    db.commit()
+    await db.commit()
     return ut
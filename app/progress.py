@@ -0,0 +1,136 @@
+import asyncio, json, time
+from datetime import datetime
+from typing import Optional
+from .config import settings
+from .models import TransferJob
+from .events import EventSink
+from .redis_conn import get_redis
+
+FINAL_STATUSES = ("completed", "partial", "failed")
+
+def _key(job_id: int) -> str:
+    return f"progress:{job_id}"
+
+class ProgressTracker:
+    """Counts bytes as they are uploaded; publishes to Redis often and to the DB rarely.
+
+    Neither blocks the event loop: Redis writes run in a thread, one at a time, and DB saves ride on the
+    job's EventSink batch.
+    """
+
+    def __init__(self, events: EventSink, job: TransferJob, initial: int = 0):
+        self.events = events
+        self.job = job
+        self.bytes = initial
+        self._published = initial
+        self.rate = 0.0  # bytes/s, smoothed
+        now = time.monotonic()
+        self._rate_at, self._rate_bytes = now, initial
+        self._redis_at = self._db_at = now
+        self._sending: Optional[asyncio.Future] = None
+
+    def add(self, n: int):
+        self.bytes += n
+        now = time.monotonic()
+        if now - self._redis_at >= settings.PROGRESS_REDIS_INTERVAL:
+            self._publish(now)
+        if now - self._db_at >= settings.PROGRESS_DB_INTERVAL:
+            self._save(now)
+
+    async def finish(self):
+        if self._sending is not None:
+            await self._sending  # so the final snapshot isn't skipped, or overtaken by an older one
+        now = time.monotonic()
+        self._publish(now)
+        if self._sending is not None:
+            await self._sending
+        self._save(now)
+
+    def _publish(self, now: float):
+        elapsed = now - self._rate_at
+        if elapsed > 0:
+            sample = (self.bytes - self._rate_bytes) / elapsed
+            self.rate = sample if not self.rate else 0.7 * self.rate + 0.3 * sample
+            self._rate_at, self._rate_bytes = now, self.bytes
+        self._redis_at = now
+        redis = get_redis()
+        if redis is None or (self._sending is not None and not self._sending.done()):
+            return  # the bytes are counted in the next publish
+        snap = {"status": self.job.status, "bytes_total": self.job.bytes_total or 0,
+                "bytes_sent": self.bytes, "rate": round(self.rate), "ts": time.time()}
+        delta, self._published = self.bytes - self._published, self.bytes
+        parent = self.job.parent_id
+        rate = 0 if self.job.status in FINAL_STATUSES else round(self.rate)
+        self._sending = asyncio.get_running_loop().run_in_executor(
+            None, _send, redis, self.job.id, snap, parent, delta, rate)
+
+    def _save(self, now: float):
+        self._db_at = now
+        self.job.bytes_sent = self.bytes; self.job.updated_at = datetime.utcnow()
+        self.events.mark_dirty()
+
+def _send(redis, job_id: int, snap: dict, parent_id: Optional[int], delta: int, rate: int):
+    try:
+        pipe = redis.pipeline(transaction=False)
+        pipe.set(_key(job_id), json.dumps(snap), ex=settings.PROGRESS_TTL)
+        if parent_id:
+            # Chunk jobs also feed their parent's running totals
+            parent = _key(parent_id)
+            pipe.incrby(f"{parent}:bytes", delta)
+            pipe.hset(f"{parent}:rates", str(job_id), rate)
+            pipe.expire(f"{parent}:bytes", settings.PROGRESS_TTL)
+            pipe.expire(f"{parent}:rates", settings.PROGRESS_TTL)
+        pipe.execute()
+    except Exception:
+        pass  # progress is best effort; the DB copy catches up on the next save
+
+def publish_status(job: TransferJob):
+    # For status changes outside a tracker (queued, early failure)
+    redis = get_redis()
+    if redis is None:
+        return
+    try:
+        raw = redis.get(_key(job.id))
+        snap = json.loads(raw) if raw else {"bytes_sent": job.bytes_sent or 0, "rate": 0}
+        snap.update(status=job.status, bytes_total=job.bytes_total or 0, ts=time.time())
+        redis.set(_key(job.id), json.dumps(snap), ex=settings.PROGRESS_TTL)
+    except Exception:
+        pass
+
+def publish_split(job: TransferJob, base: int):
+    # A split job's bytes are the sum of its chunks' counters on top of what it had already sent
+    redis = get_redis()
+    if redis is None:
+        return
+    try:
+        key = _key(job.id)
+        pipe = redis.pipeline(transaction=False)
+        pipe.delete(f"{key}:bytes", f"{key}:rates")
+        pipe.set(key, json.dumps({"status": job.status, "bytes_total": job.bytes_total or 0, "bytes_sent": base,
+                                  "rate": 0, "chunked": True, "base": base, "ts": time.time()}),
+                 ex=settings.PROGRESS_TTL)
+        pipe.execute()
+    except Exception:
+        pass
+
+def snapshot(status: str, bytes_total: int, bytes_sent: int, rate: float) -> dict:
+    remaining = max(0, (bytes_total or 0) - (bytes_sent or 0))
+    eta = round(remaining / rate) if rate > 0 and status not in FINAL_STATUSES else None
+    return {"status": status, "bytes_total": bytes_total, "bytes_sent": bytes_sent,
+            "throughput": round(rate), "eta_seconds": eta}
+
+def read_progress(job_id: int) -> Optional[dict]:
+    """Latest live progress from Redis, or None when not available."""
+    redis = get_redis()
+    if redis is None:
+        return None
+    raw = redis.get(_key(job_id))
+    if not raw:
+        return None
+    data = json.loads(raw)
+    if data.get("chunked"):
+        key = _key(job_id)
+        counted = int(redis.get(f"{key}:bytes") or 0)
+        rate = sum(int(r) for r in redis.hvals(f"{key}:rates"))
+        return snapshot(data["status"], data["bytes_total"], data["base"] + counted, rate)
+    return snapshot(data["status"], data["bytes_total"], data["bytes_sent"], data["rate"])
@@ -0,0 +1,251 @@
+import asyncio, random, time
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Dict, Optional
+from urllib.parse import urlsplit
+import httpx
+from .config import settings
+from .metrics import MOODLE_TTFB, MOODLE_ERRORS
+from .redis_conn import get_redis
+
+RETRY_STATUSES = {429, 502, 503, 504}
+BACKOFF_STATUSES = {429, 500, 502, 503, 504}
+
+# Token bucket shared by every process talking to one Moodle. Tokens may go negative:
+# the caller is told how long to sleep for the token it just reserved.
+_BUCKET_LUA = """
+local rate = tonumber(ARGV[1]); local burst = tonumber(ARGV[2]); local now = tonumber(ARGV[3])
+local s = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(s[1]) or burst
+local ts = tonumber(s[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate) - 1
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], 3600)
+if tokens >= 0 then return '0' end
+return tostring(-tokens / rate)
+"""
+
+# AIMD concurrency window and Retry-After deadline shared across processes. Decreases are
+# ignored for a cooldown so several processes seeing the same overload halve only once.
+_AIMD_LUA = """
+local now = tonumber(ARGV[2])
+local s = redis.call('HMGET', KEYS[1], 'limit', 'dec_at', 'blocked')
+local limit = tonumber(s[1]) or tonumber(ARGV[4])
+local dec_at = tonumber(s[2]) or 0
+local blocked = tonumber(s[3]) or 0
+if ARGV[1] == 'inc' then
+  limit = math.min(tonumber(ARGV[6]), limit + tonumber(ARGV[3]))
+elseif ARGV[1] == 'dec' and now - dec_at >= tonumber(ARGV[7]) then
+  limit = math.max(tonumber(ARGV[5]), limit * tonumber(ARGV[3]))
+  dec_at = now
+end
+blocked = math.max(blocked, tonumber(ARGV[8]))
+redis.call('HSET', KEYS[1], 'limit', tostring(limit), 'dec_at', tostring(dec_at), 'blocked', tostring(blocked))
+redis.call('EXPIRE', KEYS[1], 3600)
+return {tostring(limit), tostring(blocked)}
+"""
+
+def host_key(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+def retry_after_seconds(r: httpx.Response) -> float:
+    value = r.headers.get("retry-after")
+    if not value:
+        return 0.0
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return 0.0
+
+def backoff_delay(attempt: int) -> float:
+    # Full jitter: uniform in [0, base * 2^attempt], capped
+    return random.uniform(0, min(settings.MOODLE_BACKOFF_MAX, settings.MOODLE_BACKOFF_BASE * (2 ** attempt)))
+
+class HostLimiter:
+    """Token bucket plus AIMD concurrency window for one Moodle host."""
+
+    def __init__(self, host: str):
+        self.host = host
+        self.limit = float(settings.MOODLE_CONCURRENCY_START)
+        self.inflight = 0
+        self.blocked_until = 0.0  # epoch seconds, from Retry-After
+        self.tokens = float(settings.MOODLE_RATE_BURST)
+        self.tokens_at = time.monotonic()
+        self.baseline: Optional[float] = None  # lowest recent latency, drifts up slowly
+        self.last_decrease = 0.0
+        self.pending_increase = 0.0
+        self.synced_at = 0.0
+        self.cond = asyncio.Condition()
+        self._notifier: Optional[asyncio.Future] = None
+
+    # --- shared state -------------------------------------------------------
+    def _aimd(self, op: str, amount: float, blocked: float = 0.0):
+        redis = get_redis()
+        if redis is None:
+            return None
+        res = redis.eval(_AIMD_LUA, 1, f"ratelimit:{self.host}:aimd", op, time.time(), amount,
+                         settings.MOODLE_CONCURRENCY_START, settings.MOODLE_CONCURRENCY_MIN,
+                         settings.MOODLE_CONCURRENCY_MAX, settings.MOODLE_DECREASE_COOLDOWN, blocked)
+        return float(res[0]), float(res[1])
+
+    async def _sync(self, op: str = "get", amount: float = 0.0, blocked: float = 0.0):
+        try:
+            res = await asyncio.to_thread(self._aimd, op, amount, blocked)
+        except Exception:
+            return  # Redis trouble must not stop transfers; keep the local view
+        if res:
+            self.limit, shared_blocked = res
+            self.blocked_until = max(self.blocked_until, shared_blocked)
+        self.synced_at = time.monotonic()
+
+    async def _take_token(self) -> float:
+        redis = get_redis()
+        if redis is not None:
+            try:
+                wait = await asyncio.to_thread(redis.eval, _BUCKET_LUA, 1, f"ratelimit:{self.host}:bucket",
+                                               settings.MOODLE_RATE_PER_SEC, settings.MOODLE_RATE_BURST, time.time())
+                return float(wait)
+            except Exception:
+                pass
+        now = time.monotonic()
+        self.tokens = min(settings.MOODLE_RATE_BURST, self.tokens + (now - self.tokens_at) * settings.MOODLE_RATE_PER_SEC) - 1
+        self.tokens_at = now
+        return 0.0 if self.tokens >= 0 else -self.tokens / settings.MOODLE_RATE_PER_SEC
+
+    # --- slots -------------------------------------------------------------
+    async def acquire(self):
+        if time.monotonic() - self.synced_at >= settings.MOODLE_LIMIT_SYNC_SECONDS:
+            amount, self.pending_increase = self.pending_increase, 0.0
+            await self._sync("inc" if amount else "get", amount)
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.inflight < max(1, int(self.limit)))
+            self.inflight += 1
+        try:
+            delay = max(await self._take_token(), self.blocked_until - time.time())
+            if delay > 0:
+                await asyncio.sleep(delay)
+        except BaseException:
+            # Cancelled before the caller got the slot, so Slot.__aexit__ won't release it: give it back here.
+            # The wake-up runs as its own task so a second cancel can't swallow it
+            self.inflight -= 1
+            self._notifier = asyncio.ensure_future(self._notify())
+            raise
+
+    async def _notify(self):
+        async with self.cond:
+            self.cond.notify_all()
+
+    async def release(self, status: Optional[int], latency: Optional[float], retry_after: float = 0.0):
+        async with self.cond:
+            self.inflight -= 1
+            self.cond.notify_all()
+        if status == 0:
+            return
+        overloaded = status is None or status in BACKOFF_STATUSES
+        if latency is not None and not overloaded:
+            if self.baseline is None or latency < self.baseline:
+                self.baseline = latency
+            else:
+                self.baseline *= 1.01
+            overloaded = (latency > self.baseline * settings.MOODLE_LATENCY_TOLERANCE
+                          and latency > settings.MOODLE_LATENCY_FLOOR)
+        if overloaded:
+            await self._decrease(0.5 if status in (429, 503) or status is None else 0.8, retry_after)
+        else:
+            # Additive increase: about +1 per window's worth of successful requests
+            inc = 1.0 / max(1.0, self.limit)
+            self.limit = min(settings.MOODLE_CONCURRENCY_MAX, self.limit + inc)
+            self.pending_increase += inc
+
+    async def _decrease(self, factor: float, retry_after: float):
+        now = time.monotonic()
+        blocked = time.time() + retry_after if retry_after else 0.0
+        self.blocked_until = max(self.blocked_until, blocked)
+        self.pending_increase = 0.0
+        if now - self.last_decrease >= settings.MOODLE_DECREASE_COOLDOWN:
+            self.last_decrease = now
+            self.limit = max(settings.MOODLE_CONCURRENCY_MIN, self.limit * factor)
+            await self._sync("dec", factor, blocked)
+        elif blocked:
+            await self._sync("get", 0.0, blocked)
+
+    def slot(self, measure_latency: bool = True) -> "Slot":
+        return Slot(self, measure_latency)
+
+class Slot:
+    """Holds one concurrency slot; call done() with the response status before leaving."""
+
+    def __init__(self, limiter: HostLimiter, measure_latency: bool):
+        self.limiter = limiter
+        self.measure_latency = measure_latency
+        self.status: Optional[int] = None
+        self.latency: Optional[float] = None
+        self.retry_after = 0.0
+
+    def done(self, r: httpx.Response):
+        self.status = r.status_code
+        self.retry_after = retry_after_seconds(r)
+        if self.measure_latency:
+            self.latency = time.monotonic() - self.started
+
+    async def __aenter__(self):
+        await self.limiter.acquire()
+        self.started = time.monotonic()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is not None and self.status is None and not issubclass(exc_type, httpx.TransportError):
+            # Our own error (or cancellation), not a sign of server overload
+            self.status = 0
+        await self.limiter.release(self.status, self.latency, self.retry_after)
+
+_limiters: Dict[str, HostLimiter] = {}
+_limiters_loop: Optional[asyncio.AbstractEventLoop] = None
+
+def limiter_for(url: str) -> HostLimiter:
+    global _limiters_loop
+    loop = asyncio.get_running_loop()
+    if loop is not _limiters_loop:
+        _limiters.clear()
+        _limiters_loop = loop
+    host = host_key(url)
+    lim = _limiters.get(host)
+    if lim is None:
+        lim = _limiters[host] = HostLimiter(host)
+    return lim
+
+async def send_with_retry(client: httpx.AsyncClient, method: str, url: str, measure_latency: bool = True,
+                          read: Optional[Callable[[httpx.Response], Awaitable[None]]] = None,
+                          **kwargs) -> httpx.Response:
+    """Send through the host's limiter, retrying 429/5xx and transport errors with jittered backoff.
+
+    read, if given, consumes each attempt's body (e.g. into a caller's buffer) instead of r.aread().
+    """
+    lim = limiter_for(url)
+    attempts = settings.MOODLE_MAX_RETRIES + 1
+    for attempt in range(attempts):
+        last = attempt == attempts - 1
+        async with lim.slot(measure_latency) as slot:
+            try:
+                started = time.monotonic()
+                r = await client.send(client.build_request(method, url, **kwargs), stream=True)
+                MOODLE_TTFB.labels(lim.host, method).observe(time.monotonic() - started)
+                try:
+                    await (read or httpx.Response.aread)(r)
+                finally:
+                    await r.aclose()
+            except httpx.TransportError:
+                MOODLE_ERRORS.labels(lim.host, "transport").inc()
+                if last:
+                    raise
+                r = None
+            else:
+                slot.done(r)
+                if r.status_code >= 400:
+                    MOODLE_ERRORS.labels(lim.host, str(r.status_code)).inc()
+        if r is not None and (r.status_code not in RETRY_STATUSES or last):
+            return r
+        await asyncio.sleep(max(slot.retry_after, backoff_delay(attempt)))
@@ -0,0 +1,22 @@
+from typing import Dict, Optional
+from redis import Redis
+from rq import Queue
+from .config import settings
+
+_redis: Optional[Redis] = None
+
+def get_redis() -> Optional[Redis]:
+    """Process-wide Redis connection pool, or None when REDIS_URL is not configured."""
+    global _redis
+    if _redis is None and settings.REDIS_URL:
+        _redis = Redis.from_url(settings.REDIS_URL)
+    return _redis
+
+_queues: Dict[str, Queue] = {}
+
+def get_queue(name: str = "transfers") -> Queue:
+    """RQ queue on the shared connection, built once per process."""
+    q = _queues.get(name)
+    if q is None:
+        q = _queues[name] = Queue(name, connection=get_redis(), default_timeout=settings.TRANSFER_JOB_TIMEOUT)
+    return q
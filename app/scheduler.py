@@ -0,0 +1,291 @@
+import asyncio, threading, time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from rq.job import Job
+from .config import settings
+from .db import SessionLocal
+from .models import TransferJob, TransferFile, TransferEvent
+from .redis_conn import get_queue, get_redis
+from .progress import publish_status, FINAL_STATUSES
+from .chunks import aggregate_parent
+
+# Jobs are not put on the RQ queue when they are created. They wait in the DB as queued with no dispatched_at,
+# and dispatch() hands them to RQ only while there is capacity (SCHED_MAX_ACTIVE_JOBS overall,
+# SCHED_ISSUER_MAX_ACTIVE_MB of remaining bytes per issuer), in fair order:
+#   priority class (interactive weighted SCHED_INTERACTIVE_WEIGHT : 1 bulk) -> issuer -> requester_sub,
+# each level shared by bytes with start-time fair queueing (byte-weighted round robin whose state is one tag
+# per flow). A flow's tag is where its next job starts in "virtual bytes"; the lowest tag goes next, and a
+# flow that was idle restarts at the current virtual time so it can't bank credit.
+
+INTERACTIVE, BULK = "interactive", "bulk"
+MIN_COST = 1024 * 1024  # so empty and tiny jobs still take their turn
+_TAGS_KEY = "sched:tags"
+_POSITIONS_KEY = "sched:positions"
+_RQ_ENDED = ("failed", "stopped", "canceled")
+
+_local_tags: Dict[str, float] = {}
+_local_positions: Dict[str, str] = {}
+_local_lock = threading.Lock()
+_recovered_at = 0.0
+
+def priority_for(bytes_total: int, requested: str = "auto", whole_course: bool = False) -> str:
+    if requested == BULK or whole_course or bytes_total > settings.SCHED_INTERACTIVE_MB * 1024 * 1024:
+        return BULK
+    return INTERACTIVE
+
+def _weight(cls: str) -> float:
+    return float(settings.SCHED_INTERACTIVE_WEIGHT) if cls == INTERACTIVE else 1.0
+
+def cost(row) -> int:
+    return max(MIN_COST, (row.bytes_total or 0) - (row.bytes_sent or 0))
+
+def load_tags() -> Dict[str, float]:
+    redis = get_redis()
+    if redis is None:
+        return dict(_local_tags)
+    return {k.decode(): float(v) for k, v in redis.hgetall(_TAGS_KEY).items()}
+
+def _save_tags(tags: Dict[str, float]):
+    redis = get_redis()
+    if redis is None:
+        _local_tags.update(tags)
+        return
+    if tags:
+        pipe = redis.pipeline()
+        pipe.hset(_TAGS_KEY, mapping=tags)
+        pipe.expire(_TAGS_KEY, 7 * 86400)
+        pipe.execute()
+
+def _save_positions(pending: List, tags: Dict[str, float]):
+    # Where each job still waiting stands (fair order, ignoring caps) and the bytes ahead of it. Worked out
+    # once per dispatch() so status polls (queue_estimate) don't each scan and order the whole backlog
+    positions: Dict[str, str] = {}
+    ahead = 0
+    for i, row in enumerate(fair_order(pending, dict(tags)), 1):
+        positions[str(row.id)] = f"{i},{ahead}"
+        ahead += cost(row)
+    redis = get_redis()
+    if redis is None:
+        _local_positions.clear()
+        _local_positions.update(positions)
+        return
+    pipe = redis.pipeline()
+    pipe.delete(_POSITIONS_KEY)
+    if positions:
+        pipe.hset(_POSITIONS_KEY, mapping=positions)
+        pipe.expire(_POSITIONS_KEY, 86400)
+    pipe.execute()
+
+def _load_position(job_id: int) -> Optional[Tuple[int, int]]:
+    redis = get_redis()
+    raw = _local_positions.get(str(job_id)) if redis is None else redis.hget(_POSITIONS_KEY, str(job_id))
+    if raw is None:
+        return None
+    position, ahead = (raw.decode() if isinstance(raw, bytes) else raw).split(",")
+    return int(position), int(ahead)
+
+@contextmanager
+def _lock():
+    # One dispatcher at a time across web and worker processes
+    redis = get_redis()
+    if redis is None:
+        with _local_lock:
+            yield
+        return
+    with redis.lock("sched:lock", timeout=60, blocking_timeout=30):
+        yield
+
+def fair_order(pending: Iterable, tags: Dict[str, float], skip=None) -> Iterator:
+    """Yield pending job rows (id order within a requester) in fair order, updating tags as if each was
+    dispatched. skip(row) -> True leaves a row's issuer out for the rest of this pass."""
+    flows: Dict[str, Dict[str, Dict[str, deque]]] = defaultdict(lambda: defaultdict(lambda: defaultdict(deque)))
+    for row in pending:
+        flows[row.priority or INTERACTIVE][row.issuer][row.requester_sub].append(row)
+
+    def head(flow) -> int:
+        while not isinstance(flow, deque):
+            flow = next(iter(flow.values()))
+        return flow[0].id
+
+    def pick(vkey: str, children: Dict[str, object], prefix: str) -> Tuple[str, float]:
+        # Lowest tag first; ties go to the interactive class, then to the flow whose next job is oldest
+        v = tags.get(vkey, 0.0)
+        best = min(children, key=lambda name: (max(tags.get(prefix + name, 0.0), v), name != INTERACTIVE,
+                                                head(children[name])))
+        return best, max(tags.get(prefix + best, 0.0), v)
+
+    while flows:
+        cls, c_start = pick("v:", flows, "c:")
+        issuers = flows[cls]
+        issuer, i_start = pick(f"v:{cls}", issuers, f"i:{cls}:")
+        subs = issuers[issuer]
+        sub, s_start = pick(f"v:{cls}:{issuer}", subs, f"s:{cls}:{issuer}:")
+        row = subs[sub][0]
+        if skip is not None and skip(row):
+            for c in list(flows):
+                flows[c].pop(issuer, None)
+                if not flows[c]:
+                    del flows[c]
+            continue
+        subs[sub].popleft()
+        n = cost(row)
+        tags["v:"], tags[f"c:{cls}"] = c_start, c_start + n / _weight(cls)
+        tags[f"v:{cls}"], tags[f"i:{cls}:{issuer}"] = i_start, i_start + n
+        tags[f"v:{cls}:{issuer}"], tags[f"s:{cls}:{issuer}:{sub}"] = s_start, s_start + n
+        if not subs[sub]:
+            del subs[sub]
+            if not subs:
+                del issuers[issuer]
+                if not issuers:
+                    del flows[cls]
+        yield row
+
+def _pending_query():
+    return (select(TransferJob.id, TransferJob.issuer, TransferJob.requester_sub, TransferJob.priority,
+                   TransferJob.bytes_total, TransferJob.bytes_sent)
+            .where(TransferJob.status == "queued", TransferJob.dispatched_at.is_(None))
+            .order_by(TransferJob.id))
+
+def _active_since() -> datetime:
+    # A dispatched job that outlived the RQ timeout died with its worker; stop counting it
+    return datetime.utcnow() - timedelta(seconds=settings.TRANSFER_JOB_TIMEOUT + 300)
+
+def rq_job_id(job_id: int, dispatched_at: datetime) -> str:
+    # One RQ job per dispatch, so the RQ state of an earlier run of the same job can't be mistaken for this one
+    return f"transfer-{job_id}-{dispatched_at:%Y%m%d%H%M%S%f}"
+
+def _rq_status(jobs: List[TransferJob]) -> Dict[int, Optional[str]]:
+    # RQ status of each job's current run; None once RQ has dropped it (results expire after a while)
+    redis = get_redis()
+    if redis is None or not jobs:
+        return {}
+    found = Job.fetch_many([rq_job_id(j.id, j.dispatched_at) for j in jobs], connection=redis)
+    return {j.id: (r.get_status(refresh=False) if r is not None else None) for j, r in zip(jobs, found)}
+
+def recover_lost(db: Session):
+    """Free the slots of dispatched jobs whose run is over without having said so, and queue runs whose worker
+    was lost (killed, OOM, deploy: no heartbeat, or RQ failed the job) again; they resume from their checkpoints.
+    After TRANSFER_MAX_RESUMES the job is failed instead, for a manual /retry."""
+    stale = datetime.utcnow() - timedelta(seconds=settings.TRANSFER_STALE_SECONDS)
+    active = db.query(TransferJob).filter(TransferJob.dispatched_at.is_not(None)).all()
+    rq = _rq_status(active)
+    lost = []
+    for job in active:
+        state = rq.get(job.id, "")
+        if job.status in FINAL_STATUSES or (job.status == "running" and state == "finished"):
+            job.dispatched_at = None  # ended, but finished() never ran
+        elif job.status == "queued":
+            if state is None or state in _RQ_ENDED:
+                job.dispatched_at = None  # RQ lost it before it started: dispatch it again
+        elif job.status == "running" and (job.updated_at < stale or state in _RQ_ENDED):
+            # A missing RQ job alone proves nothing here: jobs dispatched before rq_job_id() have other ids
+            lost.append(job)
+    for job in lost:
+        give_up = (job.resumes or 0) >= settings.TRANSFER_MAX_RESUMES
+        if give_up:
+            job.status = "failed"
+            db.add(TransferEvent(job_id=job.id, level="ERROR",
+                                 message=f"Worker lost {job.resumes + 1} times; giving up"))
+        else:
+            job.status = "queued"; job.resumes = (job.resumes or 0) + 1
+            db.add(TransferEvent(job_id=job.id, level="WARN",
+                                 message="Worker lost; queued to resume"))
+        job.dispatched_at = None; job.updated_at = datetime.utcnow()
+    db.commit()
+    for job in lost:
+        publish_status(job)
+        if job.status == "failed" and job.parent_id:
+            aggregate_parent(db, job.parent_id)
+
+def dispatch() -> int:
+    """Hand as many waiting jobs to RQ as capacity allows, fairest first. Returns how many were sent."""
+    global _recovered_at
+    with _lock():
+        db = SessionLocal()
+        try:
+            if time.monotonic() - _recovered_at >= settings.TRANSFER_HEARTBEAT_SECONDS:
+                _recovered_at = time.monotonic()
+                recover_lost(db)
+            rows = db.execute(select(TransferJob.issuer, func.count(),
+                                     func.sum(TransferJob.bytes_total - TransferJob.bytes_sent))
+                              .where(TransferJob.dispatched_at >= _active_since())
+                              .group_by(TransferJob.issuer)).all()
+            active_jobs = {issuer: n for issuer, n, _ in rows}
+            active_bytes = {issuer: max(0, int(b or 0)) for issuer, _, b in rows}
+            free = None
+            if settings.SCHED_MAX_ACTIVE_JOBS > 0:
+                free = settings.SCHED_MAX_ACTIVE_JOBS - sum(active_jobs.values())
+            cap = settings.SCHED_ISSUER_MAX_ACTIVE_MB * 1024 * 1024
+
+            def over_cap(row) -> bool:
+                # An issuer with nothing running may always start one job, however big
+                return bool(cap and active_jobs.get(row.issuer)
+                            and active_bytes.get(row.issuer, 0) + cost(row) > cap)
+
+            tags = load_tags()
+            pending = db.execute(_pending_query()).all()
+            picked: List[int] = []
+            if free is None or free > 0:
+                for row in fair_order(pending, tags, skip=over_cap):
+                    picked.append(row.id)
+                    active_jobs[row.issuer] = active_jobs.get(row.issuer, 0) + 1
+                    active_bytes[row.issuer] = active_bytes.get(row.issuer, 0) + cost(row)
+                    if free is not None and len(picked) >= free:
+                        break
+            if picked:
+                now = datetime.utcnow()
+                db.execute(update(TransferJob).where(TransferJob.id.in_(picked), TransferJob.dispatched_at.is_(None))
+                           .values(dispatched_at=now))
+                db.commit()
+                q = get_queue()
+                for i, job_id in enumerate(picked):
+                    try:
+                        q.enqueue("app.jobs.perform_transfer", job_id, job_id=rq_job_id(job_id, now))
+                    except Exception:
+                        # Not on the queue after all: let the next dispatch() pick these up again. The tags are
+                        # left as they were, so the few that did go out aren't charged to their flows this once
+                        db.execute(update(TransferJob).where(TransferJob.id.in_(picked[i:]))
+                                   .values(dispatched_at=None))
+                        db.commit()
+                        raise
+                # fair_order stopped at the last job taken, so the tags cover exactly what was dispatched here
+                _save_tags(tags)
+            taken = set(picked)
+            _save_positions([row for row in pending if row.id not in taken], tags)
+        finally:
+            db.close()
+    return len(picked)
+
+def finished(job_id: int):
+    """The job's run is over (or it handed its work to chunk jobs): free its slot and dispatch more."""
+    db = SessionLocal()
+    try:
+        db.execute(update(TransferJob).where(TransferJob.id == job_id).values(dispatched_at=None))
+        db.commit()
+    finally:
+        db.close()
+    dispatch()
+
+async def queue_estimate(db: AsyncSession, job: TransferJob) -> Optional[dict]:
+    """Position among all waiting jobs (fair order, ignoring caps) as of the last dispatch(), and a start
+    estimate from recent throughput."""
+    if job.status != "queued" or job.dispatched_at is not None:
+        return None
+    found = await asyncio.to_thread(_load_position, job.id)
+    if found is None:
+        return None
+    position, ahead = found
+    active = await db.scalar(select(func.sum(TransferJob.bytes_total - TransferJob.bytes_sent))
+                             .where(TransferJob.dispatched_at >= _active_since()))
+    window = settings.SCHED_RATE_WINDOW
+    done = await db.scalar(select(func.sum(TransferFile.filesize))
+                           .where(TransferFile.status == "completed",
+                                  TransferFile.updated_at >= datetime.utcnow() - timedelta(seconds=window)))
+    rate = (done or 0) / window
+    eta = round((ahead + max(0, int(active or 0))) / rate) if rate else None
+    return {"queue_position": position, "bytes_ahead": ahead, "estimated_start_seconds": eta}
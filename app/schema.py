@@ -0,0 +1,95 @@
+import json, sys
+from datetime import datetime
+from sqlalchemy import BigInteger, Integer, inspect, insert, select, table, column, text, update
+from sqlalchemy.engine import Connection
+from .models import Base, TransferJob, TransferFile
+
+# create_all() only creates missing tables. This brings tables created by earlier versions up to the models:
+# missing columns and indexes are added, integer byte counters widened, and the old transfer_jobs.files
+# JSON list moved into transfer_files. Each step checks the live schema first, so it is safe to run on
+# every startup.
+
+_LEGACY_STATUSES = {"pending", "completed", "failed", "skipped"}
+
+def _q(conn: Connection, name: str) -> str:
+    return conn.dialect.identifier_preparer.quote(name)
+
+def _add_columns(conn: Connection, existing: dict) -> set:
+    added = set()
+    for t in Base.metadata.sorted_tables:
+        have = existing.get(t.name)
+        if have is None:
+            continue
+        for col in t.columns:
+            if col.name in have:
+                continue
+            # Added nullable: existing rows get the model's default below, new ones get it from the ORM
+            conn.execute(text(f"ALTER TABLE {_q(conn, t.name)} ADD COLUMN {_q(conn, col.name)} "
+                              f"{col.type.compile(dialect=conn.dialect)}"))
+            if col.default is not None and col.default.is_scalar:
+                conn.execute(update(t).where(col.is_(None)).values({col.name: col.default.arg}))
+            added.add((t.name, col.name))
+            print(f"[INFO] schema: added {t.name}.{col.name}", file=sys.stderr)
+    return added
+
+def _widen_integers(conn: Connection, existing: dict):
+    if conn.dialect.name == "sqlite":
+        return  # SQLite integers are 64-bit already
+    for t in Base.metadata.sorted_tables:
+        for col in t.columns:
+            live = existing.get(t.name, {}).get(col.name, {}).get("type")
+            if (isinstance(col.type, BigInteger) and live is not None
+                    and isinstance(live, Integer) and not isinstance(live, BigInteger)):
+                conn.execute(text(f"ALTER TABLE {_q(conn, t.name)} "
+                                  f"ALTER COLUMN {_q(conn, col.name)} TYPE BIGINT"))
+                print(f"[INFO] schema: widened {t.name}.{col.name} to BIGINT", file=sys.stderr)
+
+def _move_legacy_files(conn: Connection, existing: dict):
+    old = existing.get("transfer_jobs", {}).get("files")
+    if old is None or old["nullable"]:
+        return  # never there, or already moved
+    legacy = table("transfer_jobs", column("id"), column("files"))
+    jobs = TransferJob.__table__
+    files = TransferFile.__table__
+    migrated = select(files.c.job_id).distinct()
+    for job_id, entries in conn.execute(select(legacy.c.id, legacy.c.files)
+                                        .where(legacy.c.files.is_not(None), legacy.c.id.not_in(migrated))):
+        if isinstance(entries, str):
+            entries = json.loads(entries)
+        rows = []
+        for f in entries or []:
+            status = f.get("status") if f.get("status") in _LEGACY_STATUSES else "pending"
+            size = f.get("filesize") or 0
+            rows.append({"job_id": job_id, "filename": f.get("filename") or "", "fileurl": f.get("fileurl") or "",
+                         "filesize": size, "timemodified": f.get("timemodified"), "status": status,
+                         "bytes_done": size if status == "completed" else 0, "attempts": 0,
+                         "error": f.get("error"), "blob_name": "", "updated_at": datetime.utcnow()})
+        if rows:
+            conn.execute(insert(files), rows)
+        conn.execute(update(jobs).where(jobs.c.id == job_id).values(files_total=len(rows)))
+    # The ORM no longer writes the column, so it must accept NULL. Postgres keeps the old lists; SQLite
+    # can't relax NOT NULL in place, so there the column goes
+    if conn.dialect.name == "sqlite":
+        conn.execute(text("ALTER TABLE transfer_jobs DROP COLUMN files"))
+    else:
+        conn.execute(text("ALTER TABLE transfer_jobs ALTER COLUMN files DROP NOT NULL"))
+    print("[INFO] schema: moved transfer_jobs.files into transfer_files", file=sys.stderr)
+
+def _create_indexes(conn: Connection):
+    for t in Base.metadata.sorted_tables:
+        for index in t.indexes:
+            index.create(conn, checkfirst=True)
+
+def upgrade(conn: Connection):
+    insp = inspect(conn)
+    existing = {name: {c["name"]: c for c in insp.get_columns(name)} for name in insp.get_table_names()}
+    Base.metadata.create_all(bind=conn)
+    added = _add_columns(conn, existing)
+    if ("transfer_jobs", "dispatched_at") in added:
+        # Jobs from before the scheduler were put on RQ when created: don't dispatch them a second time
+        jobs = TransferJob.__table__
+        conn.execute(update(jobs).where(jobs.c.status.in_(("queued", "running")))
+                     .values(dispatched_at=datetime.utcnow()))
+    _widen_integers(conn, existing)
+    _move_legacy_files(conn, existing)
+    _create_indexes(conn)
@@ -1,7 +1,18 @@
 from pydantic import BaseModel
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Literal, Optional
 
 class CreateTransfer(BaseModel):
     course_id: int
-    files: List[Dict[str, Any]]
+    files: List[Dict[str, Any]] = []  # in sync mode, empty means the whole course
     destination_path_prefix: str = ""
+    mode: Literal["copy", "sync", "archive"] = "copy"
+    archive_format: Literal["zip", "tar"] = "zip"  # archive mode: every file in one blob
+    priority: Literal["auto", "bulk"] = "auto"  # auto: interactive up to SCHED_INTERACTIVE_MB
+
+class BulkTransfer(BaseModel):
+    course_ids: List[int] = []
+    category_id: Optional[int] = None  # every course in this Moodle category
+    destination_path_prefix: str = ""
+    mode: Literal["copy", "sync", "archive"] = "copy"
+    archive_format: Literal["zip", "tar"] = "zip"  # archive mode: every file in one blob
+    priority: Literal["auto", "bulk"] = "auto"  # auto: interactive up to SCHED_INTERACTIVE_MB
@@ -0,0 +1,42 @@
+from datetime import datetime
+from typing import Dict, List
+from sqlalchemy.orm import Session
+from .models import SyncManifestEntry
+
+def load_manifest(db: Session, issuer: str, course_id: str) -> Dict[str, SyncManifestEntry]:
+    rows = db.query(SyncManifestEntry).filter_by(issuer=issuer, course_id=course_id).all()
+    return {r.fileurl: r for r in rows}
+
+def is_unchanged(entry: SyncManifestEntry, f: dict, blob_name: str) -> bool:
+    # Moodle bumps timemodified on every replace; size catches edits that keep the old mtime
+    return (entry is not None
+            and entry.blob_name == blob_name
+            and entry.filesize == (f.get("filesize") or 0)
+            and entry.timemodified == f.get("timemodified"))
+
+def record_synced(db: Session, manifest: Dict[str, SyncManifestEntry], issuer: str, course_id: str,
+                  f: dict, blob_name: str, commit: bool = True):
+    entry = manifest.get(f["fileurl"])
+    if not entry:
+        entry = SyncManifestEntry(issuer=issuer, course_id=course_id, fileurl=f["fileurl"])
+        db.add(entry); manifest[f["fileurl"]] = entry
+    entry.filename = f.get("filename") or ""
+    entry.filesize = f.get("filesize") or 0
+    entry.timemodified = f.get("timemodified")
+    entry.blob_name = blob_name
+    entry.synced_at = datetime.utcnow()
+    if commit:
+        db.commit()
+
+def pop_deleted(db: Session, manifest: Dict[str, SyncManifestEntry], listing: List[dict]) -> List[dict]:
+    """Drop manifest entries for files no longer in the course listing and return them.
+
+    The copied blobs are left in place; the caller reports them so an operator can decide.
+    """
+    present = {f["fileurl"] for f in listing}
+    gone = [e for url, e in manifest.items() if url not in present]
+    for e in gone:
+        db.delete(e); manifest.pop(e.fileurl, None)
+    if gone:
+        db.commit()
+    return [{"filename": e.filename, "fileurl": e.fileurl, "blob_name": e.blob_name} for e in gone]
@@ -0,0 +1,76 @@
+import asyncio, time
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+from fastapi import HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+from .config import settings
+from .db import AsyncSessionLocal
+from .models import Platform, UserToken
+from .platforms import get_user_token, set_user_token
+from .moodle_oauth import refresh_access_token
+from .metrics import TOKEN_REFRESH
+from .ratelimit import host_key
+from .redis_conn import get_redis
+
+@dataclass(frozen=True)
+class CachedToken:
+    access_token: str
+    expires_at: float  # epoch seconds
+    cached_at: float
+
+# Short-lived per-process cache keyed by (issuer, user_sub); the DB stays the source of truth
+_tokens: Dict[Tuple[str, str], CachedToken] = {}
+_locks: Dict[Tuple[str, str], asyncio.Lock] = {}
+
+def _usable(tok: Optional[CachedToken], now: float) -> bool:
+    return (tok is not None
+            and now - tok.cached_at < settings.TOKEN_CACHE_TTL
+            and tok.expires_at - now > settings.TOKEN_REFRESH_AHEAD)
+
+def _cached(ut: UserToken) -> CachedToken:
+    return CachedToken(ut.access_token, ut.expires_at.timestamp(), time.time())
+
+def invalidate_token(issuer: str, user_sub: str):
+    _tokens.pop((issuer, user_sub), None)
+
+async def _refresh(db: AsyncSession, platform: Platform, user_sub: str, ut: UserToken) -> UserToken:
+    redis = get_redis()
+    lock = None
+    if redis is not None:
+        # Only one worker refreshes: Moodle may rotate the refresh token, so racing refreshes invalidate each other
+        lock = redis.lock(f"moodle-token-refresh:{platform.issuer}:{user_sub}",
+                          timeout=settings.TOKEN_REFRESH_LOCK_SECONDS,
+                          blocking_timeout=settings.TOKEN_REFRESH_LOCK_SECONDS)
+        await asyncio.to_thread(lock.acquire)
+    try:
+        await db.refresh(ut)  # another process may have refreshed while we waited
+        if ut.expires_at.timestamp() - time.time() > settings.TOKEN_REFRESH_AHEAD:
+            return ut
+        with TOKEN_REFRESH.labels(host_key(platform.issuer)).time():
+            res = await refresh_access_token(platform, ut.refresh_token)
+        return await set_user_token(db, platform.issuer, user_sub, res.get("access_token"),
+                              res.get("refresh_token") or ut.refresh_token, res.get("expires_in", 3600))
+    finally:
+        if lock is not None and lock.owned():
+            await asyncio.to_thread(lock.release)
+
+async def get_access_token(platform: Platform, user_sub: str) -> str:
+    """Access token for (issuer, user), refreshed ahead of expiry with one refresh per key at a time.
+
+    Uses its own async session, so callers (handlers and the worker alike) needn't share theirs.
+    """
+    key = (platform.issuer, user_sub)
+    if _usable(_tokens.get(key), time.time()):
+        return _tokens[key].access_token
+    async with _locks.setdefault(key, asyncio.Lock()):
+        tok = _tokens.get(key)
+        if _usable(tok, time.time()):
+            return tok.access_token
+        async with AsyncSessionLocal() as db:
+            ut = await get_user_token(db, platform.issuer, user_sub)
+            if not ut:
+                raise HTTPException(status_code=401, detail="No Moodle OAuth token. Start authorisation.")
+            if ut.expires_at.timestamp() - time.time() <= settings.TOKEN_REFRESH_AHEAD:
+                ut = await _refresh(db, platform, user_sub, ut)
+        tok = _tokens[key] = _cached(ut)
+        return tok.access_token
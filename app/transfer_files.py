@@ -0,0 +1,61 @@
+from datetime import datetime
+from typing import Dict, Iterator, List, Tuple
+from sqlalchemy import and_, bindparam, func, select, update
+from sqlalchemy.orm import Session
+from .models import TransferJob, TransferFile
+
+DONE = ("completed", "skipped")
+BATCH = 500  # rows loaded per query when walking a job's files
+
+_t = TransferFile.__table__
+# One executemany per flush; attempts is bumped in SQL so the worker never has to read it
+UPDATE_FILE = (update(_t).where(_t.c.id == bindparam("b_id"))
+               .values(status=bindparam("b_status"), bytes_done=bindparam("b_bytes"), blob_name=bindparam("b_blob"),
+                       error=bindparam("b_error"), attempts=_t.c.attempts + 1, updated_at=bindparam("b_at")))
+
+def file_rows(job_id: int, files: List[dict]) -> List[dict]:
+    """Insert parameters for a job's selected files, one row per distinct fileurl."""
+    unique = {f["fileurl"]: f for f in files}
+    return [{"job_id": job_id, "filename": f["filename"], "fileurl": url, "filesize": f.get("filesize") or 0,
+             "timemodified": f.get("timemodified")} for url, f in unique.items()]
+
+def of_job(job: TransferJob):
+    # A chunk job owns the parent's rows assigned to it; any other job owns its own rows
+    return TransferFile.chunk_id == job.id if job.parent_id else TransferFile.job_id == job.id
+
+def snapshot(row) -> dict:
+    return {"id": row.id, "filename": row.filename, "fileurl": row.fileurl, "filesize": row.filesize or 0,
+            "timemodified": row.timemodified}
+
+def iter_pending(db: Session, job: TransferJob, batch: int = BATCH, done: bool = False) -> Iterator[dict]:
+    """Files of the job still to copy (every file with done=True), in id order, loaded BATCH rows at a time
+    (keyset, not OFFSET)."""
+    where = of_job(job)
+    if not done:
+        where = and_(where, TransferFile.status.not_in(DONE))
+    last = 0
+    while True:
+        rows = db.execute(select(TransferFile.id, TransferFile.filename, TransferFile.fileurl, TransferFile.filesize,
+                                 TransferFile.timemodified)
+                          .where(where, TransferFile.id > last)
+                          .order_by(TransferFile.id).limit(batch)).all()
+        if not rows:
+            return
+        for r in rows:
+            yield snapshot(r)
+        last = rows[-1].id
+
+def counts(db: Session, job: TransferJob) -> Dict[str, Tuple[int, int]]:
+    """(files, bytes) per file status."""
+    rows = db.execute(select(TransferFile.status, func.count(), func.sum(TransferFile.filesize))
+                      .where(of_job(job)).group_by(TransferFile.status)).all()
+    return {status: (n, int(size or 0)) for status, n, size in rows}
+
+def mark_skipped(db: Session, ids: List[int]):
+    if ids:
+        db.execute(update(TransferFile).where(TransferFile.id.in_(ids))
+                   .values(status="skipped", error=None, updated_at=datetime.utcnow()))
+
+def failed_names(db: Session, job: TransferJob, limit: int = 100) -> List[str]:
+    return list(db.scalars(select(TransferFile.filename).where(of_job(job), TransferFile.status == "failed")
+                           .order_by(TransferFile.id).limit(limit)))
@@ -1,10 +1,28 @@
 from rq import Connection, Worker, Queue
 from redis import Redis
-import os
+import asyncio, os
+from .config import settings
 
 listen = ['transfers']
 
 def run_worker():
+    if settings.WORKER_METRICS_PORT:
+        from .metrics import serve
+        serve(settings.WORKER_METRICS_PORT)
+    try:
+        # Jobs created while no worker could take them, or freed by a worker that died, get dispatched now
+        from .scheduler import dispatch
+        dispatch()
+    except Exception as e:
+        print(f"[WARN] initial dispatch failed: {e}")
+    finally:
+        # RQ forks a child per job: don't let them inherit the connection that dispatch pooled here
+        from .db import engine
+        engine.dispose()
+    if settings.WORKER_MODE == "async":
+        from .async_worker import AsyncWorker
+        asyncio.run(AsyncWorker(listen, settings.WORKER_JOB_CONCURRENCY).run())
+        return
     redis = Redis.from_url(os.getenv("REDIS_URL"))
     with Connection(redis):
         worker = Worker(map(Queue, listen))
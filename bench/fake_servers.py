@@ -0,0 +1,275 @@
+"""Local stand-ins for Moodle and Azure Blob Storage, used by the benchmark harness.
+
+Both are plain stdlib HTTP servers, so benchmarks run with no network access. File bodies are
+generated on the fly (never held in memory) and the blob endpoint counts staged bytes without
+keeping them. The blob endpoint also serves server-side copies (Put Block From URL, Copy Blob) by
+fetching the source itself, the way Azure would.
+"""
+import json, re, threading, time, urllib.request, uuid
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+from urllib.parse import parse_qs, urlsplit
+from xml.etree import ElementTree
+
+_PATTERN = bytes(range(256)) * 256  # 64 KB of file content, repeated
+
+@dataclass
+class MoodleConfig:
+    files: int = 20
+    file_size: int = 8 * 1024 * 1024
+    latency: float = 0.0  # seconds before every response
+    bandwidth: float = 0.0  # bytes/s per download connection, 0 = unthrottled
+    ranges: bool = True  # honour Range requests (Accept-Ranges: bytes)
+    jwks: dict = field(default_factory=lambda: {"keys": []})
+    jwks_max_age: int = 300
+    blob_can_reach: bool = True  # the fake Blob endpoint can fetch from the fake Moodle (server-side copy)
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self) -> bytes:
+        n = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(n) if n else b""
+
+    def _send(self, status: int, body: bytes = b"", headers: Optional[Dict[str, str]] = None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body and self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _json(self, obj, headers: Optional[Dict[str, str]] = None):
+        self._send(200, json.dumps(obj).encode(), {"Content-Type": "application/json", **(headers or {})})
+
+class MoodleHandler(_Handler):
+    cfg: MoodleConfig
+
+    def do_POST(self):
+        time.sleep(self.cfg.latency)
+        path = urlsplit(self.path).path
+        form = {k: v[0] for k, v in parse_qs(self._body().decode()).items()}
+        if path == "/oauth2/token.php":
+            return self._json({"access_token": "bench-access", "refresh_token": "bench-refresh", "expires_in": 3600})
+        if path != "/webservice/rest/server.php":
+            return self._send(404)
+        fn = form.get("wsfunction")
+        if fn == "core_course_get_contents":
+            return self._json([{"id": 1, "name": "Section 1", "modules": [self._module(i) for i in range(self.cfg.files)]}])
+        if fn == "core_course_get_courses_by_field":
+            return self._json({"courses": [{"id": 2, "fullname": "Bench course", "shortname": "bench"}]})
+        self._json({"exception": "invalid_parameter_exception", "message": f"Unknown function {fn}"})
+
+    def _module(self, i: int) -> dict:
+        base = f"http://{self.headers.get('Host')}"
+        return {"id": i, "name": f"Resource {i}", "modname": "resource", "contents": [{
+            "type": "file", "filename": f"file{i:05d}.bin", "filepath": "/", "filesize": self.cfg.file_size,
+            "timemodified": 1700000000, "fileurl": f"{base}/webservice/pluginfile.php/{i}/mod_resource/content/file{i:05d}.bin",
+        }]}
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        time.sleep(self.cfg.latency)
+        path = urlsplit(self.path).path
+        if path == "/mod/lti/certs.php":
+            return self._json(self.cfg.jwks, {"Cache-Control": f"max-age={self.cfg.jwks_max_age}"})
+        if "/pluginfile.php/" not in path:
+            return self._send(404)
+        size = self.cfg.file_size
+        start, end, status = 0, size - 1, 200
+        m = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range") or "")
+        if m and self.cfg.ranges:
+            start = int(m.group(1))
+            end = min(size - 1, int(m.group(2))) if m.group(2) else size - 1
+            if start >= size:
+                return self._send(416, headers={"Content-Range": f"bytes */{size}"})
+            status = 206
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        if self.cfg.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+        self._stream(start, end + 1)
+
+    def _stream(self, start: int, stop: int):
+        step = len(_PATTERN)
+        pos = start
+        t0 = time.monotonic()
+        while pos < stop:
+            off = pos % step
+            chunk = _PATTERN[off:off + min(step - off, stop - pos)]
+            self.wfile.write(chunk)
+            pos += len(chunk)
+            if self.cfg.bandwidth:
+                ahead = (pos - start) / self.cfg.bandwidth - (time.monotonic() - t0)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+class BlobStore:
+    """Block bookkeeping for the fake Blob endpoint: sizes only, no content."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.uncommitted: Dict[str, Dict[str, int]] = {}
+        self.committed: Dict[str, int] = {}
+        self.bytes_received = 0
+        self.bytes_pulled = 0  # fetched from a source URL by a server-side copy
+        self.requests = 0
+        self.copies: Dict[str, dict] = {}  # blob path -> Copy Blob state
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"blobs": len(self.committed), "bytes_committed": sum(self.committed.values()),
+                    "bytes_received": self.bytes_received, "bytes_pulled": self.bytes_pulled,
+                    "requests": self.requests}
+
+class BlobHandler(_Handler):
+    store: BlobStore
+    can_reach: bool = True
+
+    def _pull(self, url: str, rng: Optional[str] = None, on_chunk=None) -> int:
+        if not self.can_reach:
+            raise OSError("source unreachable")
+        req = urllib.request.Request(url, headers={"Range": rng} if rng else {})
+        n = 0
+        with urllib.request.urlopen(req, timeout=30) as r:
+            while chunk := r.read(1 << 16):
+                n += len(chunk)
+                if on_chunk:
+                    on_chunk(len(chunk))
+        with self.store.lock:
+            self.store.bytes_pulled += n
+        return n
+
+    def _copy_blob(self, path: str, source: str):
+        state = self.store.copies[path]
+        def progress(n: int):
+            state["copied"] += n
+        try:
+            size = self._pull(source, on_chunk=progress)
+        except OSError as e:
+            state.update(status="failed", description=f"CannotVerifyCopySource: {e}")
+            return
+        with self.store.lock:
+            self.store.uncommitted.pop(path, None)
+            self.store.committed[path] = size
+        state.update(status="success", total=size)
+
+    def do_HEAD(self):
+        path = urlsplit(self.path).path
+        with self.store.lock:
+            size = self.store.committed.get(path)
+            copy = dict(self.store.copies.get(path) or {})
+        if size is None and not copy:
+            return self._error(404, "BlobNotFound")
+        h = {"x-ms-blob-type": "BlockBlob", **self._ms_headers(etag=True)}
+        if copy:
+            h.update({"x-ms-copy-id": copy["id"], "x-ms-copy-status": copy["status"],
+                      "x-ms-copy-progress": f"{copy['copied']}/{copy.get('total') or copy['copied']}",
+                      "x-ms-copy-source": copy["source"]})
+            if copy.get("description"):
+                h["x-ms-copy-status-description"] = copy["description"]
+        self.send_response(200)
+        for k, v in h.items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(size or 0))
+        self.end_headers()
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        q = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        if parts.path == "/_stats":
+            return self._json(self.store.stats())
+        if q.get("comp") != "blocklist":
+            return self._send(404)
+        with self.store.lock:
+            blocks = dict(self.store.uncommitted.get(parts.path, {}))
+        if not blocks and parts.path not in self.store.committed:
+            return self._error(404, "BlobNotFound")
+        xml = "".join(f"<Block><Name>{k}</Name><Size>{v}</Size></Block>" for k, v in blocks.items())
+        body = (f'<?xml version="1.0" encoding="utf-8"?><BlockList><CommittedBlocks />'
+                f"<UncommittedBlocks>{xml}</UncommittedBlocks></BlockList>").encode()
+        self._send(200, body, {"Content-Type": "application/xml", **self._ms_headers()})
+
+    def do_PUT(self):
+        parts = urlsplit(self.path)
+        q = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        body = self._body()
+        with self.store.lock:
+            self.store.requests += 1
+            self.store.bytes_received += len(body)
+        comp = q.get("comp")
+        source = self.headers.get("x-ms-copy-source")
+        if comp == "block":
+            size = len(body)
+            if source:  # Put Block From URL
+                try:
+                    size = self._pull(source, self.headers.get("x-ms-source-range"))
+                except OSError:
+                    return self._error(403, "CannotVerifyCopySource")
+            with self.store.lock:
+                self.store.uncommitted.setdefault(parts.path, {})[q["blockid"]] = size
+            return self._send(201, headers=self._ms_headers())
+        if comp is None and source:  # Copy Blob: accepted now, completed in the background
+            copy_id = str(uuid.uuid4())
+            with self.store.lock:
+                self.store.copies[parts.path] = {"id": copy_id, "status": "pending", "copied": 0, "source": source}
+            threading.Thread(target=self._copy_blob, args=(parts.path, source), daemon=True).start()
+            return self._send(202, headers={"x-ms-copy-id": copy_id, "x-ms-copy-status": "pending",
+                                            **self._ms_headers(etag=True)})
+        if comp == "copy":  # Abort Copy Blob
+            with self.store.lock:
+                self.store.copies.get(parts.path, {}).update(status="aborted")
+            return self._send(204, headers=self._ms_headers())
+        if comp == "blocklist":
+            ids = [el.text for el in ElementTree.fromstring(body)]
+            with self.store.lock:
+                staged = self.store.uncommitted.pop(parts.path, {})
+                missing = [i for i in ids if i not in staged]
+                if missing:
+                    self.store.uncommitted[parts.path] = staged
+                    return self._error(400, "InvalidBlockList")
+                self.store.committed[parts.path] = sum(staged[i] for i in ids)
+            return self._send(201, headers=self._ms_headers(etag=True))
+        if comp is None and self.headers.get("x-ms-blob-type") == "BlockBlob":
+            with self.store.lock:
+                self.store.uncommitted.pop(parts.path, None)
+                self.store.committed[parts.path] = len(body)
+            return self._send(201, headers=self._ms_headers(etag=True))
+        self._error(400, "UnsupportedQueryParameter")
+
+    def _ms_headers(self, etag: bool = False) -> Dict[str, str]:
+        h = {"x-ms-request-id": "bench", "x-ms-version": "2021-08-06", "x-ms-request-server-encrypted": "true"}
+        if etag:
+            h.update({"ETag": f'"0x{time.monotonic_ns():X}"', "Last-Modified": time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())})
+        return h
+
+    def _error(self, status: int, code: str):
+        body = f'<?xml version="1.0" encoding="utf-8"?><Error><Code>{code}</Code><Message>{code}</Message></Error>'.encode()
+        self._send(status, body, {"Content-Type": "application/xml", "x-ms-error-code": code, **self._ms_headers()})
+
+def _serve(handler) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def serve(cfg: MoodleConfig, ready, stop):
+    """Process entrypoint: start both servers, report (moodle_url, blob_url) on `ready`, run until `stop` is set."""
+    moodle = _serve(type("Moodle", (MoodleHandler,), {"cfg": cfg}))
+    blob = _serve(type("Blob", (BlobHandler,), {"store": BlobStore(), "can_reach": cfg.blob_can_reach}))
+    ready.put((f"http://127.0.0.1:{moodle.server_port}", f"http://127.0.0.1:{blob.server_port}"))
+    stop.wait()
+    moodle.shutdown(); blob.shutdown()
@@ -0,0 +1,184 @@
+"""Offline benchmark: LTI launch validation and an end-to-end Moodle -> Azure transfer against local fakes.
+
+    python -m bench.run --files 20 --file-size-mb 8 --latency-ms 20 --out bench.json
+
+Everything runs on 127.0.0.1. Settings not fixed here (block size, concurrency, rate limits, ...)
+are read from the environment as usual, so the same knobs can be compared between runs.
+"""
+import argparse, asyncio, base64, json, multiprocessing, os, platform, resource, statistics, subprocess, sys, tempfile, time
+import httpx
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwk, jwt
+from .fake_servers import MoodleConfig, serve
+
+ISSUER_SUB = "bench-user"
+KID = "bench-key"
+
+def _percentile(values, pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+def _signing_key():
+    pem = rsa.generate_private_key(public_exponent=65537, key_size=2048).private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()).decode()
+    public = jwk.construct(pem, "RS256").public_key().to_dict()
+    public.update({"kid": KID, "alg": "RS256", "use": "sig"})
+    return pem, public
+
+def _launch_token(pem: str, issuer: str, i: int) -> str:
+    now = int(time.time())
+    claims = {"iss": issuer, "sub": f"{ISSUER_SUB}-{i}", "aud": "bench-client", "iat": now, "exp": now + 600,
+              "nonce": str(i), "https://purl.imsglobal.org/spec/lti/claim/roles":
+                  ["http://purl.imsglobal.org/vocab/lis/v2/membership#Instructor"]}
+    return jwt.encode(claims, pem, algorithm="RS256", headers={"kid": KID})
+
+def _rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB on Linux
+
+def _git_rev() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+async def bench_launch(pem: str, issuer: str, n: int) -> dict:
+    from app.lti import validate_lti_id_token
+    tokens = [_launch_token(pem, issuer, i) for i in range(n)]
+    times = []
+    for tok in tokens:
+        t0 = time.perf_counter()
+        await validate_lti_id_token(tok)
+        times.append((time.perf_counter() - t0) * 1000)
+    return {"launches": n, "cold_ms": round(times[0], 3), "p50_ms": round(_percentile(times, 50), 3),
+            "p99_ms": round(_percentile(times, 99), 3), "mean_ms": round(statistics.fmean(times), 3)}
+
+async def bench_transfer(issuer: str, blob_url: str, archive: str = None) -> dict:
+    from datetime import datetime, timedelta
+    from app.db import SessionLocal
+    from app.jobs import run_transfer, file_entry
+    from sqlalchemy import insert
+    from app.models import Platform, TransferJob, TransferFile, UserToken
+    from app.moodle import list_course_files
+    from app.transfer_files import file_rows
+
+    db = SessionLocal()
+    platform = Platform(issuer=issuer, oauth_token_endpoint=f"{issuer}/oauth2/token.php",
+                        jwks_endpoint=f"{issuer}/mod/lti/certs.php")
+    db.add(platform)
+    db.add(UserToken(issuer=issuer, user_sub=ISSUER_SUB, access_token="bench-access", refresh_token="bench-refresh",
+                     expires_at=datetime.utcnow() + timedelta(hours=1)))
+    db.commit()
+
+    t0 = time.perf_counter()
+    files = [file_entry(f) for f in await list_course_files(platform, ISSUER_SUB, 2)]
+    list_s = time.perf_counter() - t0
+    job = TransferJob(issuer=issuer, requester_sub=ISSUER_SUB, course_id="2", source="moodle", destination="azure",
+                      status="queued", files_total=len(files), bytes_total=sum(f["filesize"] for f in files),
+                      mode="archive" if archive else "copy", archive_format=archive)
+    db.add(job); db.flush()
+    db.execute(insert(TransferFile), file_rows(job.id, files))
+    db.commit()
+    job_id, total = job.id, job.bytes_total
+    db.close()
+
+    t0 = time.perf_counter()
+    await run_transfer(job_id)
+    elapsed = time.perf_counter() - t0
+
+    db = SessionLocal()
+    job = db.get(TransferJob, job_id)
+    status = job.status
+    db.close()
+    stats = httpx.get(f"{blob_url}/_stats").json()
+    return {"status": status, "files": len(files), "bytes": total, "seconds": round(elapsed, 3),
+            "mb_per_s": round(total / 1024 / 1024 / elapsed, 2), "files_per_s": round(len(files) / elapsed, 2),
+            "list_ms": round(list_s * 1000, 3), "blob_bytes_committed": stats["bytes_committed"],
+            "blob_requests": stats["requests"], "blob_bytes_received": stats["bytes_received"],
+            "blob_bytes_pulled": stats["bytes_pulled"],
+            # an archive adds member headers and a manifest on top of the file bytes
+            "verified": status == "completed" and (stats["bytes_committed"] > total if archive
+                                                   else stats["bytes_committed"] == total)}
+
+def main(argv=None) -> int:
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--files", type=int, default=20)
+    p.add_argument("--file-size-mb", type=float, default=8)
+    p.add_argument("--latency-ms", type=float, default=0, help="fake Moodle delay before every response")
+    p.add_argument("--bandwidth-mbps", type=float, default=0, help="per-download throttle in MB/s, 0 = none")
+    p.add_argument("--no-ranges", action="store_true", help="fake Moodle ignores Range headers")
+    p.add_argument("--archive", choices=["zip", "tar"], help="transfer in archive mode, into one blob")
+    p.add_argument("--server-copy", action="store_true", help="AZURE_SERVER_COPY: the fake Blob pulls from Moodle")
+    p.add_argument("--source-unreachable", action="store_true",
+                   help="the fake Blob can't reach Moodle, so server-side copies fall back to streaming")
+    p.add_argument("--launches", type=int, default=200)
+    p.add_argument("--out", help="write JSON results here (default: stdout)")
+    args = p.parse_args(argv)
+
+    pem, public = _signing_key()
+    cfg = MoodleConfig(files=args.files, file_size=int(args.file_size_mb * 1024 * 1024),
+                       latency=args.latency_ms / 1000, bandwidth=args.bandwidth_mbps * 1024 * 1024,
+                       ranges=not args.no_ranges, jwks={"keys": [public]},
+                       blob_can_reach=not args.source_unreachable)
+    # Fakes run in their own process so the RSS and CPU measured here are the app's alone
+    ready, stop = multiprocessing.Queue(), multiprocessing.Event()
+    server = multiprocessing.Process(target=serve, args=(cfg, ready, stop), daemon=True)
+    server.start()
+    moodle_url, blob_url = ready.get(timeout=30)
+
+    tmp = tempfile.mkdtemp(prefix="bench-")
+    # Must be set before app.config is imported
+    os.environ.update({
+        "DATABASE_URL": f"sqlite:///{tmp}/bench.db",
+        "REDIS_URL": "",
+        "LTI_TOOL_PRIVATE_KEY_JWK": "{}",
+        "AZURE_STORAGE_ACCOUNT": "devstoreaccount1",
+        "AZURE_STORAGE_KEY": base64.b64encode(b"bench-storage-key").decode(),
+        "AZURE_BLOB_CONTAINER": "bench",
+        "AZURE_BLOB_ENDPOINT": f"{blob_url}/devstoreaccount1",
+        "TRANSFER_CHUNK_FILES": "0",  # no fan-out: there is no queue to hand chunks to
+    })
+    if args.server_copy:
+        os.environ["AZURE_SERVER_COPY"] = "true"
+    from app.db import init_db, close_async_engine
+    from app.http_clients import close_clients
+    init_db()
+
+    async def _run():
+        try:
+            launch = await bench_launch(pem, moodle_url, args.launches)
+            transfer = await bench_transfer(moodle_url, blob_url, args.archive)
+            return launch, transfer
+        finally:
+            await close_clients()
+            await close_async_engine()
+
+    try:
+        launch, transfer = asyncio.run(_run())
+    finally:
+        stop.set()
+        server.join(timeout=5)
+
+    from app.config import settings
+    result = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "git_rev": _git_rev(),
+        "python": platform.python_version(),
+        "params": {**vars(args), "block_size_mb": settings.AZURE_BLOB_BLOCK_SIZE_MB,
+                   "upload_concurrency": settings.AZURE_BLOB_UPLOAD_CONCURRENCY,
+                   "file_concurrency": settings.TRANSFER_FILE_CONCURRENCY,
+                   "ranged_copy": settings.AZURE_RANGED_COPY, "server_copy": settings.AZURE_SERVER_COPY},
+        "launch": launch,
+        "transfer": transfer,
+        "peak_rss_mb": round(_rss_mb(), 1),
+    }
+    out = json.dumps(result, indent=2)
+    if args.out:
+        with open(args.out, "w") as fh:
+            fh.write(out + "\n")
+    else:
+        print(out)
+    return 0 if transfer["verified"] else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,10 @@
+import base64, os, tempfile
+
+# Settings are read at import: point the app at a throwaway SQLite file and no Redis before anything loads
+_db = os.path.join(tempfile.mkdtemp(), "test.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{_db}"
+os.environ["REDIS_URL"] = ""
+os.environ.setdefault("LTI_TOOL_PRIVATE_KEY_JWK", "{}")
+os.environ.setdefault("AZURE_STORAGE_ACCOUNT", "devstoreaccount1")
+os.environ.setdefault("AZURE_STORAGE_KEY", base64.b64encode(b"key").decode())
+os.environ.setdefault("AZURE_BLOB_CONTAINER", "test")
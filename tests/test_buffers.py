@@ -0,0 +1,89 @@
+import asyncio
+from app.buffers import MAX_BLOCKS, MiB, UploadBuffers, block_size_for, single_put
+from app.config import settings
+
+def test_block_size_follows_file_size(monkeypatch):
+    monkeypatch.setattr(settings, "AZURE_BLOB_BLOCK_SIZE_MB", 8)
+    monkeypatch.setattr(settings, "AZURE_BLOB_MAX_BLOCK_MB", 64)
+    assert block_size_for(None) == 8 * MiB
+    assert block_size_for(100 * MiB) == 8 * MiB
+    assert block_size_for(20 * 1024 * MiB) == 32 * MiB  # ~1000 blocks, rounded up to a power of two
+    assert block_size_for(200 * 1024 * MiB) == 64 * MiB  # capped at AZURE_BLOB_MAX_BLOCK_MB
+
+def test_block_size_stays_within_azure_block_limit(monkeypatch):
+    monkeypatch.setattr(settings, "AZURE_BLOB_BLOCK_SIZE_MB", 8)
+    monkeypatch.setattr(settings, "AZURE_BLOB_MAX_BLOCK_MB", 64)
+    for size in (4 * 1024 * 1024 * MiB, 50_000 * 64 * MiB + 1, 10 * 1024 * 1024 * MiB):
+        block = block_size_for(size)
+        assert -(-size // block) <= MAX_BLOCKS
+        assert block % MiB == 0 and (block // MiB) & (block // MiB - 1) == 0
+
+def test_single_put(monkeypatch):
+    monkeypatch.setattr(settings, "AZURE_SINGLE_PUT_MB", 4)
+    assert single_put(4 * MiB)
+    assert not single_put(4 * MiB + 1)
+    assert not single_put(0) and not single_put(None)
+
+def test_reservations_are_granted_in_arrival_order():
+    async def run():
+        b = UploadBuffers(10)
+        await b.reserve(8)
+        granted = []
+
+        async def want(n):
+            await b.reserve(n)
+            granted.append(n)
+
+        big = asyncio.ensure_future(want(5))
+        small = asyncio.ensure_future(want(1))
+        await asyncio.sleep(0)
+        assert granted == []  # 1 byte would fit, but the 5 asked first
+        b.unreserve(8)
+        await asyncio.gather(big, small)
+        assert granted == [5, 1] and b.used == 6
+    asyncio.run(run())
+
+def test_oversized_reservation_is_clamped_to_the_budget():
+    async def run():
+        b = UploadBuffers(10)
+        assert await b.reserve(25) == 10
+        assert b.used == 10
+    asyncio.run(run())
+
+def test_cancelled_waiter_lets_the_next_one_in():
+    async def run():
+        b = UploadBuffers(10)
+        await b.reserve(8)
+        first = asyncio.ensure_future(b.reserve(5))
+        second = asyncio.ensure_future(b.reserve(2))
+        await asyncio.sleep(0)
+        assert not second.done()
+        first.cancel()
+        assert await asyncio.wait_for(second, 1) == 2
+        assert b.used == 10 and not b.waiters
+    asyncio.run(run())
+
+def test_waiter_cancelled_just_after_its_grant_gives_it_back():
+    async def run():
+        b = UploadBuffers(10)
+        await b.reserve(8)
+        waiter = asyncio.ensure_future(b.reserve(5))
+        await asyncio.sleep(0)
+        b.unreserve(8)  # grants the 5 before the waiter gets to run
+        waiter.cancel()
+        await asyncio.sleep(0)
+        assert waiter.cancelled() and b.used == 0
+    asyncio.run(run())
+
+def test_buffers_are_pooled_within_the_budget():
+    async def run():
+        b = UploadBuffers(8)
+        buf = await b.take(4)
+        b.give(buf)
+        assert b.used == 0 and b.idle == 4
+        assert await b.take(4) is buf
+        b.give(buf)
+        # Live buffers need the room: the idle one is dropped rather than going over the budget
+        big = await b.take(8)
+        assert len(big) == 8 and b.idle == 0 and b.used == 8
+    asyncio.run(run())
@@ -0,0 +1,50 @@
+import asyncio, base64, hashlib, hmac, json, time
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from fastapi import HTTPException
+from jose import jwk, jwt
+import app.lti as lti
+
+ISS = "https://moodle.example"
+ROLES = {"https://purl.imsglobal.org/spec/lti/claim/roles": [next(iter(lti.ADMIN_ROLE_URIS))]}
+
+@pytest.fixture
+def rsa_key(monkeypatch):
+    private = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = private.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                serialization.NoEncryption())
+    public = private.public_key().public_bytes(serialization.Encoding.PEM,
+                                               serialization.PublicFormat.SubjectPublicKeyInfo)
+    public_jwk = {**jwk.RSAKey(public, "RS256").to_dict(), "kid": "k1"}
+    public_jwk.pop("alg", None)  # Moodle's JWKS doesn't always name it
+    entry = lti.JwksEntry(f"{ISS}/mod/lti/certs.php", True)
+    lti._load(entry, {"keys": [public_jwk]}, 3600)
+    monkeypatch.setattr(lti, "_jwks_cache", lti.OrderedDict({ISS: entry}))
+    return pem, public
+
+def b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+def hs256(header: dict, claims: dict, secret: bytes) -> str:
+    # By hand: jose itself refuses to use a PEM key as an HMAC secret
+    signing_input = f"{b64(json.dumps(header).encode())}.{b64(json.dumps(claims).encode())}"
+    return f"{signing_input}.{b64(hmac.new(secret, signing_input.encode(), hashlib.sha256).digest())}"
+
+def validate(token):
+    return asyncio.run(lti.validate_lti_id_token(token))
+
+def test_rs256_token_is_accepted(rsa_key):
+    pem, _ = rsa_key
+    token = jwt.encode({"iss": ISS, "exp": time.time() + 60, **ROLES}, pem, "RS256", headers={"kid": "k1"})
+    assert validate(token)["iss"] == ISS
+
+def test_hmac_token_against_an_rsa_key_is_rejected(rsa_key):
+    # Signed with the RSA public key as the HMAC secret: must be a 401, not verified and not a 500
+    _, public = rsa_key
+    for kid in ("k1", None):
+        headers = {"kid": kid} if kid else {}
+        token = hs256({"alg": "HS256", "typ": "JWT", **headers}, {"iss": ISS, "exp": time.time() + 60, **ROLES}, public)
+        with pytest.raises(HTTPException) as e:
+            validate(token)
+        assert e.value.status_code == 401
@@ -0,0 +1,25 @@
+import asyncio
+from app.config import settings
+from app.ratelimit import HostLimiter
+
+def test_cancel_while_waiting_for_a_token_gives_the_slot_back(monkeypatch):
+    monkeypatch.setattr(settings, "MOODLE_RATE_BURST", 1)
+    monkeypatch.setattr(settings, "MOODLE_RATE_PER_SEC", 0.5)
+    monkeypatch.setattr(settings, "MOODLE_CONCURRENCY_START", 1)
+
+    async def run():
+        lim = HostLimiter("http://moodle.test")
+        async with lim.slot():  # spends the only token
+            pass
+        parked = asyncio.ensure_future(lim.slot().__aenter__())
+        await asyncio.sleep(0.05)
+        assert lim.inflight == 1  # holding the slot while it sleeps for the next token
+        parked.cancel()
+        await asyncio.gather(parked, return_exceptions=True)
+        await asyncio.sleep(0)
+        assert lim.inflight == 0
+        # The window isn't stuck: with a token available again the next caller gets straight in
+        lim.tokens = 1.0
+        await asyncio.wait_for(lim.acquire(), 1)
+        assert lim.inflight == 1
+    asyncio.run(run())
@@ -0,0 +1,174 @@
+import asyncio
+from collections import namedtuple
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import delete, select
+import app.jobs as jobs
+import app.scheduler as sc
+from app.db import SessionLocal, engine
+from app.models import Base, TransferJob
+
+MB = 1024 * 1024
+Row = namedtuple("Row", "id issuer requester_sub priority bytes_total bytes_sent")
+
+def row(id, issuer, mb=10, sub=None, priority=sc.BULK):
+    return Row(id, issuer, sub or f"{issuer}-user", priority, mb * MB, 0)
+
+def order(rows, tags=None, skip=None):
+    return [r.id for r in sc.fair_order(rows, {} if tags is None else tags, skip=skip)]
+
+def test_priority_for():
+    assert sc.priority_for(10 * MB) == sc.INTERACTIVE
+    assert sc.priority_for(10 * MB, requested="bulk") == sc.BULK
+    assert sc.priority_for(10 * MB, whole_course=True) == sc.BULK
+    assert sc.priority_for((sc.settings.SCHED_INTERACTIVE_MB + 1) * MB) == sc.BULK
+
+def test_issuers_alternate_with_ties_to_the_oldest_job():
+    rows = [row(1, "A"), row(2, "A"), row(3, "A"), row(4, "B"), row(5, "B"), row(6, "B")]
+    assert order(rows) == [1, 4, 2, 5, 3, 6]
+
+def test_issuers_share_by_bytes_not_jobs():
+    rows = [row(1, "A", 30), row(2, "A", 30), row(3, "B"), row(4, "B"), row(5, "B"), row(6, "B")]
+    assert order(rows) == [1, 3, 4, 5, 2, 6]
+
+def test_requesters_share_within_an_issuer():
+    rows = [row(1, "A", sub="a1"), row(2, "A", sub="a1"), row(3, "A", sub="a1"), row(4, "A", sub="a2")]
+    assert order(rows) == [1, 4, 2, 3]
+
+def test_interactive_class_gets_its_weight_and_wins_ties(monkeypatch):
+    monkeypatch.setattr(sc.settings, "SCHED_INTERACTIVE_WEIGHT", 4)
+    rows = [row(1, "A"), row(2, "A")] + [row(i, "B", priority=sc.INTERACTIVE) for i in range(3, 8)]
+    assert order(rows) == [3, 1, 4, 5, 6, 7, 2]
+
+def test_skip_leaves_the_issuer_out_for_the_rest_of_the_pass():
+    rows = [row(1, "A"), row(2, "A"), row(3, "A"), row(4, "B"), row(5, "B")]
+    assert order(rows, skip=lambda r: r.id == 2) == [1, 4, 5]
+
+def test_idle_flow_restarts_at_virtual_time():
+    tags = {}
+    assert order([row(1, "A"), row(2, "A"), row(3, "A")], tags) == [1, 2, 3]
+    # B was idle while A went alone; it must not get three turns in a row to "catch up"
+    rows = [row(4, "A"), row(5, "A"), row(6, "B"), row(7, "B"), row(8, "B")]
+    assert order(rows, tags) == [6, 4, 7, 5, 8]
+
+class FakeQueue:
+    def __init__(self, fail_after=None):
+        self.enqueued = []
+        self.fail_after = fail_after
+
+    def enqueue(self, fn, *args, **kwargs):
+        if self.fail_after is not None and len(self.enqueued) >= self.fail_after:
+            raise ConnectionError("redis down")
+        self.enqueued.append(args[0])
+
+@pytest.fixture
+def queue(monkeypatch):
+    Base.metadata.create_all(bind=engine)
+    monkeypatch.setattr(sc, "_local_tags", {})
+    monkeypatch.setattr(sc, "_local_positions", {})
+    q = FakeQueue()
+    monkeypatch.setattr(sc, "get_queue", lambda: q)
+    yield q
+    with SessionLocal() as db:
+        db.execute(delete(TransferJob)); db.commit()
+
+def add_jobs(*specs):
+    with SessionLocal() as db:
+        jobs = [TransferJob(issuer=issuer, requester_sub="u", course_id="1", source="moodle", destination="azure",
+                            status="queued", priority=sc.BULK, bytes_total=mb * MB, bytes_sent=0)
+                for issuer, mb in specs]
+        db.add_all(jobs); db.commit()
+        return [j.id for j in jobs]
+
+def complete(job_id):
+    # What a worker does at the end of a run
+    with SessionLocal() as db:
+        db.get(TransferJob, job_id).status = "completed"; db.commit()
+    sc.finished(job_id)
+
+def dispatched():
+    with SessionLocal() as db:
+        return sorted(db.scalars(select(TransferJob.id).where(TransferJob.dispatched_at.is_not(None))))
+
+def test_dispatch_stops_at_max_active_jobs(queue, monkeypatch):
+    monkeypatch.setattr(sc.settings, "SCHED_MAX_ACTIVE_JOBS", 2)
+    a1, a2, a3 = add_jobs(("A", 10), ("A", 10), ("A", 10))
+    assert sc.dispatch() == 2
+    assert queue.enqueued == [a1, a2] and dispatched() == [a1, a2]
+    assert sc.dispatch() == 0
+    complete(a1)
+    assert queue.enqueued == [a1, a2, a3] and dispatched() == [a2, a3]
+
+def test_dispatch_caps_bytes_in_flight_per_issuer(queue, monkeypatch):
+    monkeypatch.setattr(sc.settings, "SCHED_ISSUER_MAX_ACTIVE_MB", 15)
+    a1, a2, b1 = add_jobs(("A", 10), ("A", 10), ("B", 10))
+    assert sc.dispatch() == 2
+    assert sorted(queue.enqueued) == [a1, b1]
+    complete(a1)
+    assert a2 in queue.enqueued
+
+def test_dispatch_records_where_waiting_jobs_stand(queue, monkeypatch):
+    monkeypatch.setattr(sc.settings, "SCHED_MAX_ACTIVE_JOBS", 1)
+    a1, a2, b1 = add_jobs(("A", 10), ("A", 10), ("B", 10))
+    assert sc.dispatch() == 1 and queue.enqueued == [a1]
+    assert sc._load_position(a1) is None
+    assert sc._load_position(b1) == (1, 0) and sc._load_position(a2) == (2, 10 * MB)
+    (b2,) = add_jobs(("B", 10))
+    assert sc.dispatch() == 0 and sc._load_position(b2) == (3, 20 * MB)
+
+def test_issuer_with_nothing_running_may_start_a_job_over_the_cap(queue, monkeypatch):
+    monkeypatch.setattr(sc.settings, "SCHED_ISSUER_MAX_ACTIVE_MB", 15)
+    (big,) = add_jobs(("A", 100))
+    assert sc.dispatch() == 1 and queue.enqueued == [big]
+
+def test_enqueue_failure_hands_the_rest_back(queue):
+    queue.fail_after = 1
+    a1, a2, a3 = add_jobs(("A", 10), ("A", 10), ("A", 10))
+    with pytest.raises(ConnectionError):
+        sc.dispatch()
+    assert queue.enqueued == [a1] and dispatched() == [a1]
+    assert sc._local_tags == {}  # saved only once everything picked is on the queue
+    queue.fail_after = None
+    assert sc.dispatch() == 2 and dispatched() == [a1, a2, a3]
+
+def lose_worker(job_id, resumes=0):
+    # A run that started and then went silent for longer than TRANSFER_STALE_SECONDS
+    with SessionLocal() as db:
+        job = db.get(TransferJob, job_id)
+        job.status = "running"; job.resumes = resumes; job.dispatched_at = datetime.utcnow()
+        job.updated_at = datetime.utcnow() - timedelta(seconds=sc.settings.TRANSFER_STALE_SECONDS + 1)
+        db.commit()
+
+def status(job_id):
+    with SessionLocal() as db:
+        return db.get(TransferJob, job_id).status
+
+def test_job_that_lost_its_worker_is_queued_again(queue, monkeypatch):
+    monkeypatch.setattr(sc, "_recovered_at", 0.0)
+    a1, a2 = add_jobs(("A", 10), ("A", 10))
+    lose_worker(a1)
+    lose_worker(a2, resumes=sc.settings.TRANSFER_MAX_RESUMES)
+    assert sc.dispatch() == 1
+    assert queue.enqueued == [a1] and status(a1) == "queued"
+    assert status(a2) == "failed" and dispatched() == [a1]
+
+def test_slot_of_a_run_that_ended_without_finished_is_reclaimed(queue, monkeypatch):
+    monkeypatch.setattr(sc.settings, "SCHED_MAX_ACTIVE_JOBS", 1)
+    monkeypatch.setattr(sc, "_recovered_at", 0.0)
+    a1, a2 = add_jobs(("A", 10), ("A", 10))
+    assert sc.dispatch() == 1
+    with SessionLocal() as db:
+        db.get(TransferJob, a1).status = "completed"; db.commit()
+    monkeypatch.setattr(sc, "_recovered_at", 0.0)
+    assert sc.dispatch() == 1 and queue.enqueued == [a1, a2]
+
+def test_run_hands_its_slot_back_when_it_crashes(monkeypatch):
+    freed = []
+
+    async def crash(job_id):
+        raise RuntimeError("boom")
+    monkeypatch.setattr(jobs, "_run_transfer", crash)
+    monkeypatch.setattr(jobs, "finished", freed.append)
+    with pytest.raises(RuntimeError):
+        asyncio.run(jobs.run_transfer(7))
+    assert freed == [7]